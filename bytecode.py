@@ -0,0 +1,494 @@
+"""The `.fastc` binary format for compiled programs
+
+A file holds one closure (usually the top level closure `compile.compile` returns) and every spec reachable from it:
+
+    header     magic, format version, and the sizes of the sections below
+    words      little endian int32s: for each spec, its record (argument count, instruction count, capture count and
+               capture refs, constant count and the pool indices of its constant table) followed by the operands of its
+               instructions
+    opcodes    one byte per instruction, the specs' code one after another
+    constants  the constant pool: Fast values, raw Python scalars and switch keys, each entry a tag byte and a payload
+
+Specs are numbered in the order they are written, and nested specs are referred to by number. Refs are packed into one
+word, with the kind in the low three bits. The loader decodes straight from the buffer it is given, so `load` maps the
+file and reads instructions from the mapping without copying any section first.
+"""
+
+import mmap
+import struct
+import sys
+from array import array
+from dataclasses import fields
+from enum import IntEnum
+from typing import Union
+
+from errors import BytecodeError
+from instr import (
+    Arg,
+    ArrayExtend,
+    ArrayPush,
+    ArraySlice,
+    Assert,
+    BinaryOp,
+    Call,
+    Cap,
+    CaptureSet,
+    ClosureNew,
+    Compare,
+    Const,
+    Fail,
+    FloatBinaryOp,
+    Imm,
+    Index,
+    Instr,
+    IntBinaryOp,
+    Jump,
+    LocalJump,
+    MatchArray,
+    NumberCompare,
+    Pop,
+    Push,
+    PushArrayPush,
+    PushCall,
+    PushTailCall,
+    Ref,
+    Reg,
+    Return,
+    Stack,
+    Store,
+    StorePop,
+    StringConcat,
+    StringFormat,
+    Switch,
+    TailCall,
+    UnaryOp,
+)
+from value import UNIT, Array, Bool, Closure, ClosureSpec, Float, Int, String, Tag, Unit, Value, boolean
+
+MAGIC = b"FASTC\0"
+VERSION = 4
+HEADER = struct.Struct("<6sHIIIII")  # magic, version, root constant, specs, instructions, words, constant bytes
+
+
+class Operand(IntEnum):
+    """How an instruction field is stored in the words section"""
+
+    REF = 0  # one packed ref
+    INT = 1  # one word
+    STR = 2  # the pool index of a string
+    REFS = 3  # a count, then packed refs
+    STRS = 4  # a count, then pool indices of strings
+    CASES = 5  # a count, then pairs of the pool index of a switch key and a destination
+    SPEC = 6  # a spec number
+
+
+REF, INT, STR, REFS, STRS, CASES, SPEC = Operand
+
+# The operand layout of every instruction, in field order. Opcodes are positions in this table, so entries are only
+# ever appended, and changing one means bumping `VERSION`.
+OPCODES: list[tuple[type[Instr], tuple[Operand, ...]]] = [
+    (Push, (REF,)),
+    (ArrayPush, (REF, REF)),
+    (ArrayExtend, (REF, REF)),
+    (StringFormat, (STRS, REFS)),
+    (ClosureNew, (SPEC,)),
+    (Call, (REF, INT)),
+    (TailCall, (REF, INT)),
+    (CaptureSet, (REF, INT, REF)),
+    (LocalJump, (REF, INT)),
+    (Jump, (INT,)),
+    (Switch, (REF, CASES, INT)),
+    (Return, ()),
+    (Store, (REF, REF)),
+    (Pop, (INT,)),
+    (Assert, (REF, STR)),
+    (MatchArray, (REF, INT, INT)),
+    (Fail, (STR,)),
+    (Index, (REF, REF)),
+    (ArraySlice, (REF, INT, INT)),
+    (PushArrayPush, (REF, REF)),
+    (PushCall, (REF, REFS)),
+    (PushTailCall, (REF, REFS)),
+    (StorePop, (REF, REF, INT)),
+    (BinaryOp, (STR, REF, REF)),
+    (UnaryOp, (STR, REF)),
+    (Compare, (STRS, REFS)),
+    (IntBinaryOp, (STR, REF, REF)),
+    (FloatBinaryOp, (STR, REF, REF)),
+    (StringConcat, (REF, REF)),
+    (NumberCompare, (STR, REF, REF)),
+]
+OPCODE = {cls: opcode for opcode, (cls, _) in enumerate(OPCODES)}
+
+# Ref kinds. `TEMPLATE` is a value pushed as is, like the array templates of array literals.
+REF_KINDS: list[type] = [Stack, Arg, Cap, Imm, Reg, Const]
+TEMPLATE = len(REF_KINDS)
+
+
+class PoolTag(IntEnum):
+    """The tag byte of a constant pool entry"""
+
+    UNIT = 0
+    BOOL = 1
+    INT = 2
+    FLOAT = 3
+    STRING = 4
+    TAG = 5
+    ARRAY = 6
+    CLOSURE = 7
+    KEY = 8
+    PY_STR = 9
+    PY_INT = 10
+    PY_FLOAT = 11
+    PY_BOOL = 12
+
+
+KEY_TYPES: list[type] = [Array, Bool, Int, Float, String, Tag]
+
+U32 = struct.Struct("<I")
+I32 = struct.Struct("<i")
+F64 = struct.Struct("<d")
+
+
+def _int_bytes(n: int) -> bytes:
+    return n.to_bytes(n.bit_length() // 8 + 1, "little", signed=True)
+
+
+class Writer:
+    """Serializes a closure and everything reachable from it"""
+
+    def __init__(self):
+        self.words = array("i")
+        self.opcodes = bytearray()
+        self.constants = bytearray()
+        self.n_constants = 0
+        # Values are pooled by identity, so sharing survives a round trip; the values are kept alive with their ids
+        self.pooled: dict = {}
+        self.specs: list[ClosureSpec] = []
+        self.spec_ids: dict[int, int] = {}
+
+    def entry(self, tag: PoolTag, payload: bytes = b"") -> int:
+        self.constants.append(tag)
+        self.constants += payload
+        self.n_constants += 1
+        return self.n_constants - 1
+
+    def text(self, tag: PoolTag, s: str) -> int:
+        data = s.encode()
+        return self.entry(tag, U32.pack(len(data)) + data)
+
+    def indices(self, indices: list[int]) -> bytes:
+        return U32.pack(len(indices)) + b"".join(I32.pack(i) for i in indices)
+
+    def constant(self, value) -> int:
+        """The pool index of a value, adding it and what it contains to the pool first if needed"""
+        if isinstance(value, Value):
+            key = (id(value),)
+        else:
+            # Floats by their bits, so 0.0 and -0.0 stay apart
+            key = (type(value), F64.pack(value) if isinstance(value, float) else value)
+        if (index := self.pooled.get(key)) is not None:
+            return index[0]
+        match value:
+            case Unit():
+                index = self.entry(PoolTag.UNIT)
+            case Bool(b):
+                index = self.entry(PoolTag.BOOL, bytes([b]))
+            case Int(n):
+                data = _int_bytes(n)
+                index = self.entry(PoolTag.INT, U32.pack(len(data)) + data)
+            case Float(x):
+                index = self.entry(PoolTag.FLOAT, F64.pack(x))
+            case String(s):
+                index = self.text(PoolTag.STRING, s)
+            case Tag(s):
+                index = self.text(PoolTag.TAG, s)
+            case Array(values):
+                items = [-1 if item is None else self.constant(item) for item in values]
+                index = self.entry(PoolTag.ARRAY, self.indices(items))
+            case Closure(spec, captures):
+                items = [self.constant(capture) for capture in captures]
+                index = self.entry(PoolTag.CLOSURE, U32.pack(self.spec(spec)) + self.indices(items))
+            case (type() as ty, payload) if ty in KEY_TYPES:
+                index = self.entry(PoolTag.KEY, bytes([KEY_TYPES.index(ty)]) + U32.pack(self.constant(payload)))
+            case bool():
+                index = self.entry(PoolTag.PY_BOOL, bytes([value]))
+            case int():
+                data = _int_bytes(value)
+                index = self.entry(PoolTag.PY_INT, U32.pack(len(data)) + data)
+            case float():
+                index = self.entry(PoolTag.PY_FLOAT, F64.pack(value))
+            case str():
+                index = self.text(PoolTag.PY_STR, value)
+            case _:
+                raise NotImplementedError(f"`Writer.constant({type(value).__name__})`")
+        self.pooled[key] = (index, value)
+        return index
+
+    def spec(self, spec: ClosureSpec) -> int:
+        """The number of a spec, queueing it to be written if it is new"""
+        if type(spec) is not ClosureSpec:
+            raise NotImplementedError(f"`Writer.spec({type(spec).__name__})`")
+        if (index := self.spec_ids.get(id(spec))) is None:
+            index = self.spec_ids[id(spec)] = len(self.specs)
+            self.specs.append(spec)
+        return index
+
+    def ref(self, ref) -> int:
+        if isinstance(ref, Imm):
+            packed = self.constant(ref.value) << 3 | REF_KINDS.index(Imm)
+        elif isinstance(ref, Ref):
+            packed = ref.index << 3 | REF_KINDS.index(type(ref))
+        else:
+            packed = self.constant(ref) << 3 | TEMPLATE
+        return packed
+
+    def operand(self, kind: Operand, value):
+        match kind:
+            case Operand.REF:
+                self.words.append(self.ref(value))
+            case Operand.INT:
+                self.words.append(value)
+            case Operand.STR:
+                self.words.append(self.constant(value))
+            case Operand.REFS:
+                self.words.append(len(value))
+                self.words.extend(self.ref(ref) for ref in value)
+            case Operand.STRS:
+                self.words.append(len(value))
+                self.words.extend(self.constant(s) for s in value)
+            case Operand.CASES:
+                self.words.append(len(value))
+                for key, dest in value.items():
+                    self.words.extend([self.constant(key), dest])
+            case Operand.SPEC:
+                self.words.append(self.spec(value))
+
+    def instr(self, instr: Instr):
+        if (opcode := OPCODE.get(type(instr))) is None:
+            raise NotImplementedError(f"`Writer.instr({type(instr).__name__})`")
+        self.opcodes.append(opcode)
+        _, layout = OPCODES[opcode]
+        for kind, field in zip(layout, fields(instr)):
+            self.operand(kind, getattr(instr, field.name))
+
+    def write(self, closure: Closure) -> bytes:
+        root = self.constant(closure)
+        # Writing a spec can discover more specs, which are appended and written in turn
+        i = 0
+        while i < len(self.specs):
+            spec = self.specs[i]
+            self.words.extend([spec.n_args, len(spec.code), len(spec.capture_indices)])
+            self.words.extend(self.ref(ref) for ref in spec.capture_indices)
+            self.words.append(len(spec.constants))
+            self.words.extend(self.constant(value) for value in spec.constants)
+            for instr in spec.code:
+                self.instr(instr)
+            i += 1
+
+        words = self.words
+        if sys.byteorder == "big":
+            words = array("i", words)
+            words.byteswap()
+        header = HEADER.pack(
+            MAGIC, VERSION, root, len(self.specs), len(self.opcodes), len(self.words), len(self.constants)
+        )
+        return header + words.tobytes() + bytes(self.opcodes) + bytes(self.constants)
+
+
+def dumps(closure: Closure) -> bytes:
+    """Encode a compiled closure in the `.fastc` format
+
+    Raises:
+        NotImplementedError: The closure holds values or instructions the format has no encoding for
+    """
+    return Writer().write(closure)
+
+
+def write(closure: Closure, path: str):
+    """Write a compiled closure to a `.fastc` file"""
+    data = dumps(closure)
+    with open(path, "wb") as file:
+        file.write(data)
+
+
+class Reader:
+    """Decodes a `.fastc` image from a buffer, reading each section in place"""
+
+    def __init__(self, view: memoryview):
+        self.view = view
+        if len(view) < HEADER.size:
+            raise BytecodeError("Truncated header")
+        magic, version, self.root, n_specs, n_ops, n_words, n_constants = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise BytecodeError("Not a .fastc file")
+        if version != VERSION:
+            raise BytecodeError(f"Unsupported .fastc version {version}, expected {VERSION}")
+        start = HEADER.size
+        ops_start = start + 4 * n_words
+        constants_start = ops_start + n_ops
+        if len(view) != constants_start + n_constants:
+            raise BytecodeError("Truncated or oversized file")
+
+        words = view[start:ops_start].cast("i")
+        if sys.byteorder == "big":
+            swapped = array("i", words)
+            swapped.byteswap()
+            words.release()
+            words = memoryview(swapped)
+        self.words = words
+        self.opcodes = view[ops_start:constants_start]
+        self.constants_start = constants_start
+        self.specs = [ClosureSpec([], 0, []) for _ in range(n_specs)]
+        self.pool: list = []
+        self.word = 0
+
+    def release(self):
+        self.words.release()
+        self.opcodes.release()
+
+    def next_word(self) -> int:
+        self.word += 1
+        return self.words[self.word - 1]
+
+    def read_constants(self):
+        view, pos, end = self.view, self.constants_start, len(self.view)
+
+        def u32() -> int:
+            nonlocal pos
+            pos += 4
+            return U32.unpack_from(view, pos - 4)[0]
+
+        def raw(n: int) -> memoryview:
+            nonlocal pos
+            pos += n
+            return view[pos - n : pos]
+
+        def indices() -> list[int]:
+            nonlocal pos
+            n = u32()
+            pos += 4 * n
+            return [I32.unpack_from(view, pos - 4 * (n - i))[0] for i in range(n)]
+
+        def text() -> str:
+            with raw(u32()) as data:
+                return str(data, "utf-8")
+
+        def integer() -> int:
+            with raw(u32()) as data:
+                return int.from_bytes(data, "little", signed=True)
+
+        while pos < end:
+            tag = view[pos]
+            pos += 1
+            match tag:
+                case PoolTag.UNIT:
+                    value = UNIT
+                case PoolTag.BOOL:
+                    value = boolean(bool(view[pos]))
+                    pos += 1
+                case PoolTag.INT:
+                    value = Int(integer())
+                case PoolTag.FLOAT:
+                    value = Float(F64.unpack_from(view, pos)[0])
+                    pos += 8
+                case PoolTag.STRING:
+                    value = String(text())
+                case PoolTag.TAG:
+                    value = Tag(text())
+                case PoolTag.ARRAY:
+                    value = Array([None if i == -1 else self.pool[i] for i in indices()])
+                case PoolTag.CLOSURE:
+                    spec = self.specs[u32()]
+                    value = Closure(spec, [self.pool[i] for i in indices()])
+                case PoolTag.KEY:
+                    ty = KEY_TYPES[view[pos]]
+                    pos += 1
+                    value = (ty, self.pool[u32()])
+                case PoolTag.PY_STR:
+                    value = text()
+                case PoolTag.PY_INT:
+                    value = integer()
+                case PoolTag.PY_FLOAT:
+                    value = F64.unpack_from(view, pos)[0]
+                    pos += 8
+                case PoolTag.PY_BOOL:
+                    value = bool(view[pos])
+                    pos += 1
+                case _:
+                    raise BytecodeError(f"Unknown constant tag {tag}")
+            self.pool.append(value)
+
+    def ref(self, word: int) -> Union[Ref, Value]:
+        kind, index = word & 7, word >> 3
+        if kind == TEMPLATE:
+            return self.pool[index]
+        if kind > TEMPLATE:
+            raise BytecodeError(f"Unknown ref kind {kind}")
+        if REF_KINDS[kind] is Imm:
+            return Imm(self.pool[index])
+        return REF_KINDS[kind](index)
+
+    def operand(self, kind: Operand):
+        match kind:
+            case Operand.REF:
+                return self.ref(self.next_word())
+            case Operand.INT:
+                return self.next_word()
+            case Operand.STR:
+                return self.pool[self.next_word()]
+            case Operand.REFS:
+                return [self.ref(self.next_word()) for _ in range(self.next_word())]
+            case Operand.STRS:
+                return [self.pool[self.next_word()] for _ in range(self.next_word())]
+            case Operand.CASES:
+                cases = {}
+                for _ in range(self.next_word()):
+                    key = self.pool[self.next_word()]
+                    cases[key] = self.next_word()
+                return cases
+            case Operand.SPEC:
+                return self.specs[self.next_word()]
+
+    def read(self) -> Closure:
+        self.read_constants()
+        ip = 0
+        for spec in self.specs:
+            spec.n_args = self.next_word()
+            n_instrs = self.next_word()
+            spec.capture_indices = [self.ref(self.next_word()) for _ in range(self.next_word())]
+            spec.constants = [self.pool[self.next_word()] for _ in range(self.next_word())]
+            with self.opcodes[ip : ip + n_instrs] as opcodes:
+                for opcode in opcodes:
+                    if opcode >= len(OPCODES):
+                        raise BytecodeError(f"Unknown opcode {opcode}")
+                    cls, layout = OPCODES[opcode]
+                    spec.code.append(cls(*[self.operand(kind) for kind in layout]))
+            ip += n_instrs
+        return self.pool[self.root]
+
+
+def loads(data) -> Closure:
+    """Decode a closure from a `.fastc` image in any buffer, such as `bytes` or an `mmap`
+
+    Raises:
+        BytecodeError: The image is malformed or of another format version
+    """
+    with memoryview(data) as view:
+        reader = Reader(view)
+        try:
+            return reader.read()
+        except (IndexError, struct.error) as e:
+            raise BytecodeError("Malformed .fastc file") from e
+        finally:
+            reader.release()
+
+
+def load(path: str) -> Closure:
+    """Map a `.fastc` file into memory and decode the closure in it
+
+    Raises:
+        BytecodeError: The file is malformed or of another format version
+    """
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+        return loads(mapping)
@@ -0,0 +1,94 @@
+"""In-memory LRU cache of compiled programs
+
+Entries are keyed by a hash of the source text and the compiler options. Compiled closures are mutable. `CaptureSet` rewrites captures, the peephole optimizer rewrites code lists in place, and array templates are shared with the code. So the cache keeps a private copy of each closure and hands out deep copies of it, and nothing a caller does to a result can reach the cache or another caller.
+"""
+
+from collections import OrderedDict
+from copy import deepcopy
+from dataclasses import dataclass
+from hashlib import sha256
+from typing import Optional
+
+from compile import compile
+from mixins import Format
+from pipeline import code_size
+from value import Closure
+
+
+@dataclass
+class CacheStats(Format):
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def __str__(self):
+        return f"cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions"
+
+
+def cache_key(source: str, options: dict) -> tuple:
+    return (sha256(source.encode()).hexdigest(), tuple(sorted(options.items())))
+
+
+class CompileCache:
+    """Least recently used compiled programs, bounded by entry count and by total instruction count"""
+
+    def __init__(self, max_entries: int = 256, max_instructions: int = 1 << 20):
+        self.max_entries = max_entries
+        self.max_instructions = max_instructions
+        self.entries: OrderedDict[tuple, tuple[Closure, int]] = OrderedDict()
+        self.instructions = 0
+        self.stats = CacheStats()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def compile(self, source: str, **options) -> Closure:
+        """`compile.compile(source, **options)`, reusing an earlier result for the same source and options
+
+        Raises:
+            TypeError: The source is not a string
+        """
+        if not isinstance(source, str):
+            raise TypeError("Only source text can be cached")
+        key = cache_key(source, options)
+        if (entry := self.entries.get(key)) is not None:
+            self.entries.move_to_end(key)
+            self.stats.hits += 1
+            return deepcopy(entry[0])
+
+        self.stats.misses += 1
+        closure = compile(source, **options)
+        size = code_size(closure.spec)
+        if size <= self.max_instructions and self.max_entries > 0:
+            self.entries[key] = (deepcopy(closure), size)
+            self.instructions += size
+            self.evict()
+        return closure
+
+    def evict(self):
+        """Drop least recently used entries until the cache is within its bounds"""
+        while len(self.entries) > self.max_entries or self.instructions > self.max_instructions:
+            _, (_, size) = self.entries.popitem(last=False)
+            self.instructions -= size
+            self.stats.evictions += 1
+
+    def invalidate(self, source: Optional[str] = None, **options) -> int:
+        """Drop the entry for `source` compiled with `options`, or every entry if no source is given
+
+        Returns:
+            int: The number of entries dropped
+        """
+        if source is None:
+            n = len(self.entries)
+            self.entries.clear()
+            self.instructions = 0
+            return n
+        entry = self.entries.pop(cache_key(source, options), None)
+        if entry is None:
+            return 0
+        self.instructions -= entry[1]
+        return 1
+
+
+# Shared by `vm.run` callers that opt in to caching
+default_cache = CompileCache()
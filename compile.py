@@ -1,53 +1,93 @@
-from dataclasses import dataclass, field
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, replace
+from itertools import repeat
 from typing import Optional
 
-from errors import CompileError
+import decision
+import infer
+import ops
+from comb import Span
+from constants import intern
+from errors import CompileError, VmError
 from instr import (
     Arg,
     ArrayExtend,
     ArrayPush,
+    ArraySlice,
     Assert,
+    BinaryOp,
     Call,
     Cap,
+    CaptureSet,
     ClosureNew,
+    Compare,
+    Fail,
+    FloatBinaryOp,
+    Index,
+    IntBinaryOp,
+    Jump,
     LocalJump,
     Stack,
     MatchArray,
+    NumberCompare,
     Pop,
     Push,
     Ref,
-    StringBufferPush,
-    StringBufferToString,
+    Store,
+    StringConcat,
+    StringFormat,
+    Switch,
+    TailCall,
+    UnaryOp,
 )
 from parse import statements
+from pipeline import CODE, TREE, Pipeline, PipelineReport, register
+from peephole import optimize
+from ssa.build import build as build_ssa
+from ssa.lower import lower_closure
+from ssa.passes import optimize as optimize_ssa
+from ssa.registers import lower_closure as lower_register_closure
+from superinstr import fuse
 from tree import (
+    Arm,
     ArrayExpr,
-    ArrayPattern,
+    AssignStatement,
     BinaryExpr,
     BlockExpr,
+    BreakStatement,
     CallExpr,
     ComparisonExpr,
+    ConstExpr,
+    ContinueStatement,
     Expr,
     ExprStatement,
     FloatExpr,
     FnExpr,
     FnStatement,
-    GatherPattern,
+    HashCons,
     IdExpr,
     IdPattern,
     IndexExpr,
     IntExpr,
     LetStatement,
     LoopExpr,
+    LoopStatement,
     MatchExpr,
+    MatchStatement,
     ParenExpr,
     Pattern,
+    ScopedTransformer,
     Spread,
     Statement,
     StringExpr,
     SyntaxNode,
     TagExpr,
+    Transformer,
     UnaryExpr,
+    children,
+    free,
+    walk,
 )
 from value import *
 
@@ -68,8 +108,23 @@ class Frame:
 
     def pop_scope(self) -> int:
         popped = self._locals.pop()
+        size = self._curr_frame_size.pop()
+        self._curr_frame_size[-1] = size
         return popped
 
+    def size(self) -> int:
+        """Current stack depth"""
+        return self._curr_frame_size[-1]
+
+    def resize(self, size: int):
+        """Set the stack depth, at a jump target"""
+        self._curr_frame_size[-1] = size
+        self._max_frame_size = max(size, self._max_frame_size)
+
+    def scope(self) -> dict[str, Ref]:
+        """Names bound in the innermost scope"""
+        return self._locals[-1]
+
     def __getitem__(self, key) -> Ref:
         for scope in reversed(self._locals):
             if key in scope:
@@ -80,6 +135,12 @@ class Frame:
             return Cap(self._captures[key])
         raise KeyError(f"Undefined reference to {key}")
 
+    def get(self, key) -> Optional[Ref]:
+        try:
+            return self[key]
+        except KeyError:
+            return None
+
     def loc(self, key, ref):
         self._locals[-1][key] = ref
 
@@ -106,11 +167,42 @@ class Frame:
             return Stack(self._curr_frame_size[-1] - 1)
 
 
+@dataclass
+class Loop:
+    """A loop being compiled, which `break` and `continue` jump out of"""
+
+    label: Optional[str]
+    # Where `continue` jumps, the first instruction of the body
+    head: int
+    # Stack depth at the head, which `break` and `continue` pop down to
+    depth: int
+    # The slot `break` stores the value of the loop in
+    result: Stack
+    # Indices of the jumps to the exit, whose destinations are filled in once the loop is compiled
+    breaks: list[int] = field(default_factory=list)
+
+
 @dataclass
 class Compiler:
     frame: Frame = field(default_factory=Frame)
     code: list[SyntaxNode] = field(default_factory=list)
 
+    # When set, structurally identical function expressions with the same captures share one `ClosureSpec`
+    hashcons: Optional[HashCons] = None
+    specs: dict[tuple, ClosureSpec] = field(default_factory=dict)
+
+    # Pop dead values at statement boundaries instead of keeping every statement result on the stack
+    reuse_slots: bool = False
+
+    # Compile functions without captures to one shared constant closure instead of allocating one each time
+    hoist_closures: bool = False
+
+    # Code of function bodies compiled ahead of time by `precompile`, by the id of their `FnStatement` or `FnExpr`
+    precompiled: dict[int, list[Instr]] = field(default_factory=dict)
+
+    # The loops around the code being compiled, innermost last
+    loops: list[Loop] = field(default_factory=list)
+
     def push_code(self, instr: Instr) -> Optional[Ref]:
         """Push the instruction into the code object
 
@@ -139,26 +231,36 @@ class Compiler:
             case ClosureNew(spec):
                 ref = self.frame.push()
 
-            case Call():
+            case Call() | TailCall():
                 for _ in range(instr.n_args):
                     self.frame.pop()
                 ref = self.frame.push()
 
-            case LocalJump():
-                self.frame.pop()
-
-            case Pop():
-                self.frame.pop()
-
-            case StringBufferPush():
+            case LocalJump() | Jump() | Switch() | MatchArray() | Fail():
                 pass
 
-            case StringBufferToString():
+            case Index() | ArraySlice():
                 ref = self.frame.push()
 
-            case Assert():
+            case Pop(n):
+                for _ in range(n):
+                    self.frame.pop()
+
+            case Assert() | Store() | CaptureSet():
                 pass
 
+            case (
+                BinaryOp()
+                | IntBinaryOp()
+                | FloatBinaryOp()
+                | StringConcat()
+                | UnaryOp()
+                | Compare()
+                | NumberCompare()
+                | StringFormat()
+            ):
+                ref = self.frame.push()
+
             case _:
                 raise NotImplementedError(f"`Compiler.push({type(instr).__name__})`")
 
@@ -184,24 +286,19 @@ class Compiler:
                 if pattern.inner is not None:
                     self.compile_pattern(pattern.inner)
                 self.frame.loc(pattern.name.str(), ref)
-                return self.push_code(Push(Ref.Imm(Bool(True))))
-
-            case ArrayPattern():
-                lower_bound = sum(
-                    1 for x in pattern.items if not isinstance(x, GatherPattern)
-                )
-                return self.push_code(MatchArray(lower_bound))
+                return self.push_code(Push(Ref.Imm(TRUE)))
 
             case _:
                 raise NotImplementedError(
                     f"`Compiler.compile_pattern({type(pattern).__name__})`"
                 )
 
-    def compile_statement(self, statement: Statement) -> Optional[Stack]:
+    def compile_statement(self, statement: Statement, tail: bool = False) -> Optional[Stack]:
         """Compile the statement
 
         Args:
             statement (Statement): The statement to compile
+            tail (bool): Whether the value of the statement is returned from the enclosing function
 
         Raises:
             NotImplementedError: The statement type is not implemented
@@ -212,46 +309,316 @@ class Compiler:
         # print(f"`Compiler.compile_statement({type(statement)})`")
         match statement:
             case ExprStatement():
-                return self.compile_expr(statement.inner)
+                return self.compile_expr(statement.inner, tail)
 
-            case LetStatement():
+            case LetStatement(pattern=IdPattern(inner=None)):
                 self.compile_expr(statement.inner)
                 ix = self.compile_pattern(statement.pattern)
-                instr = Assert(ix, f"Irrefutable pattern: {statement.pattern}")
+                instr = Assert(ix, f"Irrefutable pattern: {statement.pattern.short()}")
                 return self.push_code(instr)
 
+            case LetStatement():
+                # Refutable patterns go through a decision tree with a single leaf
+                subject = self.compile_expr(statement.inner)
+                names = list(dict.fromkeys(statement.pattern.bound()))
+                base = self.frame.size()
+                tree = decision.compile_patterns([statement.pattern])
+                reason = f"Irrefutable pattern: {statement.pattern.short()}"
+                jumps = self.compile_decision(tree, subject, [names], reason)
+                for j in jumps[0]:
+                    self.code[j].dest = len(self.code)
+                self.frame.resize(base)
+                for name in names:
+                    self.frame.loc(name, self.frame.push())
+
+            case MatchStatement():
+                return self.compile_expr(statement.match_expr, tail)
+
+            case LoopStatement():
+                return self.compile_expr(statement.loop_expr)
+
+            case AssignStatement(pattern=IdPattern(inner=None)):
+                depth = self.frame.size()
+                value = self.compile_expr(statement.inner)
+                self.push_code(Store(self.frame[statement.pattern.name.str()], value))
+                self.push_code(Pop(self.frame.size() - depth))
+
+            case BreakStatement():
+                loop = self.loop(statement.label, "break")
+                if statement.inner is not None:
+                    self.push_code(Store(loop.result, self.compile_expr(statement.inner)))
+                loop.breaks.append(self.leave(loop, -1))
+
+            case ContinueStatement():
+                loop = self.loop(statement.label, "continue")
+                self.leave(loop, loop.head)
+
             case FnStatement():
-                pass
+                self.compile_fn_statement(statement, {})
 
             case _:
                 raise NotImplementedError(
                     f"`Compiler.compile_statement({type(statement)})`"
                 )
 
-    def compile_statements(self, statements: list[Statement]) -> Optional[Stack]:
+    def compile_statements(
+        self, statements: list[Statement], tail: bool = False
+    ) -> Optional[Stack]:
         """Compile a series of statements
 
         Args:
             statements (list[Statement]): The statements to compile
+            tail (bool): Whether the value of the final statement is returned from the enclosing function
 
         Returns:
             Optional[Loc]: The location of the value created by the final statement, if any
         """
+        base = self.frame.size()
         self.frame.push_scope()
-        result = None
+
+        # Function statements are in scope for the whole block; their slots hold a placeholder until they are defined
         for statement in statements:
-            result = self.compile_statement(statement)
+            for name in statement.early_bound():
+                self.frame.loc(name, self.push_code(Push(Ref.Imm(UNIT))))
+        functions = {}
+
+        result = None
+        for i, statement in enumerate(statements):
+            last = i == len(statements) - 1
+            if isinstance(statement, FnStatement):
+                result = self.compile_fn_statement(statement, functions)
+            else:
+                result = self.compile_statement(statement, tail and last)
+            if self.reuse_slots and not last:
+                # Only values bound to names used later in the block stay live
+                rest = statements[i + 1 :]
+                live = set(free(rest))
+                live.update(name for later in rest for name in later.early_bound())
+                live.update(assigned(rest))
+                scope = self.frame.scope()
+                self.reclaim(base, [name for name in scope if name in live])
         if result is None:
-            instr = Push(Ref.Imm(Unit()))
+            instr = Push(Ref.Imm(UNIT))
             result = self.push_code(instr)
+        if self.reuse_slots:
+            result = self.reclaim(base, [], result)
         self.frame.pop_scope()
         return result
 
-    def compile_expr(self, expr: Expr) -> Stack:
+    def compile_fn_statement(
+        self, statement: FnStatement, functions: dict[str, list[str]]
+    ) -> None:
+        """Define a function in the slot reserved for it by `compile_statements`
+
+        Functions capture each other by value, so a function that refers to itself, or to a function defined after it in the same block, captured the placeholder. Those captures are overwritten once the function exists.
+
+        Args:
+            statement (FnStatement): The function statement to compile
+            functions (dict[str, list[str]]): The names captured by each function already defined in the block
+        """
+        name = statement.name.str()
+        captured = fn_captures(statement)
+
+        if (code := self.precompiled.get(id(statement))) is None:
+            compiler = self.function_compiler(statement.params, captured)
+            compiler.compile_body(statement.body)
+            code = compiler.code
+        spec = ClosureSpec(code, len(statement.params), [self.frame[k] for k in captured])
+        if self.hoist_closures and not captured:
+            self.push_code(Store(self.frame[name], Ref.Imm(Closure(spec, []))))
+        else:
+            closure = self.push_code(ClosureNew(spec))
+            self.push_code(Store(self.frame[name], closure))
+            self.push_code(Pop(1))
+
+        functions[name] = captured
+        for other, names in functions.items():
+            if name in names:
+                instr = CaptureSet(self.frame[other], names.index(name), self.frame[name])
+                self.push_code(instr)
+
+    def new_closure(self, spec: ClosureSpec) -> Stack:
+        """Push a closure of `spec`, capturing from the current frame"""
+        if self.hoist_closures and not spec.capture_indices:
+            return self.push_code(Push(Ref.Imm(Closure(spec, []))))
+        return self.push_code(ClosureNew(spec))
+
+    def function_compiler(self, params: list[Pattern], captured: list[str]) -> "Compiler":
+        """Create the compiler for the body of a function, with `captured` as its captures"""
+        scope = Frame()
+        for k in captured:
+            scope.cap(k)
+        for pat in params:
+            for var in pat.bound():
+                scope.arg(var)
+        return Compiler(
+            scope,
+            hashcons=self.hashcons,
+            specs=self.specs,
+            reuse_slots=self.reuse_slots,
+            hoist_closures=self.hoist_closures,
+        )
+
+    def compile_body(self, body: Expr | list[Statement]):
+        """Compile the body of a function, in the compiler made for it by `function_compiler`"""
+        # Arguments and captures live outside the stack, so those the body assigns to are copied to slots first
+        for name in sorted(assigned(body)):
+            if isinstance(ref := self.frame.get(name), (Arg, Cap)):
+                self.frame.loc(name, self.push_code(Push(ref)))
+        if isinstance(body, list):
+            self.compile_statements(body, tail=True)
+        else:
+            self.compile_expr(body, tail=True)
+
+    def loop(self, label: Optional[Span], keyword: str) -> Loop:
+        """The loop a `break` or `continue` with this label leaves
+
+        Raises:
+            CompileError: There is no such loop in the function being compiled
+        """
+        for loop in reversed(self.loops):
+            if label is None or loop.label == label.str():
+                return loop
+        if label is None:
+            raise CompileError(f"`{keyword}` outside of a loop")
+        raise CompileError(f"`{keyword}` to undefined loop label {label.str()}")
+
+    def leave(self, loop: Loop, dest: int) -> int:
+        """Pop the stack down to the depth at the head of `loop` and jump to `dest`
+
+        Returns:
+            int: The index of the jump
+        """
+        depth = self.frame.size()
+        if n := depth - loop.depth:
+            self.push_code(Pop(n))
+        jump = len(self.code)
+        self.push_code(Jump(dest))
+        # Whatever follows is unreachable, and is compiled at the depth it would otherwise have
+        self.frame.resize(depth)
+        return jump
+
+    def reclaim(self, base: int, names: list[str], result: Optional[Stack] = None):
+        """Free every slot above `base` except those holding `names` and `result`
+
+        Live values are moved down into the lowest slots, then the rest are popped, so the stack holds nothing but live values.
+
+        Returns:
+            Optional[Stack]: The new location of `result`
+        """
+        scope = self.frame.scope()
+        keep = {scope[name].index for name in names}
+        if result is not None:
+            keep.add(result.index)
+
+        moved = {}
+        target = base
+        for index in sorted(keep):
+            if index != target:
+                self.push_code(Store(Stack(target), Stack(index)))
+            moved[index] = Stack(target)
+            target += 1
+        for name in names:
+            scope[name] = moved[scope[name].index]
+        for name in [name for name in scope if name not in names]:
+            del scope[name]
+
+        if n := self.frame.size() - target:
+            self.push_code(Pop(n))
+        if result is not None:
+            return moved[result.index]
+
+    def place(self, ref: Stack, index: int) -> Stack:
+        """Make slot `index` the top of the stack, holding the value of `ref`
+
+        Expressions can leave temporaries below their value, such as the closure under the result of a call. Values consumed from the top of the stack are moved down over them first.
+        """
+        if ref.index != index:
+            self.push_code(Store(Stack(index), ref))
+        if n := self.frame.size() - index - 1:
+            self.push_code(Pop(n))
+        return Stack(index)
+
+    def compile_decision(
+        self, tree: decision.Tree, subject: Stack, names: list[list[str]], reason: str
+    ) -> dict[int, list[int]]:
+        """Compile a decision tree over the value in `subject`
+
+        Each leaf leaves the values bound by its pattern in the slots starting at the current stack depth, in the order of `names[leaf.arm]`, then jumps to the pattern's code.
+
+        Args:
+            tree (decision.Tree): The decision tree to compile
+            subject (Stack): The location of the value being matched
+            names (list[list[str]]): The names bound by each pattern
+            reason (str): The error raised when no pattern matches
+
+        Returns:
+            dict[int, list[int]]: The indices of the jumps to the code of each pattern, whose destinations are left for the caller to fill in
+        """
+        base = self.frame.size()
+        jumps = defaultdict(list)
+
+        def load(occurrence: decision.Occurrence, loaded: dict) -> Stack:
+            if (ref := loaded.get(occurrence)) is not None:
+                return ref
+            parent = load(occurrence.parent, loaded)
+            if occurrence.gather is not None:
+                instr = ArraySlice(parent, *occurrence.gather)
+            else:
+                instr = Index(parent, Ref.Imm(Int(occurrence.index)))
+            loaded[occurrence] = ref = self.push_code(instr)
+            return ref
+
+        def emit(tree: decision.Tree, loaded: dict):
+            match tree:
+                case decision.Leaf(arm, bindings):
+                    refs = [load(bindings[name], loaded) for name in names[arm]]
+                    depth = self.frame.size()
+                    if refs != [Stack(base + i) for i in range(len(refs))]:
+                        # Copy the bound values, then move them down to the slots the code of the pattern expects
+                        for ref in refs:
+                            self.push_code(Push(ref))
+                        for i in range(len(refs)):
+                            if depth != base:
+                                self.push_code(Store(Stack(base + i), Stack(depth + i)))
+                        depth += len(refs)
+                    if depth != base + len(refs):
+                        self.push_code(Pop(depth - base - len(refs)))
+                    jumps[arm].append(len(self.code))
+                    self.push_code(Jump(-1))
+
+                case decision.Failure():
+                    self.push_code(Fail(reason))
+
+                case decision.Branch(occurrence, cases, default):
+                    instr = Switch(load(occurrence, loaded), {}, -1)
+                    self.push_code(instr)
+                    depth = self.frame.size()
+                    for key, case in cases.items():
+                        instr.cases[key] = len(self.code)
+                        emit(case, dict(loaded))
+                        self.frame.resize(depth)
+                    instr.default = len(self.code)
+                    emit(default, loaded)
+
+                case decision.LengthCheck(occurrence, length, then, otherwise):
+                    instr = MatchArray(load(occurrence, loaded), length, -1)
+                    self.push_code(instr)
+                    depth = self.frame.size()
+                    emit(then, dict(loaded))
+                    self.frame.resize(depth)
+                    instr.dest = len(self.code)
+                    emit(otherwise, loaded)
+
+        emit(tree, {decision.Occurrence(): subject})
+        return jumps
+
+    def compile_expr(self, expr: Expr, tail: bool = False) -> Stack:
         """Compile the expression
 
         Args:
             expr (Expr): The expression to compile
+            tail (bool): Whether the value of the expression is returned from the enclosing function, so that a call can reuse its frame
 
         Raises:
             CompileError: Spread expression appears outside of an array literal
@@ -283,36 +650,24 @@ class Compiler:
                 instr = Push(Ref.Imm(value))
                 return self.push_code(instr)
 
+            case ConstExpr():
+                instr = Push(Ref.Imm(expr.value))
+                return self.push_code(instr)
+
             case StringExpr():
 
                 # leading f
                 if expr.fn is not None:
                     fn_ix = self.compile_expr(expr.fn)
 
-                # in the special case that there is only one char and no interpolants, simply create the value in-place
-                value = String(expr.chars[0].str())
-                instr = Push(Ref.Imm(value))
-                ix = self.push_code(instr)
-
-                # For the rest of the interpolants and the chars following them:
                 if len(expr.interpolants):
-                    instr = Push(Ref.Imm(StringBuffer([ix])))
-                    buf_ix = self.push_code(instr)
-
-                    for interpolant, char in zip(expr.interpolants, expr.chars[1:]):
-                        # Compile interpolant
-                        interp_ix = self.compile_expr(interpolant)
-                        instr = StringBufferPush(buf_ix, interp_ix)
-                        self.push_code(instr)
-
-                        # Compile char
-                        instr = Push(Ref.Imm(String(char.str())))
-                        piece_ix = self.push_code(instr)
-                        instr = StringBufferPush(buf_ix, piece_ix)
-                        self.push_code(instr)
-
-                    instr = StringBufferToString(buf_ix)
-                    ix = self.push_code(instr)
+                    # The literal pieces become the template, and the interpolants are rendered in between in one go
+                    operands = [self.compile_expr(interpolant) for interpolant in expr.interpolants]
+                    template = [char.str() for char in expr.chars]
+                    ix = self.push_code(StringFormat(template, operands))
+                else:
+                    # Without interpolants, simply create the value in-place
+                    ix = self.push_code(Push(Ref.Imm(String(expr.chars[0].str()))))
 
                 # apply fn
                 if expr.fn is not None:
@@ -329,76 +684,135 @@ class Compiler:
                     match item:
                         case Spread():
                             ref = self.compile_expr(item.inner)
-                            instr = ArrayExtend(array_loc, ref)
+                            self.push_code(ArrayExtend(array_loc, ref))
+                            self.place(array_loc, array_loc.index)
 
                         case _:
-                            ref = self.compile_expr(item)
-                            instr = ArrayPush(array_loc, ref)
-                    self.push_code(instr)
+                            ref = self.place(self.compile_expr(item), array_loc.index + 1)
+                            self.push_code(ArrayPush(array_loc, ref))
                 return array_loc
 
             case Spread():
                 raise CompileError("Spread expression outside of array literal")
 
             case ParenExpr():
-                return self.compile_expr(expr.inner)
+                return self.compile_expr(expr.inner, tail)
 
             case FnExpr():
                 # Compute free variables
-                free = set(expr.free())
+                free = sorted(set(expr.free()))
 
                 # Collect indices of captured variables
                 captures = {}
                 for k in free:
                     captures[k] = self.frame[k]
 
-                # Create new scope for function and allocate space for captured variables
-                scope = Frame()
-                for k in free:
-                    scope.cap(k)
-
-                # Allocate space for function arguments
-                for pat in expr.params:
-                    for var in pat.bound():
-                        scope.arg(var)
-
-                # Compile the function
-                new_compiler = Compiler(scope)
-                result_ix = new_compiler.compile_expr(expr.inner)
-                spec = ClosureSpec(
-                    new_compiler.code, len(expr.params), list(captures.values())
-                )
+                # Reuse the spec of a structurally identical function
+                if self.hashcons is not None:
+                    key = (id(self.hashcons.intern(expr)), tuple(captures.values()))
+                    if (spec := self.specs.get(key)) is not None:
+                        return self.new_closure(spec)
+
+                # Compile the function, unless its body was compiled ahead of time
+                if (code := self.precompiled.get(id(expr))) is None:
+                    new_compiler = self.function_compiler(expr.params, free)
+                    new_compiler.compile_body(expr.inner)
+                    code = new_compiler.code
+                spec = ClosureSpec(code, len(expr.params), list(captures.values()))
+                if self.hashcons is not None:
+                    self.specs[key] = spec
 
-                return self.push_code(ClosureNew(spec))
+                return self.new_closure(spec)
 
             case BlockExpr():
-                return self.compile_statements(expr.statements)
+                return self.compile_statements(expr.statements, tail)
 
             case MatchExpr():
-                raise NotImplementedError
+                subject = self.compile_expr(expr.subject)
+                result = self.push_code(Push(Ref.Imm(UNIT)))
+                base = self.frame.size()
+
+                patterns = [arm.pattern for arm in expr.arms]
+                names = [list(dict.fromkeys(pattern.bound())) for pattern in patterns]
+                tree = decision.compile_patterns(patterns)
+                jumps = self.compile_decision(tree, subject, names, "No match arm matched")
+
+                # Arms the tree never chooses are left out
+                exits = []
+                for i, arm in enumerate(expr.arms):
+                    if i not in jumps:
+                        continue
+                    for j in jumps[i]:
+                        self.code[j].dest = len(self.code)
+                    self.frame.resize(base)
+                    self.frame.push_scope()
+                    for name in names[i]:
+                        self.frame.loc(name, self.frame.push())
+                    value = self.compile_expr(arm.expr, tail)
+                    self.push_code(Store(result, value))
+                    self.push_code(Pop(self.frame.size() - base))
+                    self.frame.pop_scope()
+                    exits.append(len(self.code))
+                    self.push_code(Jump(-1))
+
+                for j in exits:
+                    self.code[j].dest = len(self.code)
+                self.frame.resize(base)
+                return result
 
             case LoopExpr():
-                raise NotImplementedError
+                # The value of the loop is whatever `break` stores in its slot
+                result = self.push_code(Push(Ref.Imm(UNIT)))
+                label = expr.label.str() if expr.label is not None else None
+                loop = Loop(label, len(self.code), self.frame.size(), result)
+                self.loops.append(loop)
+                self.compile_statements(expr.statements)
+                self.leave(loop, loop.head)
+                self.loops.pop()
+                for j in loop.breaks:
+                    self.code[j].dest = len(self.code)
+                self.frame.resize(loop.depth)
+                return result
 
             case CallExpr():
                 # Calling convention:
                 #   x y z -> return value
                 fn_ix = self.compile_expr(expr.fn)
                 for arg in expr.args:
-                    self.compile_expr(arg)
+                    # Arguments must be the topmost slots, without temporaries between them
+                    index = self.frame.size()
+                    self.place(self.compile_expr(arg), index)
+                if tail:
+                    return self.push_code(TailCall(fn_ix, len(expr.args)))
                 return self.push_code(Call(fn_ix, len(expr.args)))
 
             case IndexExpr():
                 raise NotImplementedError
 
             case BinaryExpr():
-                raise NotImplementedError
+                op = expr.op.str()
+                if op not in ops.BINARY:
+                    raise NotImplementedError(f"`Compiler.compile_expr(BinaryExpr {op})`")
+                left = self.compile_expr(expr.left)
+                right = self.compile_expr(expr.right)
+                return self.push_code(binary_instr(op, left, right, expr.operand_types))
 
             case UnaryExpr():
-                raise NotImplementedError
+                op = expr.op.str()
+                if op not in ops.UNARY:
+                    raise NotImplementedError(f"`Compiler.compile_expr(UnaryExpr {op})`")
+                inner = self.compile_expr(expr.inner)
+                return self.push_code(UnaryOp(op, inner))
 
             case ComparisonExpr():
-                raise NotImplementedError
+                names = [op.str() for op in expr.ops]
+                for op in names:
+                    if op not in ops.COMPARE:
+                        raise NotImplementedError(
+                            f"`Compiler.compile_expr(ComparisonExpr {op})`"
+                        )
+                operands = [self.compile_expr(inner) for inner in expr.inner]
+                return self.push_code(compare_instr(names, operands, expr.operand_types))
 
             case _:
                 raise NotImplementedError(f"`Compiler.compile_expr({type(expr)})`")
@@ -415,16 +829,831 @@ class Compiler:
         return closure
 
 
-def compile(input: Expr | list[Statement] | str):
-    compiler = Compiler()
-    if isinstance(input, str):
-        res = statements(input)
-        compiler.compile_statements(res.val)
-    elif isinstance(input, Expr):
-        compiler.compile_expr(input)
-    elif isinstance(input, list):
-        compiler.compile_statements(input)
+def binary_instr(op: str, left: Ref, right: Ref, types: Optional[tuple[type, ...]]) -> Instr:
+    """The instruction for a binary operator, specialized to the operand types proven by `infer.specialize` if it can be"""
+    if types == (Int, Int) and op in ops.INT_BINARY:
+        return IntBinaryOp(op, left, right)
+    if types is not None and Float in types and set(types) <= {Int, Float} and op in ops.FLOAT_BINARY:
+        return FloatBinaryOp(op, left, right)
+    if types == (String, String) and op == "+":
+        return StringConcat(left, right)
+    return BinaryOp(op, left, right)
+
+
+def compare_instr(names: list[str], operands: list[Ref], types: Optional[tuple[type, ...]]) -> Instr:
+    """The instruction for a comparison, specialized to the operand types proven by `infer.specialize` if it can be
+
+    Equality of `Int` and `Float` values, and of two `Float`s, is left to `Compare`, which compares them as values rather than as numbers.
+    """
+    if types is not None and len(names) == 1 and set(types) <= {Int, Float} and names[0] in ops.NUMBER_COMPARE:
+        if names[0] not in ("==", "!=") or types == (Int, Int):
+            return NumberCompare(names[0], *operands)
+    return Compare(names, operands)
+
+
+def constant(expr: Expr) -> Optional[Value]:
+    """The value of an expression, if it is a literal or an already folded constant"""
+    match expr:
+        case ConstExpr():
+            return expr.value
+        case IntExpr():
+            return Int(int(expr.span.str()))
+        case FloatExpr():
+            return Float(float(expr.span.str()))
+        case TagExpr():
+            return Tag(expr.span.str())
+        case StringExpr(fn=None, interpolants=[]):
+            return String(expr.chars[0].str())
+        case ParenExpr():
+            return constant(expr.inner)
+    return None
+
+
+# Largest integer, in bits, that folding `**` or `<<` may produce; larger ones are left to compute at runtime
+MAX_FOLDED_BITS = 4096
+
+
+def too_large(op: str, left: Value, right: Value) -> bool:
+    """Would an integer operator produce a value too large to fold, or take too long to compute it?"""
+    match op, left, right:
+        case "**", Int(a), Int(b) if b > 0:
+            return max(abs(a).bit_length() - 1, 0) * b > MAX_FOLDED_BITS
+        case "<<", Int(a), Int(b) if a != 0:
+            return b > MAX_FOLDED_BITS
+    return False
+
+
+class ConstantFolder(ScopedTransformer):
+    """Evaluate pure operators on constants at compile time and propagate `let`-bound constants into their uses"""
+
+    # `env` holds the constants bound by `let` in the enclosing scopes
+
+    def fold(self, expr: Expr, f, *args) -> Expr:
+        try:
+            return ConstExpr(expr.span, f(*args))
+        except VmError:
+            # Leave the error to be raised at runtime
+            return expr
+
+    def visit_IdExpr(self, expr):
+        if (value := self.env.get(expr.span.str())) is not None:
+            return ConstExpr(expr.span, value)
+        return expr
+
+    def visit_ParenExpr(self, expr):
+        expr = self.generic_visit(expr)
+        if constant(expr.inner) is not None:
+            return expr.inner
+        return expr
+
+    def visit_BinaryExpr(self, expr):
+        expr = self.generic_visit(expr)
+        left, right = constant(expr.left), constant(expr.right)
+        if left is None or right is None or too_large(expr.op.str(), left, right):
+            return expr
+        return self.fold(expr, ops.binary, expr.op.str(), left, right)
+
+    def visit_UnaryExpr(self, expr):
+        expr = self.generic_visit(expr)
+        if (inner := constant(expr.inner)) is None:
+            return expr
+        return self.fold(expr, ops.unary, expr.op.str(), inner)
+
+    def visit_ComparisonExpr(self, expr):
+        expr = self.generic_visit(expr)
+        operands = [constant(inner) for inner in expr.inner]
+        if any(operand is None for operand in operands):
+            return expr
+        return self.fold(expr, ops.compare, [op.str() for op in expr.ops], operands)
+
+    def visit_StringExpr(self, expr):
+        expr = self.generic_visit(expr)
+
+        # Splice constant interpolants into the surrounding pieces
+        chars = [expr.chars[0].str()]
+        interpolants = []
+        for interpolant, char in zip(expr.interpolants, expr.chars[1:]):
+            try:
+                value = constant(interpolant)
+                text = None if value is None else ops.to_string(value)
+            except VmError:
+                text = None
+            if text is None:
+                interpolants.append(interpolant)
+                chars.append(char.str())
+            else:
+                chars[-1] += text + char.str()
+
+        if expr.fn is None and not interpolants:
+            return ConstExpr(expr.span, String(chars[0]))
+        if len(interpolants) == len(expr.interpolants):
+            return expr
+        return replace(
+            expr, chars=[Span(char) for char in chars], interpolants=interpolants
+        )
+
+    def visit_statements(self, statements: list[Statement]) -> list[Statement]:
+        """Fold a block, dropping `let`s whose constant value was propagated into every use"""
+        saved = dict(self.env)
+
+        # Reassigned names are not constant, and names used by hoisted functions must stay bound
+        assigned = set()
+        hoisted = set()
+        for statement in statements:
+            for node in walk(statement):
+                if isinstance(node, AssignStatement):
+                    assigned.update(node.pattern.bound())
+            if isinstance(statement, FnStatement):
+                hoisted.update(statement.free())
+            self.shadow(statement.early_bound())
+
+        out = []
+        for i, statement in enumerate(statements):
+            statement = self.visit(statement)
+            if isinstance(statement, LetStatement):
+                pattern = statement.pattern
+                self.shadow(pattern.bound())
+                value = constant(statement.inner)
+                if (
+                    value is not None
+                    and isinstance(pattern, IdPattern)
+                    and pattern.inner is None
+                    and (name := pattern.name.str()) not in assigned
+                ):
+                    self.env[name] = value
+                    if name not in hoisted and i != len(statements) - 1:
+                        continue
+            out.append(statement)
+
+        self.env = saved
+        return out
+
+
+def fold_constants(input: Expr | list[Statement]) -> Expr | list[Statement]:
+    """Constant-fold an expression or a list of statements"""
+    folder = ConstantFolder()
+    if isinstance(input, list):
+        return folder.visit_statements(input)
+    return folder.visit(input)
+
+
+# Largest body, in syntax nodes, of a function inlined at more than one call site
+INLINE_BUDGET = 40
+
+
+class Renamer(ScopedTransformer):
+    """Rename the free occurrences of the names in `env` to the names they map to"""
+
+    def __init__(self, names: dict[str, str]):
+        super().__init__()
+        self.env = dict(names)
+
+    def visit_IdExpr(self, expr):
+        if (name := self.env.get(expr.span.str())) is not None:
+            return IdExpr(Span(name))
+        return expr
+
+    def visit_AssignStatement(self, statement):
+        statement = self.generic_visit(statement)
+        match statement.pattern:
+            case IdPattern(inner=None) if (name := self.env.get(statement.pattern.name.str())) is not None:
+                return replace(statement, pattern=IdPattern(Span(name), Span(name)))
+        return statement
+
+
+class Inliner(ScopedTransformer):
+    """Substitute the bodies of functions at their call sites
+
+    Immediately invoked function expressions are always inlined. Functions bound by `let` are inlined if their name is only ever called, and their body is within the budget or they are called once. The arguments are bound by `let` to fresh names that the body is renamed to use, so they are evaluated once, in order, and cannot be captured by the body.
+
+    Closures capture by value, so a function is not inlined if one of its free variables is assigned, by the function or around it: the inlined body would see or make the assignment. Nor is it inlined if one of them is undefined where the function is, which is an error inlining would hide.
+    """
+
+    def __init__(self, budget: int = INLINE_BUDGET):
+        super().__init__()
+        self.budget = budget
+        # `env` maps the names of inlinable functions to the function and its free variables
+        self.fresh = 0
+        # Names in scope
+        self.defined: set[str] = set()
+
+    def scoped(self, node: SyntaxNode, names) -> SyntaxNode:
+        defined = self.defined
+        self.defined = defined | set(names)
+        node = super().scoped(node, names)
+        self.defined = defined
+        return node
+
+    def visit_FnStatement(self, statement):
+        defined = self.defined
+        self.defined = defined | {statement.name.str()} | {name for pat in statement.params for name in pat.bound()}
+        statement = super().visit_FnStatement(statement)
+        self.defined = defined
+        return statement
+
+    def shadow(self, names):
+        # A function can no longer be inlined where one of its free variables means something else
+        names = set(names)
+        for name, (_, free) in list(self.env.items()):
+            if name in names or not names.isdisjoint(free):
+                del self.env[name]
+
+    def callee(self, expr: Expr) -> Optional[FnExpr]:
+        while isinstance(expr, ParenExpr):
+            expr = expr.inner
+        if isinstance(expr, IdExpr) and (entry := self.env.get(expr.span.str())):
+            return entry[0]
+        if isinstance(expr, FnExpr):
+            return expr
+
+    def visit_CallExpr(self, expr):
+        expr = self.generic_visit(expr)
+        fn = self.callee(expr.fn)
+        if fn is None or not inlinable(fn) or len(fn.params) != len(expr.args):
+            return expr
+        # An immediately invoked function, whose `let` was not checked by `visit_statements`
+        inner = expr.fn
+        while isinstance(inner, ParenExpr):
+            inner = inner.inner
+        if inner is fn and not self.captures_safely(fn, expr.args):
+            return expr
+        if any(isinstance(arg, Spread) for arg in expr.args):
+            return expr
+
+        statements = []
+        names = {}
+        for param, arg in zip(fn.params, expr.args):
+            name = f"{param.name.str()}%{self.fresh}"
+            self.fresh += 1
+            names[param.name.str()] = name
+            pattern = IdPattern(Span(name), Span(name))
+            statements.append(
+                LetStatement(arg.span, None, Span("let"), pattern, Span("="), arg)
+            )
+        body = Renamer(names).visit(fn.inner)
+        statements.append(ExprStatement(body.span, None, body))
+        return BlockExpr(expr.span, Span("{"), statements, Span("}"))
+
+    def captures_safely(self, fn: FnExpr, around: list[SyntaxNode]) -> bool:
+        """Are the free variables of `fn` defined, and assigned neither by it nor by the code `around` it?"""
+        captured = set(fn.free())
+        return captured <= self.defined and captured.isdisjoint(assigned(fn.inner) | assigned(around))
+
+    def visit_statements(self, statements: list[Statement]) -> list[Statement]:
+        """Inline in a block, dropping `let`s of functions that were inlined at every use"""
+        saved = dict(self.env)
+        defined = self.defined
+        self.defined = set(defined)
+
+        assigned = set()
+        for statement in statements:
+            for node in walk(statement):
+                if isinstance(node, AssignStatement):
+                    assigned.update(node.pattern.bound())
+            self.shadow(statement.early_bound())
+            self.defined.update(statement.early_bound())
+
+        out = []
+        inlined = {}
+        for i, statement in enumerate(statements):
+            statement = self.visit(statement)
+            self.shadow(statement.bound())
+            match statement:
+                case LetStatement(pattern=IdPattern(inner=None), inner=FnExpr() as fn):
+                    name = statement.pattern.name.str()
+                    rest = statements[i + 1 :]
+                    captured = set(fn.free())
+                    calls = non_escaping_calls(name, rest)
+                    if (
+                        name not in assigned
+                        and name not in captured
+                        and self.captures_safely(fn, statements)
+                        and inlinable(fn)
+                        and calls is not None
+                        and (calls <= 1 or size(fn.inner) <= self.budget)
+                    ):
+                        self.env[name] = (fn, captured)
+                        inlined[len(out)] = name
+            out.append(statement)
+            self.defined.update(statement.bound())
+
+        # Keep the `let`s of functions still referred to, e.g. by calls where a free variable was shadowed
+        used = set()
+        for statement in out:
+            if isinstance(statement, FnStatement):
+                used.update(statement.free())
+        for j, name in inlined.items():
+            if j != len(out) - 1 and name not in used and name not in free(out[j + 1 :]):
+                out[j] = None
+
+        self.env = saved
+        self.defined = defined
+        return [statement for statement in out if statement is not None]
+
+
+def inlinable(fn: FnExpr) -> bool:
+    """Can calls to `fn` be replaced by its body? Its parameters must be plain names, and a `break` or `continue` in it must not end up in a loop around the call"""
+    return all(
+        isinstance(param, IdPattern) and param.inner is None for param in fn.params
+    ) and not any(isinstance(node, (BreakStatement, ContinueStatement)) for node in walk(fn.inner))
+
+
+def non_escaping_calls(name: str, statements: list[Statement]) -> Optional[int]:
+    """The number of calls to `name` in `statements`, or `None` if it is also used other than by calling it"""
+    uses = 0
+    calls = 0
+    for statement in statements:
+        for node in walk(statement):
+            if isinstance(node, IdExpr) and node.span.str() == name:
+                uses += 1
+            elif isinstance(node, CallExpr):
+                fn = node.fn
+                while isinstance(fn, ParenExpr):
+                    fn = fn.inner
+                if isinstance(fn, IdExpr) and fn.span.str() == name:
+                    calls += 1
+    return calls if uses == calls else None
+
+
+def size(node: SyntaxNode) -> int:
+    """Number of syntax nodes in a tree"""
+    return sum(1 for _ in walk(node))
+
+
+class Lifter(ScopedTransformer):
+    """Turn the captures of non-escaping functions into extra arguments
+
+    A function bound by `let` whose name is only ever called never leaves the scope of its captures, so each call can pass the captured values from the frame of the caller instead. The function then needs no closure of its own, and compiles to a shared constant with `Compiler.hoist_closures`.
+    """
+
+    # `env` maps the names of lifted functions to the names of their former captures
+
+    def visit_CallExpr(self, expr):
+        expr = self.generic_visit(expr)
+        fn = expr.fn
+        while isinstance(fn, ParenExpr):
+            fn = fn.inner
+        if isinstance(fn, IdExpr) and (captured := self.env.get(fn.span.str())):
+            extra = [IdExpr(Span(name)) for name in captured]
+            return replace(expr, args=expr.args + extra)
+        return expr
+
+    def visit_statements(self, statements: list[Statement]) -> list[Statement]:
+        saved = dict(self.env)
+        for statement in statements:
+            self.shadow(statement.early_bound())
+
+        out = []
+        for i, statement in enumerate(statements):
+            statement = self.visit(statement)
+            self.shadow(statement.bound())
+            match statement:
+                case LetStatement(pattern=IdPattern(inner=None), inner=FnExpr() as fn):
+                    name = statement.pattern.name.str()
+                    captured = sorted(set(fn.free()))
+                    rest = statements[i + 1 :]
+                    if (
+                        captured
+                        and name not in captured
+                        and non_escaping_calls(name, rest) is not None
+                        and binders(rest).isdisjoint([name, *captured])
+                    ):
+                        params = [IdPattern(Span(k), Span(k)) for k in captured]
+                        fn = replace(fn, params=fn.params + params)
+                        statement = replace(statement, inner=fn)
+                        self.env[name] = captured
+            out.append(statement)
+
+        self.env = saved
+        return out
+
+
+def binders(statements: list[Statement]) -> set[str]:
+    """Every name bound or assigned anywhere in `statements`, in any scope"""
+    names = set()
+    for statement in statements:
+        for node in walk(statement):
+            match node:
+                case LetStatement() | AssignStatement():
+                    names.update(node.pattern.bound())
+                case FnExpr():
+                    for param in node.params:
+                        names.update(param.bound())
+                case Arm():
+                    names.update(node.pattern.bound())
+                case FnStatement():
+                    names.add(node.name.str())
+                    for param in node.params:
+                        names.update(param.bound())
+    return names
+
+
+def assigned(node: SyntaxNode | list[Statement]) -> set[str]:
+    """Every name assigned to anywhere in a tree or a list of statements"""
+    nodes = node if isinstance(node, list) else [node]
+    return {
+        name
+        for root in nodes
+        for inner in walk(root)
+        if isinstance(inner, AssignStatement)
+        for name in inner.pattern.bound()
+    }
+
+
+def lift_functions(input: Expr | list[Statement]) -> Expr | list[Statement]:
+    """Pass the captures of non-escaping functions in an expression or a list of statements as arguments"""
+    lifter = Lifter()
+    if isinstance(input, list):
+        return lifter.visit_statements(input)
+    return lifter.visit(input)
+
+
+def inline_functions(input: Expr | list[Statement]) -> Expr | list[Statement]:
+    """Inline small and immediately invoked functions in an expression or a list of statements"""
+    inliner = Inliner()
+    if isinstance(input, list):
+        return inliner.visit_statements(input)
+    return inliner.visit(input)
+
+
+def pure(expr: Expr) -> bool:
+    """Does an expression only apply operators to literals and names, without calls or allocations?"""
+    match expr:
+        case IntExpr() | FloatExpr() | TagExpr() | ConstExpr() | IdExpr():
+            return True
+        case ParenExpr():
+            return pure(expr.inner)
+        case BinaryExpr():
+            return expr.op.str() in ops.BINARY and pure(expr.left) and pure(expr.right)
+        case UnaryExpr():
+            return expr.op.str() in ops.UNARY and pure(expr.inner)
+        case ComparisonExpr():
+            return all(op.str() in ops.COMPARE for op in expr.ops) and all(pure(inner) for inner in expr.inner)
+        case StringExpr(fn=None):
+            return all(pure(inner) for inner in expr.interpolants)
+    return False
+
+
+def cannot_fail(node: SyntaxNode) -> bool:
+    """Can evaluating a node fail or not finish only because one of its children does?"""
+    match node:
+        case Pattern() | IntExpr() | FloatExpr() | TagExpr() | ConstExpr() | IdExpr() | ParenExpr() | ArrayExpr():
+            return True
+        case BlockExpr() | ExprStatement() | FnExpr() | FnStatement():
+            return True
+        case LetStatement(pattern=IdPattern(inner=None)) | AssignStatement(pattern=IdPattern(inner=None)):
+            return True
+        case StringExpr(fn=None, interpolants=[]):
+            return True
+    return False
+
+
+def invariants(node: SyntaxNode, variant: set[str], hoisted: list[Expr]) -> bool:
+    """Add to `hoisted` the largest pure expressions in a tree that compute something and refer to none of the `variant` names, in the order they are evaluated, up to the first thing that could fail or not finish
+
+    Operators can fail, on values of the wrong type for instance, so an expression is only hoisted if nothing evaluated before it could fail first.
+
+    Returns:
+        bool: Whether evaluating the tree can only fail in the expressions it hoisted, so that what follows it can be searched too
+    """
+    match node:
+        case FnExpr() | FnStatement():
+            # Not evaluated
+            return True
+        case Arm() | LoopExpr():
+            # Evaluated conditionally, or an inner loop that was done first and may not finish
+            return False
+        case BinaryExpr() | UnaryExpr() | ComparisonExpr() | StringExpr(fn=None, interpolants=[_, *_]) if (
+            pure(node) and variant.isdisjoint(node.free())
+        ):
+            hoisted.append(node)
+            return True
+    return all(invariants(child, variant, hoisted) for child in children(node)) and cannot_fail(node)
+
+
+class Substituter(Transformer):
+    """Replace nodes, by identity, with the nodes they map to"""
+
+    def __init__(self, nodes: dict[int, SyntaxNode]):
+        super().__init__()
+        self.nodes = nodes
+
+    def visit(self, node):
+        if (new := self.nodes.get(id(node))) is not None:
+            return new
+        return super().visit(node)
+
+
+class Hoister(Transformer):
+    """Move loop-invariant pure expressions out of loops
+
+    An expression is moved if it only applies operators to names the loop neither binds nor assigns, so it has the same value on every iteration, and it is evaluated before the loop can first be left, so it was always evaluated at least once. Nothing evaluated before it in the loop may fail or not finish, since the expression itself can fail, and must still fail with the same error once it runs before the loop. Each one is bound by `let` to a fresh name in a block around the loop, which the loop reads instead. Inner loops are done first, and their hoisted expressions may move further out.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.fresh = 0
+
+    def visit_LoopStatement(self, statement):
+        statement = self.generic_visit(statement)
+        if isinstance(statement.loop_expr, LoopExpr):
+            return statement
+        return ExprStatement(statement.span, statement.semi_token, statement.loop_expr)
+
+    def visit_LoopExpr(self, expr):
+        expr = self.generic_visit(expr)
+        variant = binders(expr.statements)
+        hoisted = []
+        for statement in expr.statements:
+            if any(isinstance(node, (BreakStatement, ContinueStatement)) for node in walk(statement)):
+                break
+            if not invariants(statement, variant, hoisted):
+                break
+        if not hoisted:
+            return expr
+
+        lets = []
+        names = {}
+        for inner in hoisted:
+            name = f"loop%{self.fresh}"
+            self.fresh += 1
+            names[id(inner)] = IdExpr(Span(name))
+            pattern = IdPattern(Span(name), Span(name))
+            lets.append(LetStatement(inner.span, None, Span("let"), pattern, Span("="), inner))
+        loop = Substituter(names).visit(expr)
+        return BlockExpr(expr.span, Span("{"), [*lets, ExprStatement(loop.span, None, loop)], Span("}"))
+
+
+def hoist_invariants(input: Expr | list[Statement]) -> Expr | list[Statement]:
+    """Move loop-invariant pure expressions out of the loops in an expression or a list of statements"""
+    hoister = Hoister()
+    if isinstance(input, list):
+        return [hoister.visit(statement) for statement in input]
+    return hoister.visit(input)
+
+
+def fn_captures(statement: FnStatement) -> list[str]:
+    """The names a function statement captures, in the order of its captures"""
+    bound = set()
+    for pat in statement.params:
+        bound.update(pat.bound())
+    return sorted(set(free(statement.body)) - bound)
+
+
+def top_level_functions(statements: list[Statement]) -> list[FnStatement | FnExpr]:
+    """The functions a module defines with `fn` statements or binds to a name with `let`"""
+    functions = []
+    for statement in statements:
+        match statement:
+            case FnStatement():
+                functions.append(statement)
+            case LetStatement(pattern=IdPattern(inner=None), inner=FnExpr() as fn):
+                functions.append(fn)
+    return functions
+
+
+def compile_bodies(
+    functions: list[FnStatement | FnExpr], share_specs: bool, reuse_slots: bool, escape: bool
+) -> list[list[Instr]]:
+    """Compile the bodies of functions, in a worker process of `precompile`
+
+    Returns:
+        list[list[Instr]]: The code of each function
+    """
+    compiler = Compiler(
+        hashcons=HashCons() if share_specs else None,
+        reuse_slots=reuse_slots,
+        hoist_closures=escape,
+    )
+    out = []
+    for fn in functions:
+        match fn:
+            case FnStatement():
+                body_compiler = compiler.function_compiler(fn.params, fn_captures(fn))
+                body_compiler.compile_body(fn.body)
+            case FnExpr():
+                body_compiler = compiler.function_compiler(fn.params, sorted(set(fn.free())))
+                body_compiler.compile_body(fn.inner)
+        out.append(body_compiler.code)
+    return out
+
+
+def precompile(
+    statements: list[Statement],
+    jobs: int,
+    share_specs: bool = False,
+    reuse_slots: bool = False,
+    escape: bool = False,
+) -> dict[int, list[Instr]]:
+    """Compile the bodies of the top level functions of a module in a pool of `jobs` processes
+
+    The body of a function only depends on its parameters and the names it captures, never on the code of other functions, so every body compiles independently. Linking them into the module closure is left to `Compiler.compile_statements`, which defines them in source order and patches the captures of forward references as usual.
+    Structurally identical functions only share specs when `share_specs` is set and they are compiled by the same worker.
+
+    Returns:
+        dict[int, list[Instr]]: The code of each function body, by the id of its node, for `Compiler.precompiled`
+    """
+    functions = top_level_functions(statements)
+    if min(jobs, len(functions)) < 2:
+        return {}
+    codes = compile_functions(functions, jobs, share_specs, reuse_slots, escape)
+    return {id(fn): code for fn, code in zip(functions, codes)}
+
+
+def compile_functions(
+    functions: list[FnStatement | FnExpr],
+    jobs: int = 1,
+    share_specs: bool = False,
+    reuse_slots: bool = False,
+    escape: bool = False,
+) -> list[list[Instr]]:
+    """Compile the bodies of functions, in a pool of `jobs` processes if there is more than one
+
+    Returns:
+        list[list[Instr]]: The code of each function
+    """
+    n = min(jobs, len(functions))
+    if n < 2:
+        return compile_bodies(functions, share_specs, reuse_slots, escape)
+    # Round robin, so long runs of big functions are spread over the workers
+    batches = [functions[i::n] for i in range(n)]
+    with ProcessPoolExecutor(n) as pool:
+        results = list(
+            pool.map(compile_bodies, batches, repeat(share_specs), repeat(reuse_slots), repeat(escape))
+        )
+    codes = [None] * len(functions)
+    for i, batch in enumerate(results):
+        codes[i::n] = batch
+    return codes
+
+
+register("inline", TREE, inline_functions, help="Inline small and immediately invoked functions")
+register("lift", TREE, lift_functions, after=("inline",), help="Pass the captures of non-escaping functions as arguments")
+register("fold", TREE, fold_constants, after=("inline", "lift"), help="Fold and propagate constants")
+register(
+    "licm", TREE, hoist_invariants, after=("inline", "lift", "fold"), help="Move loop-invariant expressions out of loops"
+)
+register(
+    "specialize",
+    TREE,
+    infer.specialize,
+    after=("inline", "lift", "fold", "licm"),
+    help="Specialize operators to the operand types inference proves",
+)
+register("peephole", CODE, optimize, help="Forward operands and remove dead pushes and stores")
+register("superinstructions", CODE, fuse, after=("peephole",), help="Fuse common instruction sequences")
+# Last, since the other code passes only know literals as `Imm` refs
+register(
+    "constant_pools", CODE, intern, after=("peephole", "superinstructions"), help="Intern literals per spec"
+)
+
+# Passes of each optimization level
+LEVELS = {
+    0: (),
+    1: ("fold", "specialize", "peephole"),
+    2: ("inline", "lift", "fold", "licm", "specialize", "peephole", "superinstructions", "constant_pools"),
+}
+
+# The pass each pass option of `compile` enables
+PASS_OPTIONS = {
+    "inline": "inline",
+    "escape": "lift",
+    "fold": "fold",
+    "specialize": "specialize",
+    "peephole": "peephole",
+    "superinstructions": "superinstructions",
+    "constant_pools": "constant_pools",
+}
+
+
+def pass_names(level: int = 0, **options: bool) -> list[str]:
+    """The passes of an optimization level, plus those enabled by pass options of `compile`
+
+    Raises:
+        ValueError: The level does not exist
+    """
+    if level not in LEVELS:
+        raise ValueError(f"Unknown optimization level {level}")
+    return list(LEVELS[level]) + [PASS_OPTIONS[name] for name, enabled in options.items() if enabled]
+
+
+def transform(
+    input: Expr | list[Statement],
+    inline: bool = False,
+    escape: bool = False,
+    fold: bool = False,
+    pipeline: Optional[Pipeline] = None,
+) -> Expr | list[Statement]:
+    """Run the tree passes, those of `pipeline` if given and otherwise those the options enable"""
+    if pipeline is None:
+        pipeline = Pipeline(pass_names(inline=inline, escape=escape, fold=fold))
+    return pipeline.run_tree(input)
+
+
+def generate(
+    input: Expr | list[Statement],
+    share_specs: bool = False,
+    hoist_closures: bool = False,
+    peephole: bool = False,
+    reuse_slots: bool = False,
+    ssa: bool = False,
+    registers: bool = False,
+    superinstructions: bool = False,
+    constant_pools: bool = False,
+    jobs: int = 1,
+    precompiled: Optional[dict[int, list[Instr]]] = None,
+    pipeline: Optional[Pipeline] = None,
+) -> Closure:
+    """Generate the code of a tree that went through `transform`, then run the code passes
+
+    Args:
+        precompiled (Optional[dict[int, list[Instr]]]): Code of function bodies compiled earlier, see `Compiler.precompiled`
+        pipeline (Optional[Pipeline]): The code passes to run, instead of those the options enable
+    """
+    if registers:
+        # Register machine code is produced from SSA form, for `regvm.run`
+        return lower_register_closure(optimize_ssa(build_ssa(input)))
+    if ssa:
+        closure = lower_closure(optimize_ssa(build_ssa(input)))
     else:
+        compiler = Compiler(
+            hashcons=HashCons() if share_specs else None,
+            reuse_slots=reuse_slots,
+            hoist_closures=hoist_closures,
+        )
+        if jobs > 1 and isinstance(input, list):
+            compiler.precompiled = precompile(input, jobs, share_specs, reuse_slots, hoist_closures)
+        if precompiled is not None:
+            compiler.precompiled.update(precompiled)
+        if isinstance(input, Expr):
+            compiler.compile_expr(input)
+        else:
+            compiler.compile_statements(input)
+        closure = compiler.into_closure()
+
+    if pipeline is None:
+        pipeline = Pipeline(
+            pass_names(peephole=peephole, superinstructions=superinstructions, constant_pools=constant_pools)
+        )
+    pipeline.run_code(closure)
+    return closure
+
+
+def compile(
+    input: Expr | list[Statement] | str,
+    share_specs: bool = False,
+    fold: bool = False,
+    inline: bool = False,
+    escape: bool = False,
+    specialize: bool = False,
+    peephole: bool = False,
+    reuse_slots: bool = False,
+    ssa: bool = False,
+    registers: bool = False,
+    superinstructions: bool = False,
+    constant_pools: bool = False,
+    jobs: int = 1,
+    level: int = 0,
+    debug: bool = False,
+    report: Optional[PipelineReport] = None,
+):
+    """Compile a program
+
+    The passes that run are those of the optimization `level` (see `LEVELS`) and those the pass options enable.
+
+    Args:
+        debug (bool): Verify the code after code generation and after every code pass
+        report (Optional[PipelineReport]): Receives the time and the effect of every pass
+
+    Raises:
+        CompileError: The program cannot be compiled, or in debug mode a pass produced invalid code
+    """
+    if isinstance(input, str):
+        input = statements(input).val
+    if not isinstance(input, (Expr, list)):
         raise TypeError
-
-    return compiler.into_closure()
+    names = pass_names(
+        level,
+        inline=inline,
+        escape=escape,
+        fold=fold,
+        specialize=specialize,
+        peephole=peephole,
+        superinstructions=superinstructions,
+        constant_pools=constant_pools,
+    )
+    pipeline = Pipeline(names, debug)
+    closure = generate(
+        transform(input, pipeline=pipeline),
+        share_specs=share_specs,
+        # Lifting and hoisting closures without captures both come from escape analysis
+        hoist_closures="lift" in pipeline,
+        reuse_slots=reuse_slots,
+        ssa=ssa,
+        registers=registers,
+        jobs=jobs,
+        pipeline=pipeline,
+    )
+    if report is not None:
+        report.passes.extend(pipeline.report.passes)
+    return closure
@@ -0,0 +1,82 @@
+"""Per-spec constant tables
+
+Literals are compiled to `Imm` refs that embed their value in the instruction, so a program holds one value object per occurrence of a literal. Interning moves them into the `constants` table of the spec whose code uses them, with one entry per distinct scalar, and rewrites the refs to `Const` indices into that table. Unit and booleans become the shared `value.UNIT`, `value.TRUE` and `value.FALSE`.
+
+Only scalars are merged by value. Arrays and closures are pooled by identity, so code that relied on two constants being distinct objects behaves the same.
+"""
+
+import struct
+from typing import Hashable
+
+from instr import Const, Imm, Instr, Ref
+from peephole import map_operands, nested_specs
+from value import FALSE, TRUE, UNIT, Bool, Closure, ClosureSpec, Float, Int, String, Tag, Unit, Value
+
+
+def constant_key(value: Value) -> Hashable:
+    """The key constants are merged by: type and payload for scalars, identity for everything else"""
+    match value:
+        case Float(x):
+            # By bits, so 0.0 and -0.0 stay apart and NaN matches itself
+            return (Float, struct.pack("<d", x))
+        case Int() | String() | Tag() | Bool():
+            return (type(value), value.value)
+        case Unit():
+            return (Unit,)
+    return (id(value),)
+
+
+def canonical(value: Value) -> Value:
+    match value:
+        case Unit():
+            return UNIT
+        case Bool(b):
+            return TRUE if b else FALSE
+    return value
+
+
+class ConstantTable:
+    def __init__(self):
+        self.values: list[Value] = []
+        self.indices: dict[Hashable, int] = {}
+
+    def ref(self, ref: Ref) -> Ref:
+        """A `Const` ref for an `Imm` one, adding its value to the table if needed"""
+        if not isinstance(ref, Imm):
+            return ref
+        key = constant_key(ref.value)
+        if (index := self.indices.get(key)) is None:
+            index = self.indices[key] = len(self.values)
+            self.values.append(canonical(ref.value))
+        return Const(index)
+
+
+def intern_code(code: list[Instr]) -> tuple[list[Instr], list[Value]]:
+    """Rewrite the `Imm` operands of code to `Const` refs
+
+    Returns:
+        tuple[list[Instr], list[Value]]: The new code and its constant table
+    """
+    table = ConstantTable()
+    out = [map_operands(instr, table.ref) for instr in code]
+    return out, table.values
+
+
+def intern_spec(spec: ClosureSpec, seen=None):
+    """Build the constant tables of a spec and the specs nested in it, in place"""
+    if seen is None:
+        seen = set()
+    if id(spec.code) in seen:
+        return
+    seen.add(id(spec.code))
+    for nested in nested_specs(spec):
+        intern_spec(nested, seen)
+    code, constants = intern_code(spec.code)
+    spec.code[:] = code
+    spec.constants[:] = constants
+    spec.invalidate()
+
+
+def intern(closure: Closure):
+    """Move the literals of a compiled closure into per-spec constant tables"""
+    intern_spec(closure.spec)
@@ -0,0 +1,273 @@
+"""Compilation of match arms into decision trees
+
+Follows Maranget, "Compiling Pattern Matching to Good Decision Trees" (2008). The arms form a clause matrix with one column per occurrence (a path into the subject) and one row per arm. The matrix is split on the constructors found in one column at a time, so on any path through the tree each part of the subject is examined at most once, however many arms there are.
+"""
+
+from dataclasses import dataclass
+from typing import Hashable, Optional, Union
+
+from value import Array, Float, Int, String, Tag
+from tree import (
+    ArrayPattern,
+    FloatPattern,
+    GatherPattern,
+    IdPattern,
+    IgnorePattern,
+    IntPattern,
+    Pattern,
+    StringPattern,
+    TagPattern,
+)
+
+
+@dataclass(frozen=True)
+class Occurrence:
+    """Path from the subject to a part of it
+
+    The subject itself has no parent. Elements have an `index` into their parent array, negative indices counting from the end, and gathered elements have a `gather` of `(skip_front, skip_back)`.
+    """
+
+    parent: Optional["Occurrence"] = None
+    index: int = 0
+    gather: Optional[tuple[int, int]] = None
+
+
+@dataclass
+class Leaf:
+    """The arm to run, with the occurrence each of its variables is bound to"""
+
+    arm: int
+    bindings: dict[str, Occurrence]
+
+
+@dataclass
+class Failure:
+    """No arm matches"""
+
+
+@dataclass
+class Branch:
+    """Dispatch on the switch key of an occurrence, see `ops.switch_key`"""
+
+    occurrence: Occurrence
+    cases: dict[Hashable, "Tree"]
+    default: "Tree"
+
+
+@dataclass
+class LengthCheck:
+    """Test whether an occurrence is an array of at least `length` items"""
+
+    occurrence: Occurrence
+    length: int
+    then: "Tree"
+    otherwise: "Tree"
+
+
+Tree = Union[Leaf, Failure, Branch, LengthCheck]
+
+
+@dataclass
+class Row:
+    # `None` is a wildcard
+    patterns: list[Optional[Pattern]]
+    bindings: dict[str, Occurrence]
+    arm: int
+
+
+def key(pattern: Pattern) -> Optional[Hashable]:
+    """The switch key of the values a pattern matches, or `None` for patterns with a gather"""
+    match pattern:
+        case TagPattern():
+            return (Tag, pattern.span.str())
+        case IntPattern():
+            return (Int, int(pattern.span.str()))
+        case FloatPattern():
+            return (Float, float(pattern.span.str()))
+        case StringPattern():
+            return (String, pattern.piece.str())
+        case ArrayPattern() if not any(isinstance(p, GatherPattern) for p in pattern.items):
+            return (Array, len(pattern.items))
+    return None
+
+
+def split(pattern: ArrayPattern) -> tuple[list[Pattern], Optional[Pattern], list[Pattern]]:
+    """Split an array pattern with a gather into the patterns before it, the gathered pattern and the patterns after it"""
+    for i, item in enumerate(pattern.items):
+        if isinstance(item, GatherPattern):
+            return pattern.items[:i], item.inner, pattern.items[i + 1 :]
+    raise ValueError("Array pattern has no gather")
+
+
+def is_gather(pattern: Optional[Pattern]) -> bool:
+    return isinstance(pattern, ArrayPattern) and key(pattern) is None
+
+
+def normalize(row: Row, occurrences: list[Occurrence]) -> Row:
+    """Move the names bound by `IdPattern`s into the row's bindings, leaving their inner patterns"""
+    patterns = []
+    bindings = dict(row.bindings)
+    for pattern, occurrence in zip(row.patterns, occurrences):
+        while isinstance(pattern, IdPattern):
+            bindings[pattern.name.str()] = occurrence
+            pattern = pattern.inner
+        if isinstance(pattern, IgnorePattern):
+            pattern = None
+        patterns.append(pattern)
+    return Row(patterns, bindings, row.arm)
+
+
+def specialize(
+    occurrences: list[Occurrence], rows: list[Row], col: int, head: Hashable
+) -> tuple[list[Occurrence], list[Row]]:
+    """The matrix for subjects whose occurrence `col` has the switch key `head`"""
+    occurrence = occurrences[col]
+    before, after = occurrences[:col], occurrences[col + 1 :]
+
+    if head[0] is not Array:
+        out = []
+        for row in rows:
+            pattern = row.patterns[col]
+            if pattern is None or key(pattern) == head:
+                patterns = row.patterns[:col] + row.patterns[col + 1 :]
+                out.append(Row(patterns, row.bindings, row.arm))
+        return before + after, out
+
+    n = head[1]
+    items = [Occurrence(occurrence, index=i) for i in range(n)]
+    gathers = []
+    for row in rows:
+        if is_gather(pattern := row.patterns[col]):
+            prefix, _, suffix = split(pattern)
+            if len(prefix) + len(suffix) <= n:
+                if (skip := (len(prefix), len(suffix))) not in gathers:
+                    gathers.append(skip)
+    new = items + [Occurrence(occurrence, gather=skip) for skip in gathers]
+
+    out = []
+    for row in rows:
+        pattern = row.patterns[col]
+        if pattern is None:
+            sub = [None] * len(new)
+        elif key(pattern) == head:
+            sub = list(pattern.items) + [None] * len(gathers)
+        elif is_gather(pattern):
+            prefix, inner, suffix = split(pattern)
+            if len(prefix) + len(suffix) > n:
+                continue
+            sub = [None] * len(new)
+            sub[: len(prefix)] = prefix
+            sub[n - len(suffix) : n] = suffix
+            sub[n + gathers.index((len(prefix), len(suffix)))] = inner
+        else:
+            continue
+        patterns = row.patterns[:col] + sub + row.patterns[col + 1 :]
+        out.append(Row(patterns, row.bindings, row.arm))
+
+    occurrences = before + new + after
+    return occurrences, [normalize(row, occurrences) for row in out]
+
+
+def at_least(
+    occurrences: list[Occurrence], rows: list[Row], col: int, length: int
+) -> tuple[list[Occurrence], list[Row]]:
+    """The matrix for subjects whose occurrence `col` is an array of at least `length` items but not of any length in the enclosing branch"""
+    occurrence = occurrences[col]
+    before, after = occurrences[:col], occurrences[col + 1 :]
+
+    applicable = []
+    for row in rows:
+        pattern = row.patterns[col]
+        if pattern is None:
+            applicable.append((row, None))
+        elif is_gather(pattern):
+            prefix, inner, suffix = split(pattern)
+            if len(prefix) + len(suffix) <= length:
+                applicable.append((row, (prefix, inner, suffix)))
+
+    n_front = max((len(parts[0]) for _, parts in applicable if parts), default=0)
+    n_back = max((len(parts[2]) for _, parts in applicable if parts), default=0)
+    gathers = []
+    for _, parts in applicable:
+        if parts and (skip := (len(parts[0]), len(parts[2]))) not in gathers:
+            gathers.append(skip)
+    new = (
+        [Occurrence(occurrence, index=i) for i in range(n_front)]
+        + [Occurrence(occurrence, index=-j) for j in range(n_back, 0, -1)]
+        + [Occurrence(occurrence, gather=skip) for skip in gathers]
+    )
+
+    out = []
+    for row, parts in applicable:
+        sub = [None] * len(new)
+        if parts is not None:
+            prefix, inner, suffix = parts
+            sub[: len(prefix)] = prefix
+            sub[n_front + n_back - len(suffix) : n_front + n_back] = suffix
+            sub[n_front + n_back + gathers.index((len(prefix), len(suffix)))] = inner
+        patterns = row.patterns[:col] + sub + row.patterns[col + 1 :]
+        out.append(Row(patterns, row.bindings, row.arm))
+
+    occurrences = before + new + after
+    return occurrences, [normalize(row, occurrences) for row in out]
+
+
+def default(occurrences: list[Occurrence], rows: list[Row], col: int) -> Tree:
+    """The tree for subjects whose occurrence `col` has none of the switch keys in the column
+
+    Only wildcards and array patterns with a gather can still match. The latter are tried from the longest minimum length down.
+    """
+    lengths = sorted(
+        {
+            len(pattern.items) - 1
+            for row in rows
+            if is_gather(pattern := row.patterns[col])
+        },
+        reverse=True,
+    )
+
+    def check(i: int) -> Tree:
+        if i == len(lengths):
+            remaining = [
+                Row(row.patterns[:col] + row.patterns[col + 1 :], row.bindings, row.arm)
+                for row in rows
+                if row.patterns[col] is None
+            ]
+            return compile_matrix(occurrences[:col] + occurrences[col + 1 :], remaining)
+        return LengthCheck(
+            occurrences[col],
+            lengths[i],
+            compile_matrix(*at_least(occurrences, rows, col, lengths[i])),
+            check(i + 1),
+        )
+
+    return check(0)
+
+
+def compile_matrix(occurrences: list[Occurrence], rows: list[Row]) -> Tree:
+    if not rows:
+        return Failure()
+    first = rows[0]
+    if all(pattern is None for pattern in first.patterns):
+        return Leaf(first.arm, first.bindings)
+
+    # Split on the first column the first row tests
+    col = next(i for i, pattern in enumerate(first.patterns) if pattern is not None)
+    heads = []
+    for row in rows:
+        pattern = row.patterns[col]
+        if pattern is not None and (head := key(pattern)) is not None and head not in heads:
+            heads.append(head)
+
+    otherwise = default(occurrences, rows, col)
+    if not heads:
+        return otherwise
+    cases = {head: compile_matrix(*specialize(occurrences, rows, col, head)) for head in heads}
+    return Branch(occurrences[col], cases, otherwise)
+
+
+def compile_patterns(patterns: list[Pattern]) -> Tree:
+    """Build the decision tree choosing the first of `patterns` that matches the subject; leaves refer to patterns by index"""
+    subject = Occurrence()
+    rows = [normalize(Row([pattern], {}, i), [subject]) for i, pattern in enumerate(patterns)]
+    return compile_matrix([subject], rows)
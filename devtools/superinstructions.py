@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""Mine instruction pair and triple frequencies from VM profiles
+
+Runs every program of the corpus, and any files given, under a profiling VM and prints the most frequent sequences of consecutive instructions. Those are the candidates for superinstructions (see `superinstr.py`). Pass `--fused` to profile with the current superinstructions selected, to see what remains.
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from compile import compile
+from vm import Profile, Vm
+
+CORPUS = [
+    "let f = fn(x, y) [y, x]; [f(1, 2), f(3, 4), f(5, 6)]",
+    "fn len(n) { match n { [] -> 0, [_, ...r] -> len(r) } }; len([1, 2, 3, 4, 5, 6, 7, 8])",
+    "fn rev(a, out) { match a { [] -> out, [x, ...r] -> rev(r, [x, ...out]) } }; rev([1, 2, 3, 4, 5, 6], [])",
+    "let g = fn(x) match x { :a -> 1, :b -> 2, _ -> 3 }; [g(:a), g(:b), g(:c), g(:d)]",
+    "let pair = fn(a, b) [a, b]; let swap = fn(p) match p { [a, b] -> pair(b, a) }; [swap([1, 2]), swap(pair(3, 4))]",
+    "fn map(f, a) { match a { [] -> [], [x, ...r] -> [f(x), ...map(f, r)] } }; map(fn(x) [x, x], [1, 2, 3, 4])",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", nargs="*", type=argparse.FileType(), default=[], help="More programs to profile")
+    parser.add_argument("-n", "--top", type=int, default=10, help="Number of sequences to show")
+    parser.add_argument("--peephole", action="store_true", help="Profile peephole optimized code")
+    parser.add_argument("--fused", action="store_true", help="Profile code with superinstructions")
+    args = parser.parse_args()
+
+    profile = Profile()
+    programs = CORPUS + [file.read() for file in args.input]
+    for source in programs:
+        closure = compile(source, peephole=args.peephole, superinstructions=args.fused)
+        profile.recent = ()
+        Vm(profile=profile).run(closure)
+
+    print(f"{profile.total()} instructions executed over {len(programs)} programs")
+    for title, counts in [("pairs", profile.pairs), ("triples", profile.triples)]:
+        print()
+        print(f"Top {title}:")
+        for sequence, count in counts.most_common(args.top):
+            print(f"{count:8} {count / profile.total():6.1%}  {' '.join(sequence)}")
+
+
+if __name__ == "__main__":
+    main()
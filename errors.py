@@ -8,3 +8,7 @@ class VmError(Exception):
 
 class CompileError(Exception):
     pass
+
+
+class BytecodeError(Exception):
+    pass
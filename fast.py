@@ -2,9 +2,14 @@
 
 import argparse
 
+import bytecode
 import colors
-from compile import Compiler
+import compile as compiler
+import vm
+from errors import CompileError
+from instr import ClosureNew
 from parse import statements
+from pipeline import PipelineReport
 
 
 def parse(args):
@@ -22,30 +27,64 @@ def parse(args):
             print(f"{colors.error}error {r.span.start}: {r.reason}{colors.reset}")
 
 
-def compile(args):
-    compiler = Compiler()
-    if args.command is not None:
-        if r := statements(args.command):
-            expr = r.val
-            print("(Statements)")
-            for statement in expr:
-                print(statement)
-            compiler.compile(expr)
-            print()
-            print("(Code)")
-            for code in compiler.code:
-                print(code)
+def print_spec(spec, indent=""):
+    for i, instr in enumerate(spec.code):
+        if isinstance(instr, ClosureNew):
+            print(f"{indent}{i:4} ClosureNew(n_args={instr.spec.n_args}, captures={instr.spec.capture_indices})")
+            print_spec(instr.spec, indent + "    ")
         else:
-            print(f"{colors.error}error {r.span.start}: {r.reason}{colors.reset}")
-    for file in args.input:
-        if r := statements(file.read()):
-            expr = r.val
-            if r := compiler.compile(expr):
-                print(r.val)
-            else:
-                print(f"{colors.error}error {r.span.start}: {r.reason}{colors.reset}")
+            print(f"{indent}{i:4} {instr}")
+
+
+def compile(args):
+    programs = ([("-c", args.command)] if args.command is not None else []) + [
+        (file.name, file.read()) for file in args.input
+    ]
+    if args.output is not None and len(programs) != 1:
+        print(f"{colors.error}error: -o needs exactly one program{colors.reset}")
+        return
+    for name, source in programs:
+        if not (r := statements(source)):
+            print(f"{colors.error}error {name} {r.span.start}: {r.reason}{colors.reset}")
+            continue
+        try:
+            report = PipelineReport()
+            closure = compiler.compile(
+                r.val, peephole=args.peephole, jobs=args.jobs, level=args.level, debug=args.debug, report=report
+            )
+        except CompileError as e:
+            print(f"{colors.error}error {name}: {e}{colors.reset}")
+            continue
+        if args.timings:
+            print(report)
+        if args.output is not None:
+            bytecode.write(closure, args.output)
         else:
-            print(f"{colors.error}error {r.span.start}: {r.reason}{colors.reset}")
+            print_spec(closure.spec)
+
+
+def run(args):
+    sources = ([args.command] if args.command is not None else []) + [file.read() for file in args.input]
+    for source in sources:
+        report = PipelineReport()
+        try:
+            closure = compiler.compile(source, level=args.level, debug=args.debug, report=report)
+        except CompileError as e:
+            print(f"{colors.error}error: {e}{colors.reset}")
+            continue
+        if args.timings:
+            print(report)
+        print(vm.run(closure, jit_threshold=args.jit_threshold))
+    for path in args.bytecode:
+        print(vm.run(bytecode.load(path), jit_threshold=args.jit_threshold))
+
+
+def add_pipeline_arguments(parser):
+    parser.add_argument(
+        "-O", dest="level", type=int, choices=sorted(compiler.LEVELS), default=0, help="Optimization level"
+    )
+    parser.add_argument("--debug", action="store_true", help="Verify the code after every pass")
+    parser.add_argument("--timings", action="store_true", help="Print the time and effect of every pass")
 
 
 def main():
@@ -69,8 +108,24 @@ def main():
 
     # Compile subcommand
     compile_parser = subparsers.add_parser("compile", help="compile to bytecode")
+    compile_parser.add_argument("-o", "--output", default=None, help="Write the bytecode to a .fastc file")
+    compile_parser.add_argument("--peephole", action="store_true", help="Run the peephole optimizer")
+    compile_parser.add_argument("-j", "--jobs", type=int, default=1, help="Compile top level functions in parallel")
+    add_pipeline_arguments(compile_parser)
     compile_parser.set_defaults(func=compile)
 
+    # Run subcommand
+    run_parser = subparsers.add_parser("run", help="run programs")
+    run_parser.add_argument("--bytecode", nargs="*", default=[], help=".fastc files to run")
+    run_parser.add_argument(
+        "--jit-threshold", type=int, default=vm.JIT_THRESHOLD, help="Calls after which a function is compiled to Python"
+    )
+    run_parser.add_argument(
+        "--no-jit", dest="jit_threshold", action="store_const", const=None, help="Only interpret"
+    )
+    add_pipeline_arguments(run_parser)
+    run_parser.set_defaults(func=run)
+
     args = parser.parse_args()
 
     # print(f"{args = }")
@@ -0,0 +1,189 @@
+"""Incremental rebuilds of a module
+
+`IncrementalBuild` keeps the code of every top level function of its last build, and a rebuild only compiles the functions whose code may have changed. Each top level statement is identified by the names it binds and hashed by its source text, and the names it refers to come from `free`:
+
+- Without tree passes, the code of a function body only depends on its own definition, so only functions whose definitions changed are recompiled.
+- Inlining and constant folding copy definitions into the code that refers to them, so the transitive dependents of a changed definition are recompiled too.
+- Lifting rewrites the parameters of a function depending on how it is called anywhere in the module, so with `escape` every function is a candidate.
+
+A candidate whose tree is structurally unchanged after the tree passes still keeps its code. The top level code is always linked anew, and the result is patched into the closure of the previous build, so whoever holds that closure runs the new code.
+
+Kept code is not recompiled when only its position in the source moves, so the positions quoted in the failure messages of a function are those of the build that compiled it.
+"""
+
+from collections import defaultdict
+from copy import deepcopy
+from dataclasses import dataclass
+from hashlib import sha256
+from typing import Optional
+
+from compile import PASS_OPTIONS, compile_functions, generate, pass_names, transform
+from errors import CompileError
+from instr import Instr
+from mixins import Format
+from parse import statements, ws
+from pipeline import Pipeline
+from tree import FnExpr, FnStatement, HashCons, IdPattern, LetStatement, Statement, structural_hash
+from value import Closure
+
+
+@dataclass
+class BuildStats(Format):
+    compiled: int = 0
+    reused: int = 0
+
+    def __str__(self):
+        return f"incremental: {self.compiled} functions compiled, {self.reused} reused"
+
+
+@dataclass
+class Definition(Format):
+    """A top level function of the last build"""
+
+    # After the tree passes
+    node: FnStatement | FnExpr
+    node_hash: int
+    code: list[Instr]
+
+
+def statement_keys(module: list[Statement]) -> list[str]:
+    """Keys identifying top level statements across builds: the names they bind, numbered if they repeat"""
+    seen = defaultdict(int)
+    keys = []
+    for statement in module:
+        names = ",".join(sorted(set(statement.early_bound()) | set(statement.bound())))
+        keys.append(f"{names}#{seen[names]}")
+        seen[names] += 1
+    return keys
+
+
+def defined_function(statement: Statement) -> Optional[FnStatement | FnExpr]:
+    """The function a top level statement defines, if any, like `compile.top_level_functions`"""
+    match statement:
+        case FnStatement():
+            return statement
+        case LetStatement(pattern=IdPattern(inner=None), inner=FnExpr() as fn):
+            return fn
+    return None
+
+
+def same_tree(a, b) -> bool:
+    hashcons = HashCons()
+    return hashcons.intern(a) is hashcons.intern(b)
+
+
+class IncrementalBuild:
+    """Rebuilds of one module, reusing the code of functions that did not change
+
+    Takes the options of `compile.compile`, except for the SSA and register machine backends, which do not compile function by function.
+    """
+
+    def __init__(self, **options):
+        if options.get("ssa") or options.get("registers"):
+            raise ValueError("Incremental builds only support the stack compiler")
+        self.passes = pass_names(
+            options.pop("level", 0), **{name: options.pop(name, False) for name in PASS_OPTIONS}
+        )
+        self.debug = options.pop("debug", False)
+        self.inline = "inline" in self.passes
+        self.escape = "lift" in self.passes
+        self.fold = "fold" in self.passes
+        # Only functions that need compiling go to the pool, not the whole module
+        self.jobs = options.pop("jobs", 1)
+        self.options = options
+        self.hashes: dict[str, str] = {}
+        self.definitions: dict[str, Definition] = {}
+        self.closure: Optional[Closure] = None
+        self.stats = BuildStats()
+
+    def dirty(self, module: list[Statement], keys: list[str], hashes: dict[str, str]) -> set[str]:
+        """Keys of the statements whose functions have to be looked at again"""
+        changed = {key for key in hashes.keys() | self.hashes.keys() if hashes.get(key) != self.hashes.get(key)}
+        if not (self.inline or self.fold):
+            return changed
+
+        # Names bound by changed statements, then by the statements referring to them, and so on
+        binders = defaultdict(set)
+        users = defaultdict(set)
+        for key, statement in zip(keys, module):
+            for name in set(statement.early_bound()) | set(statement.bound()):
+                binders[key].add(name)
+            for name in set(statement.free()):
+                users[name].add(key)
+        names = {name for key in changed for name in key.split("#")[0].split(",") if name}
+        dirty = set(changed)
+        while names:
+            name = names.pop()
+            for key in users[name] - dirty:
+                dirty.add(key)
+                names |= binders[key]
+        return dirty
+
+    def build(self, source: str) -> Closure:
+        """Compile a new version of the module
+
+        Raises:
+            CompileError: The source does not parse
+
+        Returns:
+            Closure: The closure of the first build, patched with the new code
+        """
+        r = statements(source)
+        if not r:
+            raise CompileError(f"{r.span.start}: {r.reason}")
+        # The parser stops at the first statement it cannot read
+        if rest := ws(r.span).span:
+            raise CompileError(f"{rest.start}: cannot parse {rest.str()[:20]!r}")
+        module = r.val
+        keys = statement_keys(module)
+        hashes = {key: sha256(statement.span.str().encode()).hexdigest() for key, statement in zip(keys, module)}
+        dirty = self.dirty(module, keys, hashes)
+
+        # The tree passes work on the whole module
+        transformed = transform(module, pipeline=Pipeline(self.passes))
+        definitions: dict[str, Definition] = {}
+        stale: list[tuple[str, FnStatement | FnExpr]] = []
+        for key, statement in zip(statement_keys(transformed), transformed):
+            if (fn := defined_function(statement)) is None:
+                continue
+            old = self.definitions.get(key)
+            if old is not None and not (self.escape or key in dirty):
+                definitions[key] = Definition(fn, old.node_hash, old.code)
+                continue
+            node_hash = structural_hash(fn)
+            if old is not None and old.node_hash == node_hash and same_tree(old.node, fn):
+                definitions[key] = Definition(fn, node_hash, old.code)
+            else:
+                stale.append((key, fn))
+
+        codes = compile_functions(
+            [fn for _, fn in stale],
+            self.jobs,
+            self.options.get("share_specs", False),
+            self.options.get("reuse_slots", False),
+            self.escape,
+        )
+        for (key, fn), code in zip(stale, codes):
+            definitions[key] = Definition(fn, structural_hash(fn), code)
+        self.stats = BuildStats(compiled=len(stale), reused=len(definitions) - len(stale))
+
+        # The code passes rewrite code lists in place, so they get copies of the kept code
+        precompiled = {id(d.node): deepcopy(d.code) for d in definitions.values()}
+        closure = generate(
+            transformed,
+            hoist_closures=self.escape,
+            precompiled=precompiled,
+            pipeline=Pipeline(self.passes, self.debug),
+            **self.options,
+        )
+        self.hashes = hashes
+        self.definitions = definitions
+
+        if self.closure is None:
+            self.closure = closure
+        else:
+            self.closure.spec.code[:] = closure.spec.code
+            self.closure.spec.constants[:] = closure.spec.constants
+            # Threaded and compiled from the old code
+            self.closure.spec.invalidate()
+        return self.closure
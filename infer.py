@@ -0,0 +1,271 @@
+"""Static type inference
+
+Bidirectional, as described in the README: `synth` derives the type of an expression from its parts, and `check` tells whether an expression has a type. Fast has no type annotations, so types come from literals and operators and flow through `let`. They are lost at function parameters, calls and the names bound by patterns. A type is the `Value` subclass every value of an expression is an instance of, or `None` when that is not known.
+
+A name is bound once by `let` but may be assigned any number of times, in loops too. Names assigned a value of another type than the one they were bound with are unstable, and have no type anywhere. Finding one can change the types of other assignments, so inference runs until no new unstable names turn up.
+
+`specialize` records the proven operand types on operator expressions, which the compiler turns into instructions that skip the type dispatch of `ops`.
+"""
+
+from dataclasses import replace
+from typing import Optional
+
+from tree import (
+    ArrayExpr,
+    Arm,
+    AssignStatement,
+    BinaryExpr,
+    BlockExpr,
+    BreakStatement,
+    ComparisonExpr,
+    ConstExpr,
+    Expr,
+    ExprStatement,
+    FloatExpr,
+    FnExpr,
+    FnStatement,
+    IdExpr,
+    IdPattern,
+    IntExpr,
+    LetStatement,
+    LoopExpr,
+    LoopStatement,
+    MatchExpr,
+    MatchStatement,
+    ParenExpr,
+    Statement,
+    StringExpr,
+    SyntaxNode,
+    TagExpr,
+    Transformer,
+    UnaryExpr,
+    children,
+)
+from value import Array, Bool, Closure, Float, Int, String, Tag, Unit
+
+Type = Optional[type]
+
+NUMBERS = (Int, Float)
+
+
+def binary_type(op: str, left: Type, right: Type) -> Type:
+    """The type of a binary operator applied to values of these types, following `ops.BINARY`"""
+    if left is Int and right is Int and op in ("*", "//", "%", "+", "-", "<<", ">>", "&", "^", "|"):
+        return Int
+    if left in NUMBERS and right in NUMBERS:
+        if op == "/":
+            return Float
+        # A negative exponent makes `Int ** Int` a `Float`
+        if Float in (left, right) and op in ("**", "*", "//", "%", "+", "-"):
+            return Float
+    if left is String and right is String and op == "+":
+        return String
+    if left is Bool and right is Bool and op in ("and", "or"):
+        return Bool
+    return None
+
+
+def unary_type(op: str, inner: Type) -> Type:
+    """The type of a unary operator applied to a value of this type, following `ops.UNARY`"""
+    if (op == "-" and inner in NUMBERS) or (op == "~" and inner is Int) or (op == "!" and inner is Bool):
+        return inner
+    return None
+
+
+def join(types: list[Type]) -> Type:
+    """The type of a value that comes from any of several places"""
+    if types and all(ty is types[0] for ty in types):
+        return types[0]
+    return None
+
+
+class Inferrer:
+    """One run of inference over a program, recording the type of every expression it reaches"""
+
+    def __init__(self, unstable: set[str]):
+        # Names assigned values of more than one type
+        self.unstable = unstable
+        self.changed = False
+        # id of an expression -> its type
+        self.types: dict[int, Type] = {}
+        # Label and the types of the values `break` leaves with, of each loop around the code
+        self.loops: list[tuple[Optional[str], list[Type]]] = []
+
+    def bind(self, env: dict[str, Type], names, ty: Type = None):
+        for name in names:
+            env[name] = None if name in self.unstable else ty
+
+    def check(self, expr: Expr, ty: type, env: dict[str, Type]) -> bool:
+        """Does every value of the expression have type `ty`?"""
+        return self.synth(expr, env) is ty
+
+    def synth(self, expr: Expr, env: dict[str, Type]) -> Type:
+        """The type of the values of an expression, if known"""
+        ty = self._synth(expr, env)
+        self.types[id(expr)] = ty
+        return ty
+
+    def _synth(self, expr: Expr, env: dict[str, Type]) -> Type:
+        match expr:
+            case IntExpr():
+                return Int
+            case FloatExpr():
+                return Float
+            case TagExpr():
+                return Tag
+            case ConstExpr():
+                return type(expr.value)
+            case IdExpr():
+                return env.get(expr.span.str())
+            case ParenExpr():
+                return self.synth(expr.inner, env)
+            case StringExpr():
+                for inner in expr.interpolants:
+                    self.synth(inner, env)
+                if expr.fn is not None:
+                    self.synth(expr.fn, env)
+                    return None
+                return String
+            case ArrayExpr():
+                self.visit_children(expr, env)
+                return Array
+            case FnExpr():
+                inner = dict(env)
+                self.bind(inner, [name for param in expr.params for name in param.bound()])
+                self.function(lambda: self.synth(expr.inner, inner))
+                return Closure
+            case BinaryExpr():
+                left = self.synth(expr.left, env)
+                right = self.synth(expr.right, env)
+                return binary_type(expr.op.str(), left, right)
+            case UnaryExpr():
+                return unary_type(expr.op.str(), self.synth(expr.inner, env))
+            case ComparisonExpr():
+                for inner in expr.inner:
+                    self.synth(inner, env)
+                return Bool
+            case BlockExpr():
+                return self.statements(expr.statements, env)
+            case MatchExpr():
+                self.synth(expr.subject, env)
+                return join([self.arm(arm, env) for arm in expr.arms])
+            case LoopExpr():
+                label = expr.label.str() if expr.label is not None else None
+                self.loops.append((label, []))
+                self.statements(expr.statements, env)
+                _, breaks = self.loops.pop()
+                return join(breaks)
+        # Calls, indexing and spreads
+        self.visit_children(expr, env)
+        return None
+
+    def arm(self, arm: Arm, env: dict[str, Type]) -> Type:
+        inner = dict(env)
+        self.bind(inner, arm.pattern.bound())
+        return self.synth(arm.expr, inner)
+
+    def function(self, body):
+        """Infer the body of a function, where there are no loops to break out of"""
+        loops, self.loops = self.loops, []
+        body()
+        self.loops = loops
+
+    def visit_children(self, node: SyntaxNode, env: dict[str, Type]):
+        for child in children(node):
+            match child:
+                case Expr():
+                    self.synth(child, env)
+                case Statement():
+                    self.statements([child], env)
+                case _:
+                    self.visit_children(child, env)
+
+    def statements(self, statements: list[Statement], env: dict[str, Type]) -> Type:
+        """The type of the value of a block"""
+        env = dict(env)
+        for statement in statements:
+            # Functions are in scope before they are defined, as a placeholder
+            self.bind(env, statement.early_bound())
+        ty = Unit
+        for statement in statements:
+            ty = self.statement(statement, env)
+        return ty
+
+    def statement(self, statement: Statement, env: dict[str, Type]) -> Type:
+        match statement:
+            case ExprStatement():
+                return self.synth(statement.inner, env)
+            case LoopStatement():
+                return self.synth(statement.loop_expr, env)
+            case MatchStatement():
+                return self.synth(statement.match_expr, env)
+            case LetStatement(pattern=IdPattern(inner=None)):
+                self.bind(env, [statement.pattern.name.str()], self.synth(statement.inner, env))
+            case LetStatement():
+                self.synth(statement.inner, env)
+                self.bind(env, statement.pattern.bound())
+            case AssignStatement():
+                ty = self.synth(statement.inner, env)
+                for name in statement.pattern.bound():
+                    if name not in self.unstable and (ty is None or env.get(name) is not ty):
+                        self.unstable.add(name)
+                        self.changed = True
+            case BreakStatement():
+                ty = Unit if statement.inner is None else self.synth(statement.inner, env)
+                label = statement.label.str() if statement.label is not None else None
+                for loop_label, breaks in reversed(self.loops):
+                    if label is None or loop_label == label:
+                        breaks.append(ty)
+                        break
+                return None
+            case FnStatement():
+                inner = dict(env)
+                self.bind(inner, [statement.name.str()], Closure)
+                self.bind(inner, [name for param in statement.params for name in param.bound()])
+                self.function(lambda: self.statements(statement.body, inner))
+            case _:
+                self.visit_children(statement, env)
+        return Unit
+
+
+def infer(input: Expr | list[Statement]) -> dict[int, Type]:
+    """The type of every expression in an expression or a list of statements, by id"""
+    unstable = set()
+    while True:
+        inferrer = Inferrer(unstable)
+        if isinstance(input, list):
+            inferrer.statements(input, {})
+        else:
+            inferrer.synth(input, {})
+        if not inferrer.changed:
+            return inferrer.types
+
+
+class Annotator(Transformer):
+    """Record the types of the operands of operator expressions, from `infer`"""
+
+    def __init__(self, types: dict[int, Type]):
+        super().__init__()
+        self.types = types
+
+    def operand_types(self, operands: list[Expr]) -> Optional[tuple[type, ...]]:
+        types = tuple(self.types.get(id(operand)) for operand in operands)
+        return None if None in types else types
+
+    def visit_BinaryExpr(self, expr):
+        types = self.operand_types([expr.left, expr.right])
+        expr = self.generic_visit(expr)
+        return expr if types is None else replace(expr, operand_types=types)
+
+    def visit_ComparisonExpr(self, expr):
+        types = self.operand_types(expr.inner)
+        expr = self.generic_visit(expr)
+        return expr if types is None else replace(expr, operand_types=types)
+
+
+def specialize(input: Expr | list[Statement]) -> Expr | list[Statement]:
+    """Annotate the operators in an expression or a list of statements with the types of their operands, where they are known"""
+    annotator = Annotator(infer(input))
+    if isinstance(input, list):
+        return [annotator.visit(statement) for statement in input]
+    return annotator.visit(input)
@@ -17,7 +17,7 @@ class Imm(Ref, Format):
         return f"imm"
 
 
-@dataclass
+@dataclass(frozen=True)
 class Stack(Ref, Format):
     """Stack slot"""
 
@@ -27,7 +27,7 @@ class Stack(Ref, Format):
         return f"loc {self.index}"
 
 
-@dataclass
+@dataclass(frozen=True)
 class Arg(Ref, Format):
     """Function argument"""
 
@@ -37,7 +37,7 @@ class Arg(Ref, Format):
         return f"arg {self.index}"
 
 
-@dataclass
+@dataclass(frozen=True)
 class Cap(Ref, Format):
     """Closure capture"""
 
@@ -47,6 +47,26 @@ class Cap(Ref, Format):
         return f"cap {self.index}"
 
 
+@dataclass(frozen=True)
+class Reg(Ref, Format):
+    """Register of a frame in the register machine, see `register.py`"""
+
+    index: int
+
+    def short(self):
+        return f"reg {self.index}"
+
+
+@dataclass(frozen=True)
+class Const(Ref, Format):
+    """Entry of the constant table of the running closure's spec, see `constants.py`"""
+
+    index: int
+
+    def short(self):
+        return f"const {self.index}"
+
+
 Ref.get_children()
 
 
@@ -74,14 +94,14 @@ class ArrayExtend(Instr):
 
 
 @dataclass
-class StringBufferPush(Instr):
-    buffer_loc: Stack
-    piece: Stack
+class StringFormat(Instr):
+    """Push the string of the literal pieces of `template` with the rendered `operands` in between
 
+    `template` has one more piece than there are operands.
+    """
 
-@dataclass
-class StringBufferToString(Instr):
-    buffer_loc: Stack
+    template: list[str]
+    operands: list[Ref]
 
 
 @dataclass
@@ -95,17 +115,58 @@ class Call(Instr):
     n_args: int
 
 
+@dataclass
+class TailCall(Instr):
+    """Call in tail position; the callee takes over the frame of the caller and returns to its caller"""
+
+    closure: Ref
+    n_args: int
+
+
+@dataclass
+class CaptureSet(Instr):
+    """Overwrite a capture of a closure, so that functions can refer to themselves and each other"""
+
+    closure: Ref
+    index: int
+    value: Ref
+
+
 @dataclass
 class LocalJump(Instr):
     condition: Ref
     dest: int
 
 
+@dataclass
+class Jump(Instr):
+    """Unconditional jump"""
+
+    dest: int
+
+
+@dataclass
+class Switch(Instr):
+    """Jump to `cases[ops.switch_key(value)]`, or to `default` if the key is missing"""
+
+    value: Ref
+    cases: dict
+    default: int
+
+
 @dataclass
 class Return(Instr):
     """Return from stack frame; return value is implicitly the top-most temporary on the previous stack frame"""
 
 
+@dataclass
+class Store(Instr):
+    """Overwrite a stack slot"""
+
+    dest: Stack
+    value: Ref
+
+
 @dataclass
 class Pop(Instr):
     # number of values to pop
@@ -125,7 +186,18 @@ class IsType(Instr):
 
 @dataclass
 class MatchArray(Instr):
+    """Jump to `dest` unless `array` is an array of at least `lower_bound` items"""
+
+    array: Ref
     lower_bound: int
+    dest: int
+
+
+@dataclass
+class Fail(Instr):
+    """Raise a runtime error"""
+
+    reason: str
 
 
 @dataclass
@@ -134,4 +206,101 @@ class Index(Instr):
     ix: Ref
 
 
+@dataclass
+class ArraySlice(Instr):
+    """Push the items of `array` without the first `skip_front` and last `skip_back`"""
+
+    array: Ref
+    skip_front: int
+    skip_back: int
+
+
+@dataclass
+class PushArrayPush(Instr):
+    """Superinstruction for `Push(value)` then `ArrayPush` of the pushed slot: append `value` without going through the stack"""
+
+    array: Ref
+    value: Ref
+
+
+@dataclass
+class PushCall(Instr):
+    """Superinstruction for pushing each of `args` then `Call(closure, len(args))`"""
+
+    closure: Ref
+    args: list[Ref]
+
+
+@dataclass
+class PushTailCall(Instr):
+    """Superinstruction for pushing each of `args` then `TailCall(closure, len(args))`"""
+
+    closure: Ref
+    args: list[Ref]
+
+
+@dataclass
+class StorePop(Instr):
+    """Superinstruction for `Store(dest, value)` then `Pop(n)`"""
+
+    dest: Stack
+    value: Ref
+    n: int
+
+
+@dataclass
+class BinaryOp(Instr):
+    op: str
+    left: Ref
+    right: Ref
+
+
+@dataclass
+class IntBinaryOp(Instr):
+    """`BinaryOp` on two `Int`s, one of `ops.INT_BINARY`"""
+
+    op: str
+    left: Ref
+    right: Ref
+
+
+@dataclass
+class FloatBinaryOp(Instr):
+    """`BinaryOp` on two numbers, at least one of them a `Float`, one of `ops.FLOAT_BINARY`"""
+
+    op: str
+    left: Ref
+    right: Ref
+
+
+@dataclass
+class StringConcat(Instr):
+    """`BinaryOp` `+` on two `String`s"""
+
+    left: Ref
+    right: Ref
+
+
+@dataclass
+class UnaryOp(Instr):
+    op: str
+    inner: Ref
+
+
+@dataclass
+class Compare(Instr):
+    # len(ops) == len(operands) - 1
+    ops: list[str]
+    operands: list[Ref]
+
+
+@dataclass
+class NumberCompare(Instr):
+    """`Compare` of two numbers with one operator of `ops.NUMBER_COMPARE`; `==` and `!=` only on two `Int`s"""
+
+    op: str
+    left: Ref
+    right: Ref
+
+
 Instr.get_children()
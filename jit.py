@@ -0,0 +1,298 @@
+"""Compilation of hot closures to Python functions
+
+The VM counts the calls of every spec, and once a spec is called often enough (see `Vm.jit_threshold`) its code is translated to the source of a Python function, which `compile` turns into Python bytecode. The function is kept on the spec and runs every later call of it.
+
+Stack slots become Python locals `s0`, `s1`, ... at the depths `peephole.depths` finds, so pushes and pops do no work, and arguments become locals `a0`, `a1`, .... Immediates, nested specs and the helpers the code calls are free variables of the function, so they are read from closure cells. Captures are read from the running closure on every use, as `CaptureSet` may assign them after the closure is created.
+
+Python has no goto, so the code is split into basic blocks, and a loop picks the block that starts at `pc`. Blocks are tested in the order of the code, so a block falls through to the next one and jumps forward by setting `pc`, while jumps back also `continue`.
+
+A compiled function takes the VM and the frame of a call, like the steps of `Vm.run`, and returns the value of the call. Calls go through `Vm.run` and so nest Python calls, which is why the VM interprets calls made from deeply nested compiled code (see `vm.MAX_COMPILED_DEPTH`). Tail calls replace the closure and arguments of the frame and return `None`, for the VM to run the new closure in the same frame.
+"""
+
+from typing import Any, Callable, Optional
+
+import ops
+from errors import VmError
+from instr import (
+    Arg,
+    ArrayExtend,
+    ArrayPush,
+    ArraySlice,
+    Assert,
+    BinaryOp,
+    Call,
+    Cap,
+    CaptureSet,
+    ClosureNew,
+    Compare,
+    Const,
+    Fail,
+    FloatBinaryOp,
+    Imm,
+    Index,
+    Instr,
+    IntBinaryOp,
+    Jump,
+    LocalJump,
+    MatchArray,
+    NumberCompare,
+    Pop,
+    Push,
+    PushArrayPush,
+    PushCall,
+    PushTailCall,
+    Ref,
+    Return,
+    Stack,
+    Store,
+    StorePop,
+    StringConcat,
+    StringFormat,
+    Switch,
+    TailCall,
+    UnaryOp,
+)
+from peephole import depths, operands, successors
+from value import FALSE, TRUE, Array, Closure, ClosureSpec, Float, Int, String, Value
+
+# Runs a call of a closure in a frame of the VM; `None` when the frame was handed to another closure by a tail call
+Compiled = Callable[[Any, Any], Optional[Value]]
+
+# Free variables of every compiled function
+HELPERS = {
+    "Array": Array,
+    "Closure": Closure,
+    "Float": Float,
+    "Int": Int,
+    "String": String,
+    "TRUE": TRUE,
+    "FALSE": FALSE,
+    "VmError": VmError,
+    "binary": ops.binary,
+    "unary": ops.unary,
+    "compare": ops.compare,
+    "render": ops.render,
+    "switch_key": ops.switch_key,
+}
+
+# Instructions after which the next one only runs if it is jumped to
+ENDS_BLOCK = (LocalJump, MatchArray, Jump, Switch, Return, Fail, TailCall, PushTailCall)
+
+
+class Translator:
+    """Translation of the code of one spec to the source of a Python function"""
+
+    def __init__(self, spec: ClosureSpec):
+        self.spec = spec
+        self.depth = depths(spec.code)
+        # Free variables: name -> value, and id of the value -> name
+        self.cells: dict[str, Any] = {**HELPERS, "consts": spec.constants}
+        self.names: dict[int, str] = {}
+        self.lines: list[str] = []
+
+    def cell(self, value: Any) -> str:
+        """Name of a free variable holding a value"""
+        if id(value) not in self.names:
+            name = self.names[id(value)] = f"k{len(self.names)}"
+            self.cells[name] = value
+        return self.names[id(value)]
+
+    def ref(self, ref: Ref, depth: int) -> str:
+        """Expression reading an operand"""
+        match ref:
+            case Stack(index):
+                return f"s{index if index >= 0 else depth + index}"
+            case Arg(index):
+                return f"a{index}"
+            case Cap(index):
+                return f"caps[{index}]"
+            case Const(index):
+                return f"consts[{index}]"
+            case Imm(value):
+                return self.cell(value)
+        raise NotImplementedError(f"`Translator.ref({type(ref).__name__})`")
+
+    def emit(self, line: str, indent: int):
+        self.lines.append("    " * indent + line)
+
+    def goto(self, dest: int, start: int, indent: int):
+        self.emit(f"pc = {dest}", indent)
+        if dest <= start:
+            self.emit("continue", indent)
+
+    def leaders(self) -> list[int]:
+        """First instruction of every reachable block, and the exit if it is reached"""
+        code = self.spec.code
+        leaders = {0}
+        for i, instr in enumerate(code):
+            if self.depth[i] is None:
+                continue
+            if isinstance(instr, ENDS_BLOCK):
+                leaders.add(i + 1)
+                leaders.update(successors(code, i))
+        return sorted(i for i in leaders if i <= len(code) and self.depth[i] is not None)
+
+    def instr(self, instr: Instr, i: int, start: int, indent: int):
+        """Statements executing an instruction at index `i` of the block starting at `start`"""
+        d = self.depth[i]
+
+        def r(ref: Ref) -> str:
+            return self.ref(ref, d)
+
+        match instr:
+            case Push(Array()):
+                self.emit(f"s{d} = Array([])", indent)
+            case Push(value):
+                self.emit(f"s{d} = {r(value)}", indent)
+            case IntBinaryOp(op, left, right) | FloatBinaryOp(op, left, right):
+                ty, table = ("Int", ops.INT_BINARY) if isinstance(instr, IntBinaryOp) else ("Float", ops.FLOAT_BINARY)
+                # The operators of these tables are those of Python
+                self.operator(op, table)
+                self.emit(f"s{d} = {ty}({r(left)}.value {op} {r(right)}.value)", indent)
+            case NumberCompare(op, left, right):
+                self.operator(op, ops.NUMBER_COMPARE)
+                self.emit(f"s{d} = TRUE if {r(left)}.value {op} {r(right)}.value else FALSE", indent)
+            case StringConcat(left, right):
+                self.emit(f"s{d} = String({r(left)}.value + {r(right)}.value)", indent)
+            case BinaryOp(op, left, right):
+                self.emit(f"s{d} = binary({op!r}, {r(left)}, {r(right)})", indent)
+            case UnaryOp(op, inner):
+                self.emit(f"s{d} = unary({op!r}, {r(inner)})", indent)
+            case Compare(names, refs):
+                self.emit(f"s{d} = compare({self.cell(names)}, [{', '.join(map(r, refs))}])", indent)
+            case StringFormat(template, refs):
+                self.emit(f"s{d} = String(render({self.cell(template)}, [{', '.join(map(r, refs))}]))", indent)
+            case Call(closure, n_args):
+                args = ", ".join(f"s{j}" for j in range(d - n_args, d))
+                self.emit(f"s{d - n_args} = vm.run({r(closure)}, [{args}])", indent)
+            case PushCall(closure, args):
+                self.emit(f"s{d} = vm.run({r(closure)}, [{', '.join(map(r, args))}])", indent)
+            case TailCall(closure, n_args):
+                self.emit(f"frame.closure = {r(closure)}", indent)
+                self.emit(f"frame.args = [{', '.join(f's{j}' for j in range(d - n_args, d))}]", indent)
+                self.emit("return None", indent)
+            case PushTailCall(closure, args):
+                self.emit(f"frame.closure = {r(closure)}", indent)
+                self.emit(f"frame.args = [{', '.join(map(r, args))}]", indent)
+                self.emit("return None", indent)
+            case ClosureNew(spec):
+                captures = ", ".join(map(r, spec.capture_indices))
+                self.emit(f"s{d} = Closure({self.cell(spec)}, [{captures}])", indent)
+            case CaptureSet(closure, index, value):
+                self.emit(f"{r(closure)}.captures[{index}] = {r(value)}", indent)
+            case ArrayPush(array, value) | PushArrayPush(array, value):
+                self.emit(f"{r(array)}.values.append({r(value)})", indent)
+            case ArrayExtend(array, source):
+                self.emit(f"{r(array)}.values.extend({r(source)}.values)", indent)
+            case LocalJump(condition, dest):
+                self.emit(f"if {r(condition)} == TRUE:", indent)
+                self.goto(dest, start, indent + 1)
+                self.emit("else:", indent)
+                self.emit(f"pc = {i + 1}", indent + 1)
+            case Jump(dest):
+                self.goto(dest, start, indent)
+            case Switch(value, cases, default):
+                self.emit(f"pc = {self.cell(cases)}.get(switch_key({r(value)}), {default})", indent)
+                if any(dest <= start for dest in [*cases.values(), default]):
+                    self.emit("continue", indent)
+            case MatchArray(array, lower_bound, dest):
+                self.emit(f"t = {r(array)}", indent)
+                self.emit(f"if isinstance(t, Array) and len(t.values) >= {lower_bound}:", indent)
+                self.emit(f"pc = {i + 1}", indent + 1)
+                self.emit("else:", indent)
+                self.goto(dest, start, indent + 1)
+            case Fail(reason):
+                self.emit(f"raise VmError({reason!r})", indent)
+            case Index(array, ix):
+                self.emit(f"s{d} = {r(array)}.values[{r(ix)}.value]", indent)
+            case ArraySlice(array, skip_front, skip_back):
+                self.emit(f"t = {r(array)}.values", indent)
+                self.emit(f"s{d} = Array(t[{skip_front} : len(t) - {skip_back}])", indent)
+            case Return():
+                self.exit(d, indent)
+            case Store(dest, value) | StorePop(dest, value):
+                self.emit(f"s{dest.index} = {r(value)}", indent)
+            case Pop():
+                pass
+            case Assert(value, reason):
+                self.emit(f"if {r(value)} != TRUE:", indent)
+                self.emit(f"raise VmError({'assertion error: ' + reason!r})", indent + 1)
+            case _:
+                raise NotImplementedError(f"`Translator.instr({type(instr).__name__})`")
+
+    def operator(self, op: str, table: dict):
+        if op not in table:
+            raise VmError(f"unknown operator `{op}`")
+
+    def exit(self, depth: int, indent: int):
+        """Return the value on top of the stack"""
+        if depth == 0:
+            # What the VM does when it returns from an empty stack
+            self.emit('raise IndexError("list index out of range")', indent)
+        else:
+            self.emit(f"return s{depth - 1}", indent)
+
+    def translate(self) -> str:
+        code = self.spec.code
+        leaders = self.leaders()
+        self.emit("def jitted(vm, frame):", 0)
+        refs = [ref for instr in code for ref, _ in operands(instr)]
+        arg_indices = sorted({ref.index for ref in refs if isinstance(ref, Arg)})
+        if arg_indices:
+            self.emit("args = frame.args", 1)
+            for index in arg_indices:
+                self.emit(f"a{index} = args[{index}]", 1)
+        if any(isinstance(ref, Cap) for ref in refs):
+            self.emit("caps = frame.closure.captures", 1)
+
+        # Straight-line code needs no loop
+        looped = len(leaders) > 1
+        indent = 1
+        if looped:
+            self.emit("pc = 0", 1)
+            self.emit("while True:", 1)
+        for k, start in enumerate(leaders):
+            if looped:
+                self.emit(f"if pc == {start}:", 2)
+                indent = 3
+            end = leaders[k + 1] if k + 1 < len(leaders) else len(code)
+            if start == len(code):
+                self.exit(self.depth[start], indent)
+                continue
+            # Up to the next block, or to the jump or return ending this one, after which the code is unreachable
+            i = start
+            while True:
+                self.instr(code[i], i, start, indent)
+                i += 1
+                if isinstance(code[i - 1], ENDS_BLOCK):
+                    break
+                if i == end:
+                    if end == len(code) and end not in leaders:
+                        self.exit(self.depth[end], indent)
+                    else:
+                        self.emit(f"pc = {end}", indent)
+                    break
+        return "\n".join(self.lines)
+
+
+def translate(spec: ClosureSpec) -> tuple[str, dict[str, Any]]:
+    """The source of a Python function running the code of a spec, and the values of its free variables
+
+    Raises:
+        CompileError: Two paths reach an instruction with different stack depths
+        NotImplementedError: The code has an instruction or operand the VM does not run
+    """
+    translator = Translator(spec)
+    source = translator.translate()
+    return source, translator.cells
+
+
+def compile_spec(spec: ClosureSpec) -> Compiled:
+    """A Python function running the code of a spec, see `translate`"""
+    source, cells = translate(spec)
+    # The free variables are parameters of a factory, so the function reads them from closure cells
+    factory = f"def factory({', '.join(cells)}):\n" + "\n".join(f"    {line}" for line in source.split("\n"))
+    factory += "\n    return jitted"
+    namespace = {}
+    exec(compile(factory, "<jit>", "exec"), namespace)
+    return namespace["factory"](*cells.values())
@@ -56,20 +56,6 @@ class Format:
             raise ValueError
         return self.positional[0]
 
-    @property
-    def left(self):
-        """Get left child if there are exactly 2 children, or raise ValueError"""
-        if len(self.positional) != 2:
-            raise ValueError
-        return self.positional[0]
-
-    @property
-    def right(self):
-        """Get right child if there are exactly 2 children, or raise ValueError"""
-        if len(self.positional) != 2:
-            raise ValueError
-        return self.positional[1]
-
     # - Pretty-printing -#
     def format_lines(self, recursive=True, max_depth=10, visited=None, depth=0):
         """Pretty-print data structure
@@ -0,0 +1,259 @@
+"""Semantics of Fast operators on runtime values
+
+The VM and compile-time constant folding share these tables, so a folded expression always produces the value it would have produced at runtime.
+"""
+
+import operator
+from typing import Callable, Hashable, Optional
+
+from errors import VmError
+from value import FALSE, TRUE, Array, Bool, Float, Int, String, Tag, Unit, Value, boolean
+
+
+def _type_error(op: str, *values: Value) -> VmError:
+    types = ", ".join(type(value).__name__ for value in values)
+    return VmError(f"unsupported operand types for `{op}`: {types}")
+
+
+def _numeric(op: str, f: Callable) -> Callable[[Value, Value], Value]:
+    """Int op Int is Int; a Float on either side makes the result Float"""
+
+    def apply(left: Value, right: Value) -> Value:
+        match left, right:
+            case Int(a), Int(b):
+                return Int(f(a, b))
+            case (Int(a) | Float(a)), (Int(b) | Float(b)):
+                return Float(f(a, b))
+        raise _type_error(op, left, right)
+
+    return apply
+
+
+def _integer(op: str, f: Callable) -> Callable[[Value, Value], Value]:
+    def apply(left: Value, right: Value) -> Value:
+        match left, right:
+            case Int(a), Int(b):
+                return Int(f(a, b))
+        raise _type_error(op, left, right)
+
+    return apply
+
+
+def _logical(op: str, f: Callable) -> Callable[[Value, Value], Value]:
+    def apply(left: Value, right: Value) -> Value:
+        match left, right:
+            case Bool(a), Bool(b):
+                return boolean(f(a, b))
+        raise _type_error(op, left, right)
+
+    return apply
+
+
+def _add(left: Value, right: Value) -> Value:
+    match left, right:
+        case String(a), String(b):
+            return String(a + b)
+    return _numeric("+", operator.add)(left, right)
+
+
+def _div(left: Value, right: Value) -> Value:
+    match left, right:
+        case (Int(a) | Float(a)), (Int(b) | Float(b)):
+            return Float(a / b)
+    raise _type_error("/", left, right)
+
+
+def _pow(left: Value, right: Value) -> Value:
+    match left, right:
+        case Int(a), Int(b) if b >= 0:
+            return Int(a**b)
+        case (Int(a) | Float(a)), (Int(b) | Float(b)):
+            result = float(a) ** b
+            # A negative number to a fractional power
+            if isinstance(result, complex):
+                raise VmError(f"complex result of `**`: {a} ** {b}")
+            return Float(result)
+    raise _type_error("**", left, right)
+
+
+BINARY: dict[str, Callable[[Value, Value], Value]] = {
+    "**": _pow,
+    "*": _numeric("*", operator.mul),
+    "/": _div,
+    "//": _numeric("//", operator.floordiv),
+    "%": _numeric("%", operator.mod),
+    "+": _add,
+    "-": _numeric("-", operator.sub),
+    "<<": _integer("<<", operator.lshift),
+    ">>": _integer(">>", operator.rshift),
+    "&": _integer("&", operator.and_),
+    "^": _integer("^", operator.xor),
+    "|": _integer("|", operator.or_),
+    "and": _logical("and", operator.and_),
+    "or": _logical("or", operator.or_),
+}
+
+
+def _neg(value: Value) -> Value:
+    match value:
+        case Int(a):
+            return Int(-a)
+        case Float(a):
+            return Float(-a)
+    raise _type_error("-", value)
+
+
+def _not(value: Value) -> Value:
+    match value:
+        case Bool(a):
+            return boolean(not a)
+    raise _type_error("!", value)
+
+
+def _invert(value: Value) -> Value:
+    match value:
+        case Int(a):
+            return Int(~a)
+    raise _type_error("~", value)
+
+
+UNARY: dict[str, Callable[[Value], Value]] = {
+    "-": _neg,
+    "!": _not,
+    "~": _invert,
+}
+
+
+def _ordering(op: str, f: Callable) -> Callable[[Value, Value], bool]:
+    def apply(left: Value, right: Value) -> bool:
+        match left, right:
+            case (Int(a) | Float(a)), (Int(b) | Float(b)):
+                return f(a, b)
+            case String(a), String(b):
+                return f(a, b)
+        raise _type_error(op, left, right)
+
+    return apply
+
+
+def _contains(left: Value, right: Value) -> bool:
+    match left, right:
+        case String(a), String(b):
+            return a in b
+        case _, Array(values):
+            return left in values
+    raise _type_error("in", left, right)
+
+
+COMPARE: dict[str, Callable[[Value, Value], bool]] = {
+    "<": _ordering("<", operator.lt),
+    "<=": _ordering("<=", operator.le),
+    ">=": _ordering(">=", operator.ge),
+    ">": _ordering(">", operator.gt),
+    "==": operator.eq,
+    "!=": operator.ne,
+    "in": _contains,
+    "notin": lambda left, right: not _contains(left, right),
+}
+
+
+# Operators on the payloads of operands whose types were proven at compile time, see `infer.py`. None of them can fail.
+INT_BINARY: dict[str, Callable[[int, int], int]] = {
+    "*": operator.mul,
+    "+": operator.add,
+    "-": operator.sub,
+    "&": operator.and_,
+    "^": operator.xor,
+    "|": operator.or_,
+}
+FLOAT_BINARY: dict[str, Callable[[float, float], float]] = {
+    "*": operator.mul,
+    "+": operator.add,
+    "-": operator.sub,
+}
+NUMBER_COMPARE: dict[str, Callable[[float, float], bool]] = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">=": operator.ge,
+    ">": operator.gt,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+
+def binary(op: str, left: Value, right: Value) -> Value:
+    """Apply a binary operator
+
+    Raises:
+        VmError: Unknown operator, unsupported operand types, division by zero, a result too large for a float, or a complex result
+    """
+    if (f := BINARY.get(op)) is None:
+        raise VmError(f"unknown binary operator `{op}`")
+    try:
+        return f(left, right)
+    except ZeroDivisionError:
+        raise VmError(f"division by zero in `{op}`")
+    except OverflowError:
+        raise VmError(f"numeric overflow in `{op}`")
+
+
+def unary(op: str, value: Value) -> Value:
+    """Apply a unary operator
+
+    Raises:
+        VmError: Unknown operator or unsupported operand type
+    """
+    if (f := UNARY.get(op)) is None:
+        raise VmError(f"unknown unary operator `{op}`")
+    return f(value)
+
+
+def compare(ops: list[str], operands: list[Value]) -> Bool:
+    """Evaluate a comparison chain; `a < b < c` means `a < b and b < c`
+
+    Raises:
+        VmError: Unknown operator or unsupported operand types
+    """
+    for op, left, right in zip(ops, operands, operands[1:]):
+        if (f := COMPARE.get(op)) is None:
+            raise VmError(f"unknown comparison operator `{op}`")
+        if not f(left, right):
+            return FALSE
+    return TRUE
+
+
+def to_string(value: Value) -> str:
+    """Convert a value to the text it renders as inside string interpolation"""
+    match value:
+        case String(s):
+            return s
+        case Int(n):
+            return str(n)
+        case Float(x):
+            return repr(x)
+        case Tag(name):
+            return name
+        case Bool(b):
+            return "true" if b else "false"
+        case Unit():
+            return "()"
+    raise _type_error("string interpolation", value)
+
+
+def render(template: list[str], values: list[Value]) -> str:
+    """The text of a `StringFormat` instruction: the pieces of `template` with the values rendered in between"""
+    parts = [template[0]]
+    for value, piece in zip(values, template[1:]):
+        parts.append(to_string(value))
+        parts.append(piece)
+    return "".join(parts)
+
+
+def switch_key(value: Value) -> Optional[Hashable]:
+    """The key a `Switch` looks a value up by: the type and payload of a scalar, or the length of an array"""
+    match value:
+        case Array(values):
+            return (Array, len(values))
+        case Int() | Float() | String() | Tag() | Bool():
+            return (type(value), value.value)
+    return None
@@ -127,7 +127,9 @@ arm = starmap(seq(pattern, ws, "->", ws, expr), Arm)
 match_expr = starmap(
     seq("match", ws, expr, ws, "{", ws, sep(arm, ","), ws, "}"), MatchExpr
 )
-loop_expr = starmap(seq("loop", ws, "{", ws, statements, ws, "}"), LoopExpr)
+loop_expr = starmap(
+    seq(opt(label, ws, ignore(":"), ws), "loop", ws, "{", ws, statements, ws, "}"), LoopExpr
+)
 
 atom.f = alt(float_expr, integer, string, id, tag_expr, array, paren, spread, block, fn)
 
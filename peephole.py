@@ -0,0 +1,542 @@
+"""Peephole optimization of compiled instruction lists
+
+Instructions address stack slots by absolute index (`Stack(i)` is `StackFrame.locals[i]`), so removing an instruction that pushes a value shifts every slot above it. The analyses here track the stack depth before each instruction so that slot references, `Pop` counts and jump targets can be fixed up after instructions are removed.
+"""
+
+from collections import defaultdict
+from dataclasses import dataclass, fields, replace
+from typing import Callable, Iterable, Optional
+
+from errors import CompileError
+from instr import (
+    Arg,
+    ArrayExtend,
+    ArrayPush,
+    ArraySlice,
+    Assert,
+    BinaryOp,
+    Call,
+    Cap,
+    CaptureSet,
+    ClosureNew,
+    Compare,
+    Const,
+    Fail,
+    FloatBinaryOp,
+    Imm,
+    Index,
+    Instr,
+    IntBinaryOp,
+    Jump,
+    LocalJump,
+    MatchArray,
+    NumberCompare,
+    Pop,
+    Push,
+    PushArrayPush,
+    PushCall,
+    PushTailCall,
+    Ref,
+    Return,
+    Stack,
+    Store,
+    StorePop,
+    StringConcat,
+    StringFormat,
+    Switch,
+    TailCall,
+    UnaryOp,
+)
+from mixins import Format
+from value import Array, Bool, Closure, ClosureSpec
+
+# Operands that an instruction writes through, rather than only reads
+MUTATED = {
+    (ArrayPush, "array"),
+    (ArrayExtend, "array_loc"),
+    (CaptureSet, "closure"),
+    (PushArrayPush, "array"),
+}
+
+# Operands that an instruction overwrites without reading; not part of `operands`
+WRITTEN = {
+    (Store, "dest"),
+    (StorePop, "dest"),
+}
+
+
+def stack_effect(instr: Instr) -> tuple[int, int]:
+    """Number of values an instruction pops, then pushes
+
+    Raises:
+        NotImplementedError: The instruction type is not implemented
+    """
+    match instr:
+        case (
+            Push()
+            | ClosureNew()
+            | StringFormat()
+            | BinaryOp()
+            | IntBinaryOp()
+            | FloatBinaryOp()
+            | StringConcat()
+            | UnaryOp()
+            | Compare()
+            | NumberCompare()
+            | Index()
+            | ArraySlice()
+            | PushCall()
+            | PushTailCall()
+        ):
+            return 0, 1
+        case ArrayPush():
+            return 1, 0
+        case Call(_, n_args) | TailCall(_, n_args):
+            return n_args, 1
+        case Pop(n) | StorePop(n=n):
+            return n, 0
+        case (
+            ArrayExtend()
+            | Assert()
+            | LocalJump()
+            | Jump()
+            | Switch()
+            | MatchArray()
+            | Fail()
+            | Return()
+            | Store()
+            | CaptureSet()
+            | PushArrayPush()
+        ):
+            return 0, 0
+    raise NotImplementedError(f"`stack_effect({type(instr).__name__})`")
+
+
+def operands(instr: Instr):
+    """Iterate over `(ref, mutated)` for the `Ref` operands of an instruction
+
+    The captures of a `ClosureNew` are operands read from the enclosing frame.
+    """
+    if isinstance(instr, ClosureNew):
+        for ref in instr.spec.capture_indices:
+            yield ref, False
+        return
+    for f in fields(instr):
+        if (type(instr), f.name) in WRITTEN:
+            continue
+        value = getattr(instr, f.name)
+        mutated = (type(instr), f.name) in MUTATED
+        if isinstance(value, Ref):
+            yield value, mutated
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, Ref):
+                    yield item, mutated
+
+
+def nested_specs(spec: ClosureSpec) -> Iterable[ClosureSpec]:
+    """Specs the code of a spec makes closures of: with `ClosureNew`, or as literal closures, immediate or constant"""
+    for instr in spec.code:
+        if isinstance(instr, ClosureNew):
+            yield instr.spec
+        for ref, _ in operands(instr):
+            value = ref.value if isinstance(ref, Imm) else None
+            if isinstance(ref, Const) and ref.index < len(spec.constants):
+                value = spec.constants[ref.index]
+            if isinstance(value, Closure):
+                yield value.spec
+
+
+def map_operands(instr: Instr, f: Callable[[Ref], Ref], written: bool = True) -> Instr:
+    """Replace every `Ref` operand `ref` of an instruction with `f(ref)`
+
+    Operands the instruction only writes to are left alone unless `written` is set. Returns `instr` itself when nothing changes.
+    """
+    if isinstance(instr, ClosureNew):
+        captures = [f(ref) for ref in instr.spec.capture_indices]
+        if all(a is b for a, b in zip(captures, instr.spec.capture_indices)):
+            return instr
+        return ClosureNew(replace(instr.spec, capture_indices=captures))
+    changes = {}
+    for fl in fields(instr):
+        if not written and (type(instr), fl.name) in WRITTEN:
+            continue
+        value = getattr(instr, fl.name)
+        if isinstance(value, Ref):
+            if (new := f(value)) is not value:
+                changes[fl.name] = new
+        elif isinstance(value, list) and any(isinstance(item, Ref) for item in value):
+            new = [f(item) if isinstance(item, Ref) else item for item in value]
+            if any(a is not b for a, b in zip(value, new)):
+                changes[fl.name] = new
+    return replace(instr, **changes) if changes else instr
+
+
+def successors(code: list[Instr], i: int) -> list[int]:
+    """Instructions that may run after `code[i]`; `len(code)` is the exit of the code object"""
+    match code[i]:
+        case Return():
+            return [len(code)]
+        case LocalJump(_, dest) | MatchArray(_, _, dest):
+            return [i + 1, dest]
+        case Jump(dest):
+            return [dest]
+        case Switch(_, cases, default):
+            return list(dict.fromkeys([*cases.values(), default]))
+        case Fail():
+            return []
+    return [i + 1]
+
+
+def predecessors(code: list[Instr]) -> list[list[int]]:
+    preds = [[] for _ in range(len(code) + 1)]
+    for i in range(len(code)):
+        for j in successors(code, i):
+            preds[j].append(i)
+    return preds
+
+
+def depths(code: list[Instr]) -> list[Optional[int]]:
+    """Stack depth before each instruction, and at the exit; `None` for unreachable instructions
+
+    Raises:
+        CompileError: Two paths reach the same instruction with different stack depths
+    """
+    depth = [None] * (len(code) + 1)
+    depth[0] = 0
+    worklist = [0]
+    while worklist:
+        i = worklist.pop()
+        if i == len(code):
+            continue
+        pops, pushes = stack_effect(code[i])
+        after = depth[i] - pops + pushes
+        for j in successors(code, i):
+            if depth[j] is None:
+                depth[j] = after
+                worklist.append(j)
+            elif depth[j] != after:
+                raise CompileError(
+                    f"Stack depth {depth[j]} != {after} at instruction {j}"
+                )
+    return depth
+
+
+def implicit_uses(code: list[Instr], i: int, depth: int) -> range:
+    """Slots read by an instruction without naming them
+
+    Calls consume their arguments from the top of the stack, and the value on top of the stack when the code exits is its return value.
+    """
+    if i == len(code):
+        return range(depth - 1, depth)
+    match code[i]:
+        case Call(_, n_args) | TailCall(_, n_args):
+            return range(depth - n_args, depth)
+        case ArrayPush() | Return():
+            return range(depth - 1, depth)
+    return range(0)
+
+
+def defs(code: list[Instr], i: int, depth: int) -> range:
+    """Stack slots an instruction gives a new value"""
+    match code[i]:
+        case Store(dest) | StorePop(dest):
+            return range(dest.index, dest.index + 1)
+    pops, pushes = stack_effect(code[i])
+    return range(depth - pops, depth - pops + pushes)
+
+
+def uses(code: list[Instr], i: int, depth: int) -> set[int]:
+    """Stack slots read or written through by an instruction"""
+    out = set(implicit_uses(code, i, depth))
+    if i < len(code):
+        for ref, _ in operands(code[i]):
+            if isinstance(ref, Stack):
+                out.add(ref.index if ref.index >= 0 else depth + ref.index)
+    return out
+
+
+def liveness(code: list[Instr], depth: list[Optional[int]]) -> list[set[int]]:
+    """Stack slots whose current value may still be used after each instruction"""
+    n = len(code)
+    live_in = [set() for _ in range(n + 1)]
+    live_out = [set() for _ in range(n + 1)]
+    if depth[n] is not None:
+        live_in[n] = uses(code, n, depth[n])
+    preds = predecessors(code)
+
+    worklist = [i for i in range(n) if depth[i] is not None]
+    while worklist:
+        i = worklist.pop()
+        out = set()
+        for j in successors(code, i):
+            out |= live_in[j]
+        pops, _ = stack_effect(code[i])
+        written = defs(code, i, depth[i])
+        popped = range(depth[i] - pops, depth[i])
+        new_in = uses(code, i, depth[i]) | {
+            slot for slot in out if slot not in written and slot not in popped
+        }
+        live_out[i] = out
+        if new_in != live_in[i]:
+            live_in[i] = new_in
+            worklist.extend(p for p in preds[i] if depth[p] is not None)
+    return live_out
+
+
+def reaching_defs(
+    code: list[Instr], depth: list[Optional[int]]
+) -> list[dict[int, frozenset[int]]]:
+    """For each instruction, the instructions that may have pushed the value in each stack slot"""
+    n = len(code)
+    reach: list[Optional[dict]] = [None] * (n + 1)
+    reach[0] = {}
+    worklist = [0]
+    while worklist:
+        i = worklist.pop()
+        if i == n:
+            continue
+        pops, pushes = stack_effect(code[i])
+        state = {
+            slot: sources for slot, sources in reach[i].items() if slot < depth[i] - pops
+        }
+        for slot in defs(code, i, depth[i]):
+            state[slot] = frozenset([i])
+        for j in successors(code, i):
+            if reach[j] is None:
+                reach[j] = state
+                worklist.append(j)
+                continue
+            merged = {
+                slot: reach[j].get(slot, frozenset()) | state.get(slot, frozenset())
+                for slot in reach[j].keys() | state.keys()
+            }
+            if merged != reach[j]:
+                reach[j] = merged
+                worklist.append(j)
+    return [state if state is not None else {} for state in reach]
+
+
+def retarget(instr: Instr, f: Callable[[int], int]) -> Instr:
+    """Replace every jump destination `dest` of an instruction with `f(dest)`"""
+    match instr:
+        case LocalJump() | Jump() | MatchArray():
+            return replace(instr, dest=f(instr.dest))
+        case Switch(_, cases, default):
+            return replace(
+                instr, cases={key: f(dest) for key, dest in cases.items()}, default=f(default)
+            )
+    return instr
+
+
+def compact(code: list[Optional[Instr]]) -> list[Instr]:
+    """Drop the `None` entries from an instruction list and retarget jumps"""
+    index = []
+    n = 0
+    for instr in code:
+        index.append(n)
+        if instr is not None:
+            n += 1
+    index.append(n)
+
+    return [retarget(instr, index.__getitem__) for instr in code if instr is not None]
+
+
+def _forwardable(ref: Ref) -> bool:
+    """Can a read of a slot holding `ref` read `ref` directly instead?"""
+    if isinstance(ref, (Arg, Cap)):
+        return True
+    # Shared mutable constants must stay behind their own slot
+    return isinstance(ref, Imm) and not isinstance(ref.value, Array)
+
+
+def rewrite_operands(code: list[Instr]) -> tuple[list[Instr], bool]:
+    """Drop asserts of values known to be true, stores that would not change their slot and jumps to the next instruction, and read pushed arguments, captures and constants directly
+
+    Neither changes the stack layout; the pushes left without readers are removed by `remove_dead_pushes`.
+    """
+    depth = depths(code)
+    reach = reaching_defs(code, depth)
+
+    # def index -> [(reader index, can the operand be replaced?)]
+    readers = defaultdict(list)
+    for j in range(len(code) + 1):
+        if depth[j] is None:
+            continue
+        if j < len(code):
+            for ref, mutated in operands(code[j]):
+                if isinstance(ref, Stack):
+                    defs = reach[j].get(ref.index, frozenset())
+                    for i in defs:
+                        readers[i].append((j, not mutated and len(defs) == 1))
+        for slot in implicit_uses(code, j, depth[j]):
+            for i in reach[j].get(slot, ()):
+                readers[i].append((j, False))
+
+    def known(j: int, ref: Ref):
+        if isinstance(ref, Imm):
+            return ref.value
+        if isinstance(ref, Stack):
+            defs = reach[j].get(ref.index, frozenset())
+            if len(defs) == 1 and isinstance(instr := code[next(iter(defs))], Push):
+                if isinstance(instr.value, Imm):
+                    return instr.value.value
+
+    def holds(j: int, slot: int, ref: Ref) -> bool:
+        """Does `slot` already hold the value of `ref` before instruction `j`?"""
+        defs = reach[j].get(slot, frozenset())
+        if len(defs) != 1 or depth[j] is None:
+            return False
+        source = code[next(iter(defs))]
+        if _forwardable(ref):
+            return isinstance(source, (Push, Store)) and source.value == ref
+        if isinstance(ref, Stack):
+            # `ref` is a copy of `slot` made while `slot` had its current value
+            copies = reach[j].get(ref.index, frozenset())
+            if len(copies) == 1 and code[q := next(iter(copies))] == Push(Stack(slot)):
+                return reach[q].get(slot) == defs
+        return False
+
+    out: list[Optional[Instr]] = list(code)
+    changed = False
+    for j, instr in enumerate(code):
+        if isinstance(instr, Assert) and known(j, instr.value) == Bool(True):
+            out[j] = None
+            changed = True
+        elif isinstance(instr, Store) and holds(j, instr.dest.index, instr.value):
+            out[j] = None
+            changed = True
+        elif isinstance(instr, Jump) and instr.dest == j + 1:
+            out[j] = None
+            changed = True
+
+    for i, instr in enumerate(code):
+        if not (isinstance(instr, Push) and _forwardable(instr.value)):
+            continue
+        match readers[i]:
+            case [(j, True)] if out[j] is not None:
+                slot = Stack(depth[i])
+                out[j] = map_operands(
+                    out[j], lambda r: instr.value if r == slot else r, written=False
+                )
+                changed = True
+
+    return compact(out), changed
+
+
+def _region(code, depth, preds, i) -> Optional[set[int]]:
+    """Instructions during which the value pushed by `code[i]` is on the stack
+
+    Returns `None` if any of them can also be reached without running `code[i]` first, or stores into the slot, in which case the push cannot be removed on its own.
+    """
+    slot = depth[i]
+    region = set()
+    worklist = successors(code, i)
+    while worklist:
+        j = worklist.pop()
+        if j in region or depth[j] is None or depth[j] <= slot:
+            continue
+        region.add(j)
+        if j < len(code):
+            worklist.extend(successors(code, j))
+    for j in region:
+        if any(p != i and p not in region for p in preds[j]):
+            return None
+        if j < len(code) and slot in defs(code, j, depth[j]):
+            return None
+    return region
+
+
+def remove_dead_pushes(code: list[Instr]) -> tuple[list[Instr], bool]:
+    """Remove side-effect free pushes whose value is never used, renumbering the slots above them"""
+    depth = depths(code)
+    live_out = liveness(code, depth)
+    preds = predecessors(code)
+
+    dead = set()
+    # instruction index -> removed slots that are on the stack before it
+    removed = defaultdict(list)
+    for i, instr in enumerate(code):
+        if depth[i] is None:
+            continue
+        if isinstance(instr, Store) and instr.dest.index not in live_out[i]:
+            dead.add(i)
+            continue
+        if not isinstance(instr, (Push, ClosureNew)):
+            continue
+        if depth[i] in live_out[i]:
+            continue
+        if (region := _region(code, depth, preds, i)) is None:
+            continue
+        dead.add(i)
+        for j in region:
+            removed[j].append(depth[i])
+
+    if not dead:
+        return code, False
+
+    out: list[Optional[Instr]] = []
+    for j, instr in enumerate(code):
+        if j in dead:
+            out.append(None)
+            continue
+        if slots := removed.get(j):
+
+            def shift(ref):
+                if isinstance(ref, Stack):
+                    return Stack(ref.index - sum(1 for slot in slots if slot < ref.index))
+                return ref
+
+            instr = map_operands(instr, shift)
+            if isinstance(instr, Pop):
+                n = instr.n - sum(1 for slot in slots if slot >= depth[j] - instr.n)
+                instr = Pop(n) if n else None
+        out.append(instr)
+    return compact(out), True
+
+
+def optimize_code(code: list[Instr]) -> list[Instr]:
+    """Run the peephole rewrites over an instruction list until none of them apply"""
+    while True:
+        code, rewritten = rewrite_operands(code)
+        code, removed = remove_dead_pushes(code)
+        if not (rewritten or removed):
+            return code
+
+
+@dataclass
+class Report(Format):
+    """Instruction counts before and after optimization, summed over every distinct `ClosureSpec`"""
+
+    before: int = 0
+    after: int = 0
+    specs: int = 0
+
+    def __str__(self):
+        return f"peephole: {self.before} -> {self.after} instructions in {self.specs} code objects"
+
+
+def optimize_spec(spec: ClosureSpec, report: Optional[Report] = None, seen=None) -> Report:
+    """Optimize a spec and the specs nested in it, in place"""
+    if report is None:
+        report = Report()
+    if seen is None:
+        seen = set()
+    if id(spec.code) in seen:
+        return report
+    seen.add(id(spec.code))
+
+    for nested in nested_specs(spec):
+        optimize_spec(nested, report, seen)
+
+    report.before += len(spec.code)
+    spec.code[:] = optimize_code(spec.code)
+    spec.invalidate()
+    report.after += len(spec.code)
+    report.specs += 1
+    return report
+
+
+def optimize(closure: Closure) -> Report:
+    """Optimize the code of a compiled closure in place"""
+    return optimize_spec(closure.spec)
@@ -0,0 +1,195 @@
+"""Pass manager
+
+Passes are registered under a name with the kind of program they rewrite, either the syntax tree before code generation or the compiled closure after it, and with the names of the passes they must run after when both are enabled. A `Pipeline` orders the passes it is given, runs them, and records the time each one took and the size of the program before and after it, in tree nodes or in instructions. In debug mode it also checks the invariants of the code after code generation and after every code pass, see `verify`.
+"""
+
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Iterable
+
+from errors import CompileError
+from instr import Arg, Cap, Const, Stack, Store, StorePop
+from mixins import Format
+from peephole import depths, nested_specs, operands, stack_effect, successors
+from tree import walk
+from value import Closure, ClosureSpec
+
+TREE = "tree"
+CODE = "code"
+
+
+@dataclass
+class Pass(Format):
+    name: str
+    kind: str
+    # Tree passes return the new tree, code passes rewrite the closure in place
+    run: Callable
+    # Passes this one runs after, when they are part of the same pipeline
+    after: tuple[str, ...] = ()
+    help: str = ""
+
+
+REGISTRY: dict[str, Pass] = {}
+
+
+def register(name: str, kind: str, run: Callable, after: tuple[str, ...] = (), help: str = "") -> Pass:
+    """Make a pass available to pipelines; registration order breaks ties between independent passes"""
+    if kind not in (TREE, CODE):
+        raise ValueError(f"Unknown pass kind {kind!r}")
+    REGISTRY[name] = Pass(name, kind, run, after, help)
+    return REGISTRY[name]
+
+
+def order(names: Iterable[str]) -> list[Pass]:
+    """The registered passes of the given names, each after the passes it depends on
+
+    Raises:
+        CompileError: A pass is not registered, or the dependencies form a cycle
+    """
+    names = set(names)
+    for name in names:
+        if name not in REGISTRY:
+            raise CompileError(f"Unknown pass {name!r}")
+    out: list[Pass] = []
+    done: set[str] = set()
+    visiting: set[str] = set()
+
+    def visit(p: Pass):
+        if p.name in done:
+            return
+        if p.name in visiting:
+            raise CompileError(f"Pass dependency cycle through {p.name!r}")
+        visiting.add(p.name)
+        for dependency in p.after:
+            if dependency in names:
+                visit(REGISTRY[dependency])
+        visiting.remove(p.name)
+        done.add(p.name)
+        out.append(p)
+
+    for p in REGISTRY.values():
+        if p.name in names:
+            visit(p)
+    return out
+
+
+def code_size(spec: ClosureSpec, seen=None) -> int:
+    """Number of instructions in a spec and the specs nested in it"""
+    if seen is None:
+        seen = set()
+    if id(spec.code) in seen:
+        return 0
+    seen.add(id(spec.code))
+    return len(spec.code) + sum(code_size(nested, seen) for nested in nested_specs(spec))
+
+
+def tree_size(tree) -> int:
+    """Number of nodes in a tree or a list of statements"""
+    nodes = tree if isinstance(tree, list) else [tree]
+    return sum(1 for node in nodes for _ in walk(node))
+
+
+def verify_spec(spec: ClosureSpec, seen=None):
+    """Check the code of a spec and of the specs nested in it
+
+    Jumps stay within the code, every path reaches an instruction with the same stack depth, no instruction pops more than the stack holds, and every operand is in range: stack slots below the depth, and arguments, captures and constants within those of the spec.
+
+    Raises:
+        CompileError: The code breaks an invariant
+    """
+    if seen is None:
+        seen = set()
+    if id(spec.code) in seen:
+        return
+    seen.add(id(spec.code))
+    code = spec.code
+
+    def fail(i: int, message: str):
+        raise CompileError(f"Invalid code at instruction {i} ({code[i]}): {message}")
+
+    for i in range(len(code)):
+        for j in successors(code, i):
+            if not 0 <= j <= len(code):
+                fail(i, f"jump target {j} out of range")
+    depth = depths(code)
+    limits = {Arg: spec.n_args, Cap: len(spec.capture_indices), Const: len(spec.constants)}
+    for i, instr in enumerate(code):
+        if depth[i] is None:
+            continue
+        pops, _ = stack_effect(instr)
+        if pops > depth[i]:
+            fail(i, f"pops {pops} values from a stack of {depth[i]}")
+        refs = [ref for ref, _ in operands(instr)]
+        if isinstance(instr, (Store, StorePop)):
+            refs.append(instr.dest)
+        for ref in refs:
+            if isinstance(ref, Stack) and not 0 <= ref.index < depth[i]:
+                fail(i, f"stack slot {ref.index} at depth {depth[i]}")
+            if type(ref) in limits and not 0 <= ref.index < limits[type(ref)]:
+                fail(i, f"{type(ref).__name__.lower()} {ref.index} out of range")
+    for nested in nested_specs(spec):
+        verify_spec(nested, seen)
+
+
+def verify(closure: Closure):
+    """Check the invariants of the code of a compiled closure, see `verify_spec`"""
+    verify_spec(closure.spec)
+
+
+@dataclass
+class PassStats(Format):
+    name: str
+    seconds: float
+    # Tree nodes for tree passes, instructions for code passes
+    before: int
+    after: int
+
+    def __str__(self):
+        return f"{self.name:20} {self.seconds * 1000:9.3f} ms {self.before:8} -> {self.after}"
+
+
+@dataclass
+class PipelineReport(Format):
+    passes: list[PassStats] = field(default_factory=list)
+
+    def __str__(self):
+        return "\n".join(str(stats) for stats in self.passes)
+
+
+class Pipeline:
+    """Runs passes in dependency order, recording their cost and effect"""
+
+    def __init__(self, names: Iterable[str] = (), debug: bool = False):
+        self.passes = order(names)
+        self.debug = debug
+        self.report = PipelineReport()
+
+    def __contains__(self, name: str) -> bool:
+        return any(p.name == name for p in self.passes)
+
+    def run_tree(self, tree):
+        """Run the tree passes on a tree or a list of statements"""
+        for p in self.passes:
+            if p.kind == TREE:
+                before = tree_size(tree)
+                start = time.perf_counter()
+                tree = p.run(tree)
+                self.report.passes.append(PassStats(p.name, time.perf_counter() - start, before, tree_size(tree)))
+        return tree
+
+    def run_code(self, closure: Closure):
+        """Run the code passes on a compiled closure, in place"""
+        if self.debug:
+            verify(closure)
+        for p in self.passes:
+            if p.kind == CODE:
+                before = code_size(closure.spec)
+                start = time.perf_counter()
+                p.run(closure)
+                elapsed = time.perf_counter() - start
+                self.report.passes.append(PassStats(p.name, elapsed, before, code_size(closure.spec)))
+                if self.debug:
+                    try:
+                        verify(closure)
+                    except CompileError as e:
+                        raise CompileError(f"After pass {p.name!r}: {e}") from e
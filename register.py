@@ -0,0 +1,157 @@
+"""Instruction set of the register machine
+
+Each instruction names its operands and the register it writes directly, so an operation is one dispatch instead of pushes followed by the operation. Operands are `Ref`s as in `instr.py`, with `Reg` in place of `Stack`. Code for it is produced from SSA form by `ssa.registers` and run by `regvm.py`.
+"""
+
+from dataclasses import dataclass
+
+from instr import Ref, Reg
+from mixins import Format, GetChildren
+from value import ClosureSpec
+
+
+@dataclass
+class RegisterSpec(ClosureSpec):
+    """Code object of the register machine; frames have `n_regs` registers"""
+
+    n_regs: int = 0
+
+
+@dataclass
+class RegInstr(Format, GetChildren):
+    def short(self):
+        return f"RegInstr.{type(self).__name__}"
+
+
+@dataclass
+class Move(RegInstr):
+    dest: Reg
+    value: Ref
+
+
+@dataclass
+class Binary(RegInstr):
+    dest: Reg
+    op: str
+    left: Ref
+    right: Ref
+
+
+@dataclass
+class Unary(RegInstr):
+    dest: Reg
+    op: str
+    inner: Ref
+
+
+@dataclass
+class Compare(RegInstr):
+    dest: Reg
+    ops: list[str]
+    operands: list[Ref]
+
+
+@dataclass
+class Concat(RegInstr):
+    """String interpolation, converting each piece with `ops.to_string`"""
+
+    dest: Reg
+    pieces: list[Ref]
+
+
+@dataclass
+class NewArray(RegInstr):
+    dest: Reg
+
+
+@dataclass
+class Append(RegInstr):
+    array: Ref
+    value: Ref
+
+
+@dataclass
+class Extend(RegInstr):
+    array: Ref
+    value: Ref
+
+
+@dataclass
+class Index(RegInstr):
+    dest: Reg
+    array: Ref
+    index: int
+
+
+@dataclass
+class Slice(RegInstr):
+    dest: Reg
+    array: Ref
+    skip_front: int
+    skip_back: int
+
+
+@dataclass
+class MakeClosure(RegInstr):
+    """Create a closure of `spec`, whose `capture_indices` are resolved in the current frame"""
+
+    dest: Reg
+    spec: RegisterSpec
+
+
+@dataclass
+class SetCapture(RegInstr):
+    closure: Ref
+    index: int
+    value: Ref
+
+
+@dataclass
+class Call(RegInstr):
+    dest: Reg
+    closure: Ref
+    args: list[Ref]
+
+
+@dataclass
+class TailCall(RegInstr):
+    """Call in tail position, reusing the frame of the caller"""
+
+    closure: Ref
+    args: list[Ref]
+
+
+@dataclass
+class Jump(RegInstr):
+    dest: int
+
+
+@dataclass
+class Switch(RegInstr):
+    """Jump to `cases[ops.switch_key(value)]`, or to `default` if the key is missing"""
+
+    value: Ref
+    cases: dict
+    default: int
+
+
+@dataclass
+class MatchArray(RegInstr):
+    """Jump to `dest` unless `array` is an array of at least `lower_bound` items"""
+
+    array: Ref
+    lower_bound: int
+    dest: int
+
+
+@dataclass
+class Fail(RegInstr):
+    reason: str
+
+
+@dataclass
+class Return(RegInstr):
+    value: Ref
+
+
+RegInstr.get_children()
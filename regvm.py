@@ -0,0 +1,176 @@
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+import ops
+from errors import VmError
+from instr import Arg, Cap, Imm, Ref, Reg
+from mixins import Format
+from register import (
+    Append,
+    Binary,
+    Call,
+    Compare,
+    Concat,
+    Extend,
+    Fail,
+    Index,
+    Jump,
+    MakeClosure,
+    MatchArray,
+    Move,
+    NewArray,
+    Return,
+    SetCapture,
+    Slice,
+    Switch,
+    TailCall,
+    Unary,
+)
+from value import Array, Closure, String, Value
+from compile import compile
+
+
+@dataclass
+class RegisterFrame(Format):
+    closure: Closure
+    args: list[Any]
+    regs: list[Any] = field(default_factory=list)
+
+    def positional(self):
+        yield self.closure
+        yield self.args
+        yield from self.regs
+
+
+@dataclass
+class RegisterVm(Format):
+    stack: list[RegisterFrame] = field(default_factory=list)
+
+    def positional(self):
+        yield from self.stack
+
+    @property
+    def frame(self) -> RegisterFrame:
+        return self.stack[-1]
+
+    def resolve(self, ref: Ref) -> Value:
+        match ref:
+            case Reg(index):
+                return self.frame.regs[index]
+
+            case Arg(index):
+                return self.frame.args[index]
+
+            case Cap(index):
+                return self.frame.closure.captures[index]
+
+            case Imm(value):
+                return value
+
+            case _:
+                raise NotImplementedError(f"`RegisterVm.resolve({type(ref).__name__})`")
+
+    def set(self, reg: Reg, value: Value):
+        self.frame.regs[reg.index] = value
+
+    def run(self, closure: Closure, args: Optional[list[Value]] = None) -> Value:
+        if not self.stack:
+            assert closure.spec.n_args == 0, "First closure run must not have arguments"
+        self.stack.append(RegisterFrame(closure, args or [], [None] * closure.spec.n_regs))
+        code = closure.spec.code
+
+        ip = 0
+        while True:
+            instr = code[ip]
+            match instr:
+                case Move(dest, value_ref):
+                    self.set(dest, self.resolve(value_ref))
+
+                case Binary(dest, op, left_ref, right_ref):
+                    self.set(dest, ops.binary(op, self.resolve(left_ref), self.resolve(right_ref)))
+
+                case Unary(dest, op, inner_ref):
+                    self.set(dest, ops.unary(op, self.resolve(inner_ref)))
+
+                case Compare(dest, names, operand_refs):
+                    self.set(dest, ops.compare(names, [self.resolve(ref) for ref in operand_refs]))
+
+                case Concat(dest, piece_refs):
+                    pieces = [ops.to_string(self.resolve(ref)) for ref in piece_refs]
+                    self.set(dest, String("".join(pieces)))
+
+                case NewArray(dest):
+                    self.set(dest, Array([]))
+
+                case Append(array_ref, value_ref):
+                    self.resolve(array_ref).values.append(self.resolve(value_ref))
+
+                case Extend(array_ref, value_ref):
+                    self.resolve(array_ref).values.extend(self.resolve(value_ref).values)
+
+                case Index(dest, array_ref, index):
+                    self.set(dest, self.resolve(array_ref).values[index])
+
+                case Slice(dest, array_ref, skip_front, skip_back):
+                    values = self.resolve(array_ref).values
+                    self.set(dest, Array(values[skip_front : len(values) - skip_back]))
+
+                case MakeClosure(dest, spec):
+                    captures = [self.resolve(ref) for ref in spec.capture_indices]
+                    self.set(dest, Closure(spec, captures))
+
+                case SetCapture(closure_ref, index, value_ref):
+                    self.resolve(closure_ref).captures[index] = self.resolve(value_ref)
+
+                case Call(dest, closure_ref, arg_refs):
+                    callee = self.resolve(closure_ref)
+                    args = [self.resolve(ref) for ref in arg_refs]
+                    self.set(dest, self.run(callee, args))
+
+                case TailCall(closure_ref, arg_refs):
+                    # Replace the running closure in the current frame instead of nesting a new one
+                    closure = self.resolve(closure_ref)
+                    frame = self.frame
+                    frame.args = [self.resolve(ref) for ref in arg_refs]
+                    frame.closure = closure
+                    frame.regs = [None] * closure.spec.n_regs
+                    code = closure.spec.code
+                    ip = 0
+                    continue
+
+                case Jump(dest):
+                    ip = dest
+                    continue
+
+                case Switch(value_ref, cases, default):
+                    ip = cases.get(ops.switch_key(self.resolve(value_ref)), default)
+                    continue
+
+                case MatchArray(array_ref, lower_bound, dest):
+                    match self.resolve(array_ref):
+                        case Array(values) if len(values) >= lower_bound:
+                            pass
+                        case _:
+                            ip = dest
+                            continue
+
+                case Fail(reason):
+                    raise VmError(reason)
+
+                case Return(value_ref):
+                    value = self.resolve(value_ref)
+                    self.stack.pop()
+                    return value
+
+                case _:
+                    raise NotImplementedError(
+                        f"`RegisterVm.run` missing case for instruction: {instr}"
+                    )
+
+            ip += 1
+
+
+def run(code: str | Closure) -> Value:
+    if isinstance(code, str):
+        code = compile(code, registers=True)
+    return RegisterVm().run(code)
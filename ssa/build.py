@@ -0,0 +1,526 @@
+"""Construction of SSA form from syntax trees
+
+Names are looked up in a stack of scopes mapping them to the `Var` holding their value, so rebinding a name never overwrites a value. Match expressions and refutable lets go through the same decision trees as `compile.Compiler`. Every arm gets a block with one phi per bound name, and the arms meet in a join block with a phi for the result.
+
+Assignment gives a name a new `Var` in the scope that binds it. Where control flow merges, names assigned on the way get a phi when their values differ: in the join block of a match, in the header of a loop for the values at entry and at every `continue`, and in the exit of a loop for the values at every `break`.
+"""
+
+from dataclasses import dataclass, field
+from typing import Optional
+
+import decision
+import ops
+from comb import Span
+from errors import CompileError
+from tree import (
+    ArrayExpr,
+    AssignStatement,
+    BinaryExpr,
+    BlockExpr,
+    BreakStatement,
+    CallExpr,
+    ComparisonExpr,
+    ConstExpr,
+    ContinueStatement,
+    Expr,
+    ExprStatement,
+    FloatExpr,
+    FnExpr,
+    FnStatement,
+    IdExpr,
+    IdPattern,
+    IntExpr,
+    LetStatement,
+    LoopExpr,
+    LoopStatement,
+    MatchExpr,
+    MatchStatement,
+    ParenExpr,
+    Pattern,
+    Spread,
+    Statement,
+    StringExpr,
+    TagExpr,
+    SyntaxNode,
+    UnaryExpr,
+    free,
+    walk,
+)
+from value import UNIT, Float, Int, String, Tag
+
+from ssa.ssa import (
+    ArrayExtend,
+    ArrayPush,
+    BinOp,
+    Block,
+    Call,
+    Capture,
+    Cmp,
+    Concat,
+    Const,
+    Fail,
+    Function,
+    Index,
+    Jump,
+    MakeClosure,
+    MatchArray,
+    NewArray,
+    Op,
+    Param,
+    Phi,
+    Return,
+    SetCapture,
+    Slice,
+    Switch,
+    UnOp,
+    Var,
+)
+
+
+@dataclass
+class Loop:
+    """A loop being built, which `break` and `continue` jump out of"""
+
+    label: Optional[str]
+    header: Block
+    # The names assigned in the body, each with a phi in the header
+    names: list[str]
+    # For each `break`: its block, the value of the loop and the values of `names`
+    breaks: list[tuple[Block, Var, list[Var]]] = field(default_factory=list)
+
+
+def assigned(nodes: list[SyntaxNode]) -> list[str]:
+    """Every name assigned to anywhere in the trees, in order of first assignment"""
+    return list(
+        dict.fromkeys(
+            name
+            for root in nodes
+            for node in walk(root)
+            if isinstance(node, AssignStatement)
+            for name in node.pattern.bound()
+        )
+    )
+
+
+class Builder:
+    def __init__(self, function: Function):
+        self.function = function
+        self.block: Optional[Block] = function.block()
+        self.scopes: list[dict[str, Var]] = [{}]
+        self.loops: list[Loop] = []
+
+    def emit(self, op: Op) -> Optional[Var]:
+        """Append an instruction to the current block"""
+        if op.terminator:
+            self.block.terminator = op
+            self.block = None
+        else:
+            self.block.ops.append(op)
+        return op.result
+
+    def var(self) -> Var:
+        return self.function.var()
+
+    def bind(self, name: str, var: Var):
+        self.scopes[-1][name] = var
+
+    def lookup(self, name: str) -> Var:
+        for scope in reversed(self.scopes):
+            if name in scope:
+                return scope[name]
+        raise KeyError(f"Undefined reference to {name}")
+
+    def assign(self, name: str, var: Var):
+        """Give a new value to a name in the scope that binds it"""
+        for scope in reversed(self.scopes):
+            if name in scope:
+                scope[name] = var
+                return
+        raise KeyError(f"Undefined reference to {name}")
+
+    def visible(self, names: list[str]) -> list[str]:
+        """The names bound in some scope"""
+        return [name for name in names if any(name in scope for scope in self.scopes)]
+
+    def merge(self, names: list[str], block: Block, incoming: dict[Block, list[Var]]):
+        """Assign each name its value when control arrives at `block` from each predecessor, through a phi if they differ"""
+        for i, name in enumerate(names):
+            values = {pred: env[i] for pred, env in incoming.items()}
+            if len(set(values.values())) == 1:
+                self.assign(name, next(iter(values.values())))
+            elif values:
+                phi = Phi(self.var(), values)
+                block.phis.append(phi)
+                self.assign(name, phi.dest)
+
+    def loop(self, label: Optional[Span], keyword: str) -> Loop:
+        """The loop a `break` or `continue` with this label leaves
+
+        Raises:
+            CompileError: There is no such loop in the function being built
+        """
+        for loop in reversed(self.loops):
+            if label is None or loop.label == label.str():
+                return loop
+        if label is None:
+            raise CompileError(f"`{keyword}` outside of a loop")
+        raise CompileError(f"`{keyword}` to undefined loop label {label.str()}")
+
+    def back_edge(self, loop: Loop):
+        """Jump from the current block to the header of a loop"""
+        for phi, name in zip(loop.header.phis, loop.names):
+            phi.incoming[self.block] = self.lookup(name)
+        self.emit(Jump(loop.header))
+
+    def build_decision(
+        self, tree: decision.Tree, subject: Var, names: list[list[str]], reason: str
+    ) -> dict[int, Block]:
+        """Build a decision tree over `subject`
+
+        Returns:
+            dict[int, Block]: The block entered when each pattern matches, with a phi for each of the names it binds, in the order of `names`. Patterns the tree never chooses are missing.
+        """
+        targets = {}
+
+        def load(occurrence: decision.Occurrence, loaded: dict) -> Var:
+            if (var := loaded.get(occurrence)) is not None:
+                return var
+            parent = load(occurrence.parent, loaded)
+            if occurrence.gather is not None:
+                op = Slice(self.var(), parent, *occurrence.gather)
+            else:
+                op = Index(self.var(), parent, occurrence.index)
+            loaded[occurrence] = var = self.emit(op)
+            return var
+
+        def build(tree: decision.Tree, loaded: dict):
+            match tree:
+                case decision.Leaf(arm, bindings):
+                    values = [load(bindings[name], loaded) for name in names[arm]]
+                    if arm not in targets:
+                        target = targets[arm] = self.function.block()
+                        target.phis = [Phi(self.var()) for _ in names[arm]]
+                    for phi, value in zip(targets[arm].phis, values):
+                        phi.incoming[self.block] = value
+                    self.emit(Jump(targets[arm]))
+
+                case decision.Failure():
+                    self.emit(Fail(reason))
+
+                case decision.Branch(occurrence, cases, default):
+                    op = Switch(load(occurrence, loaded), {}, None)
+                    self.emit(op)
+                    for key, case in cases.items():
+                        self.block = op.cases[key] = self.function.block()
+                        build(case, dict(loaded))
+                    self.block = op.default = self.function.block()
+                    build(default, loaded)
+
+                case decision.LengthCheck(occurrence, length, then, otherwise):
+                    op = MatchArray(load(occurrence, loaded), length, None, None)
+                    self.emit(op)
+                    self.block = op.then = self.function.block()
+                    build(then, dict(loaded))
+                    self.block = op.otherwise = self.function.block()
+                    build(otherwise, loaded)
+
+        build(tree, {decision.Occurrence(): subject})
+        return targets
+
+    def build_statement(self, statement: Statement, tail: bool = False) -> Optional[Var]:
+        match statement:
+            case ExprStatement():
+                return self.build_expr(statement.inner, tail)
+
+            case LetStatement(pattern=IdPattern(inner=None)):
+                self.bind(statement.pattern.name.str(), self.build_expr(statement.inner))
+
+            case LetStatement():
+                subject = self.build_expr(statement.inner)
+                names = list(dict.fromkeys(statement.pattern.bound()))
+                tree = decision.compile_patterns([statement.pattern])
+                reason = f"Irrefutable pattern: {statement.pattern.short()}"
+                targets = self.build_decision(tree, subject, [names], reason)
+                # A pattern that can never match leaves the rest of the block unreachable
+                self.block = targets.get(0) or self.function.block()
+                for name, phi in zip(names, self.block.phis):
+                    self.bind(name, phi.dest)
+
+            case MatchStatement():
+                return self.build_expr(statement.match_expr, tail)
+
+            case LoopStatement():
+                return self.build_expr(statement.loop_expr)
+
+            case AssignStatement(pattern=IdPattern(inner=None)):
+                self.assign(statement.pattern.name.str(), self.build_expr(statement.inner))
+
+            case BreakStatement():
+                loop = self.loop(statement.label, "break")
+                if statement.inner is not None:
+                    value = self.build_expr(statement.inner)
+                else:
+                    value = self.emit(Const(self.var(), UNIT))
+                loop.breaks.append((self.block, value, [self.lookup(name) for name in loop.names]))
+                self.emit(Jump(None))
+                # The rest of the block is unreachable
+                self.block = self.function.block()
+
+            case ContinueStatement():
+                self.back_edge(self.loop(statement.label, "continue"))
+                self.block = self.function.block()
+
+            case FnStatement():
+                self.build_fn_statement(statement, {})
+
+            case _:
+                raise NotImplementedError(f"`Builder.build_statement({type(statement).__name__})`")
+
+    def build_statements(self, statements: list[Statement], tail: bool = False) -> Optional[Var]:
+        """Build a block of statements
+
+        Returns:
+            Optional[Var]: The value of the final statement, or `None` if it already returned from the function
+        """
+        self.scopes.append({})
+
+        # Function statements are in scope for the whole block, holding a placeholder until they are defined
+        for statement in statements:
+            for name in statement.early_bound():
+                self.bind(name, self.emit(Const(self.var(), UNIT)))
+        functions = {}
+
+        result = None
+        for i, statement in enumerate(statements):
+            last = i == len(statements) - 1
+            if isinstance(statement, FnStatement):
+                result = self.build_fn_statement(statement, functions)
+            else:
+                result = self.build_statement(statement, tail and last)
+        self.scopes.pop()
+
+        if self.block is None:
+            return None
+        if result is None:
+            result = self.emit(Const(self.var(), UNIT))
+        return result
+
+    def build_fn_statement(
+        self, statement: FnStatement, functions: dict[str, tuple[Var, list[str]]]
+    ) -> None:
+        """Define a function, then overwrite the captures of the placeholder for it in the functions of the block"""
+        name = statement.name.str()
+        bound = set()
+        for pat in statement.params:
+            bound.update(pat.bound())
+        captured = sorted(set(free(statement.body)) - bound)
+
+        function = build_function(statement.params, captured, statement.body)
+        closure = self.emit(MakeClosure(self.var(), function, [self.lookup(k) for k in captured]))
+        self.bind(name, closure)
+
+        functions[name] = (closure, captured)
+        for other, names in functions.values():
+            if name in names:
+                self.emit(SetCapture(other, names.index(name), closure))
+
+    def build_expr(self, expr: Expr, tail: bool = False) -> Optional[Var]:
+        """Build the expression into the current block
+
+        Args:
+            expr (Expr): The expression to build
+            tail (bool): Whether the value of the expression is returned from the enclosing function, so that match arms can return directly
+
+        Raises:
+            CompileError: Spread expression appears outside of an array literal
+            NotImplementedError: The expression type is not implemented
+
+        Returns:
+            Optional[Var]: The value of the expression, or `None` if it already returned from the function
+        """
+        match expr:
+            case IdExpr():
+                return self.lookup(expr.span.str())
+
+            case IntExpr():
+                return self.emit(Const(self.var(), Int(int(expr.span.str()))))
+
+            case TagExpr():
+                return self.emit(Const(self.var(), Tag(expr.span.str())))
+
+            case FloatExpr():
+                return self.emit(Const(self.var(), Float(float(expr.span.str()))))
+
+            case ConstExpr():
+                return self.emit(Const(self.var(), expr.value))
+
+            case StringExpr():
+                if expr.fn is not None:
+                    fn = self.build_expr(expr.fn)
+                value = self.emit(Const(self.var(), String(expr.chars[0].str())))
+                if expr.interpolants:
+                    pieces = [value]
+                    for interpolant, char in zip(expr.interpolants, expr.chars[1:]):
+                        pieces.append(self.build_expr(interpolant))
+                        pieces.append(self.emit(Const(self.var(), String(char.str()))))
+                    value = self.emit(Concat(self.var(), pieces))
+                if expr.fn is not None:
+                    return self.emit(Call(self.var(), fn, [value]))
+                return value
+
+            case ArrayExpr():
+                array = self.emit(NewArray(self.var(), len(expr.items)))
+                for item in expr.items:
+                    match item:
+                        case Spread():
+                            self.emit(ArrayExtend(array, self.build_expr(item.inner)))
+                        case _:
+                            self.emit(ArrayPush(array, self.build_expr(item)))
+                return array
+
+            case Spread():
+                raise CompileError("Spread expression outside of array literal")
+
+            case ParenExpr():
+                return self.build_expr(expr.inner, tail)
+
+            case FnExpr():
+                captured = sorted(set(expr.free()))
+                function = build_function(expr.params, captured, expr.inner)
+                captures = [self.lookup(k) for k in captured]
+                return self.emit(MakeClosure(self.var(), function, captures))
+
+            case BlockExpr():
+                return self.build_statements(expr.statements, tail)
+
+            case MatchExpr():
+                subject = self.build_expr(expr.subject)
+                patterns = [arm.pattern for arm in expr.arms]
+                names = [list(dict.fromkeys(pattern.bound())) for pattern in patterns]
+                tree = decision.compile_patterns(patterns)
+                targets = self.build_decision(tree, subject, names, "No match arm matched")
+
+                # In tail position each arm returns its own value, otherwise the arms meet in a join block
+                join = Phi(self.var())
+                # Every arm starts from the values before the match, and the join merges those it ends with
+                changed = self.visible(assigned([arm.expr for arm in expr.arms]))
+                before = [self.lookup(name) for name in changed]
+                after = {}
+                for i, arm in enumerate(expr.arms):
+                    if i not in targets:
+                        continue
+                    self.block = targets[i]
+                    for name, value in zip(changed, before):
+                        self.assign(name, value)
+                    self.scopes.append({})
+                    for name, phi in zip(names[i], self.block.phis):
+                        self.bind(name, phi.dest)
+                    value = self.build_expr(arm.expr, tail)
+                    self.scopes.pop()
+                    if self.block is None:
+                        continue
+                    if tail:
+                        self.emit(Return(value))
+                    else:
+                        join.incoming[self.block] = value
+                        after[self.block] = [self.lookup(name) for name in changed]
+                        self.emit(Jump(None))
+
+                if tail:
+                    return None
+                self.block = self.function.block()
+                self.block.phis.append(join)
+                for pred in join.incoming:
+                    pred.terminator.target = self.block
+                for name, value in zip(changed, before):
+                    self.assign(name, value)
+                self.merge(changed, self.block, after)
+                return join.dest
+
+            case LoopExpr():
+                # The names assigned in the body get a phi in the header, for their values at the entry and at every `continue`
+                names = self.visible(assigned(expr.statements))
+                header = self.function.block()
+                header.phis = [Phi(self.var(), {self.block: self.lookup(name)}) for name in names]
+                self.emit(Jump(header))
+                self.block = header
+                for name, phi in zip(names, header.phis):
+                    self.assign(name, phi.dest)
+
+                label = expr.label.str() if expr.label is not None else None
+                loop = Loop(label, header, names)
+                self.loops.append(loop)
+                self.build_statements(expr.statements)
+                if self.block is not None:
+                    self.back_edge(loop)
+                self.loops.pop()
+
+                # The value of the loop is whatever `break` leaves it with
+                self.block = self.function.block()
+                result = Phi(self.var())
+                self.block.phis.append(result)
+                for pred, value, _ in loop.breaks:
+                    pred.terminator.target = self.block
+                    result.incoming[pred] = value
+                for name, phi in zip(names, header.phis):
+                    self.assign(name, phi.dest)
+                self.merge(names, self.block, {pred: env for pred, _, env in loop.breaks})
+                return result.dest
+
+            case CallExpr():
+                fn = self.build_expr(expr.fn)
+                args = [self.build_expr(arg) for arg in expr.args]
+                return self.emit(Call(self.var(), fn, args))
+
+            case BinaryExpr():
+                op = expr.op.str()
+                if op not in ops.BINARY:
+                    raise NotImplementedError(f"`Builder.build_expr(BinaryExpr {op})`")
+                left = self.build_expr(expr.left)
+                right = self.build_expr(expr.right)
+                return self.emit(BinOp(self.var(), op, left, right))
+
+            case UnaryExpr():
+                op = expr.op.str()
+                if op not in ops.UNARY:
+                    raise NotImplementedError(f"`Builder.build_expr(UnaryExpr {op})`")
+                return self.emit(UnOp(self.var(), op, self.build_expr(expr.inner)))
+
+            case ComparisonExpr():
+                names = [op.str() for op in expr.ops]
+                for op in names:
+                    if op not in ops.COMPARE:
+                        raise NotImplementedError(f"`Builder.build_expr(ComparisonExpr {op})`")
+                operands = [self.build_expr(inner) for inner in expr.inner]
+                return self.emit(Cmp(self.var(), names, operands))
+
+            case _:
+                raise NotImplementedError(f"`Builder.build_expr({type(expr).__name__})`")
+
+
+def build_function(
+    params: list[Pattern], captured: list[str], body: Expr | list[Statement]
+) -> Function:
+    """Build the SSA form of a function body, with `captured` as its captures"""
+    function = Function(len(params), len(captured))
+    builder = Builder(function)
+    for i, name in enumerate(captured):
+        builder.bind(name, builder.emit(Capture(builder.var(), i)))
+    index = 0
+    for pat in params:
+        for name in pat.bound():
+            builder.bind(name, builder.emit(Param(builder.var(), index)))
+            index += 1
+
+    if isinstance(body, list):
+        value = builder.build_statements(body, tail=True)
+    else:
+        value = builder.build_expr(body, tail=True)
+    if builder.block is not None:
+        builder.emit(Return(value))
+    return function
+
+
+def build(input: Expr | list[Statement]) -> Function:
+    """Build the SSA form of a program"""
+    return build_function([], [], input)
@@ -0,0 +1,273 @@
+"""Lowering of SSA form to VM instructions
+
+Blocks are laid out in reverse postorder. Every value computed by an instruction gets its own stack slot, and the slots of a block start where those of its immediate dominator end, so the values a block can use are always below it on the stack. Phis take the first slots of their block. Each edge into a block with phis copies the incoming values into those slots, the same way leaves of decision trees do in `compile.Compiler.compile_decision`.
+"""
+
+from typing import Callable
+
+from instr import (
+    Arg,
+    ArraySlice,
+    Call,
+    Cap,
+    CaptureSet,
+    ClosureNew,
+    Compare,
+    BinaryOp,
+    Fail,
+    Imm,
+    Index,
+    Instr,
+    Jump,
+    MatchArray,
+    Pop,
+    Push,
+    Ref,
+    Stack,
+    Store,
+    StringFormat,
+    Switch,
+    TailCall,
+    UnaryOp,
+)
+from instr import ArrayExtend as ArrayExtendInstr, ArrayPush as ArrayPushInstr
+from value import Array, Closure, ClosureSpec, Int, String
+
+from ssa import ssa
+from ssa.passes import dominators
+
+
+class Lowering:
+    def __init__(self, function: ssa.Function):
+        self.function = function
+        self.code: list[Instr] = []
+        self.depth = 0
+        self.refs: dict[ssa.Var, Ref] = {}
+        self.labels: dict[ssa.Block, int] = {}
+        self.patches: list[tuple[ssa.Block, Callable[[int], None]]] = []
+        self.exits: list[Jump] = []
+        self.end_depth: dict[ssa.Block, int] = {}
+        self.idom = dominators(function)
+
+        # With a single return, its block goes last so that its value is simply left on top of the stack
+        self.order = function.reverse_postorder()
+        self.returns = [b for b in self.order if isinstance(b.terminator, ssa.Return)]
+        if len(self.returns) == 1:
+            self.order.remove(self.returns[0])
+            self.order.append(self.returns[0])
+
+    def emit(self, instr: Instr):
+        self.code.append(instr)
+
+    def push(self, instr: Instr) -> Stack:
+        """Emit an instruction that pushes one value"""
+        self.emit(instr)
+        self.depth += 1
+        return Stack(self.depth - 1)
+
+    def label(self, block: ssa.Block, set: Callable[[int], None]):
+        """Fill in a jump destination once the block has been placed"""
+        self.patches.append((block, set))
+
+    def base(self, block: ssa.Block) -> int:
+        """The first slot of the phis of a block"""
+        return 0 if block is self.function.entry else self.end_depth[self.idom[block]]
+
+    def needs_moves(self, source: ssa.Block, target: ssa.Block) -> bool:
+        return bool(target.phis) or self.depth != self.base(target)
+
+    def moves(self, source: ssa.Block, target: ssa.Block):
+        """Put the values of the phis of `target` for the edge from `source` into their slots, and drop everything above them"""
+        base = self.base(target)
+        refs = [self.refs[phi.incoming[source]] for phi in target.phis]
+        depth = self.depth
+        if refs != [Stack(base + i) for i in range(len(refs))]:
+            for ref in refs:
+                self.push(Push(ref))
+            if depth != base:
+                for i in range(len(refs)):
+                    self.emit(Store(Stack(base + i), Stack(depth + i)))
+            depth += len(refs)
+        if depth != base + len(refs):
+            self.emit(Pop(depth - base - len(refs)))
+        self.depth = base + len(refs)
+
+    def edge(self, source: ssa.Block, target: ssa.Block) -> Callable[[Callable[[int], None]], None]:
+        """Emit the moves of an edge out of line if it needs any, then jump to `target`
+
+        Returns a function that points a jump at the edge.
+        """
+        if not self.needs_moves(source, target):
+            return lambda set: self.label(target, set)
+        depth = self.depth
+        start = len(self.code)
+        self.moves(source, target)
+        self.jump(target)
+        self.depth = depth
+        return lambda set: set(start)
+
+    def jump(self, target: ssa.Block):
+        instr = Jump(-1)
+        self.emit(instr)
+        self.label(target, lambda dest: setattr(instr, "dest", dest))
+
+    def lower_op(self, op: ssa.Op, tail: bool):
+        refs = self.refs
+        match op:
+            case ssa.Const(dest, value):
+                refs[dest] = Imm(value)
+
+            case ssa.Param(dest, index):
+                refs[dest] = Arg(index)
+
+            case ssa.Capture(dest, index):
+                refs[dest] = Cap(index)
+
+            case ssa.Copy(dest, src):
+                refs[dest] = refs[src]
+
+            case ssa.BinOp(dest, name, left, right):
+                refs[dest] = self.push(BinaryOp(name, refs[left], refs[right]))
+
+            case ssa.UnOp(dest, name, inner):
+                refs[dest] = self.push(UnaryOp(name, refs[inner]))
+
+            case ssa.Cmp(dest, names, operands):
+                refs[dest] = self.push(Compare(names, [refs[var] for var in operands]))
+
+            case ssa.Concat(dest, pieces):
+                # Constant strings join the template, the other pieces are rendered into it
+                template, operands = [""], []
+                for piece in pieces:
+                    match refs[piece]:
+                        case Imm(String(s)):
+                            template[-1] += s
+                        case ref:
+                            operands.append(ref)
+                            template.append("")
+                refs[dest] = self.push(StringFormat(template, operands))
+
+            case ssa.Call(dest, fn, args):
+                # Calling convention:
+                #   x y z -> return value
+                for arg in args:
+                    self.push(Push(refs[arg]))
+                instr = TailCall if tail else Call
+                self.depth -= len(args)
+                refs[dest] = self.push(instr(refs[fn], len(args)))
+
+            case ssa.MakeClosure(dest, function, captures):
+                spec = ClosureSpec(lower(function), function.n_params, [refs[var] for var in captures])
+                refs[dest] = self.push(ClosureNew(spec))
+
+            case ssa.SetCapture(closure, index, value):
+                self.emit(CaptureSet(refs[closure], index, refs[value]))
+
+            case ssa.NewArray(dest, size):
+                refs[dest] = self.push(Push(Array([None] * size)))
+
+            case ssa.ArrayPush(array, value):
+                # The pushed item is taken from the top of the stack
+                self.emit(ArrayPushInstr(refs[array], self.push(Push(refs[value]))))
+                self.depth -= 1
+
+            case ssa.ArrayExtend(array, value):
+                self.emit(ArrayExtendInstr(refs[array], refs[value]))
+
+            case ssa.Index(dest, array, index):
+                refs[dest] = self.push(Index(refs[array], Imm(Int(index))))
+
+            case ssa.Slice(dest, array, skip_front, skip_back):
+                refs[dest] = self.push(ArraySlice(refs[array], skip_front, skip_back))
+
+            case _:
+                raise NotImplementedError(f"`Lowering.lower_op({type(op).__name__})`")
+
+    def lower_terminator(self, block: ssa.Block, next: ssa.Block):
+        match block.terminator:
+            case ssa.Jump(target):
+                if self.needs_moves(block, target):
+                    self.moves(block, target)
+                if target is not next:
+                    self.jump(target)
+
+            case ssa.Switch(value, cases, default):
+                instr = Switch(self.refs[value], {}, -1)
+                self.emit(instr)
+                edges = {}
+                for target in block.successors():
+                    edges[target] = self.edge(block, target)
+                for key, target in cases.items():
+                    edges[target](lambda dest, key=key: instr.cases.__setitem__(key, dest))
+                edges[default](lambda dest: setattr(instr, "default", dest))
+
+            case ssa.MatchArray(value, lower_bound, then, otherwise):
+                # Falls through when the value matches
+                instr = MatchArray(self.refs[value], lower_bound, -1)
+                self.emit(instr)
+                depth = self.depth
+                falls = then is next and not self.needs_moves(block, then)
+                if not falls or self.needs_moves(block, otherwise):
+                    self.moves(block, then)
+                    self.jump(then)
+                self.depth = depth
+                self.edge(block, otherwise)(lambda dest: setattr(instr, "dest", dest))
+
+            case ssa.Fail(reason):
+                self.emit(Fail(reason))
+
+            case ssa.Return(value):
+                ref = self.refs[value]
+                if len(self.returns) == 1:
+                    if ref != Stack(self.depth - 1):
+                        self.push(Push(ref))
+                    return
+                # Every return leaves the value alone in slot 0, so the exit is reached at one stack depth
+                if self.depth == 0:
+                    self.push(Push(ref))
+                else:
+                    if ref != Stack(0):
+                        self.emit(Store(Stack(0), ref))
+                    if self.depth > 1:
+                        self.emit(Pop(self.depth - 1))
+                if next is not None:
+                    instr = Jump(-1)
+                    self.emit(instr)
+                    self.exits.append(instr)
+
+    def lower(self) -> list[Instr]:
+        for i, block in enumerate(self.order):
+            self.labels[block] = len(self.code)
+            self.depth = self.base(block)
+            for j, phi in enumerate(block.phis):
+                self.refs[phi.dest] = Stack(self.depth + j)
+            self.depth += len(block.phis)
+
+            for j, op in enumerate(block.ops):
+                # A call whose result is returned right away reuses the frame
+                tail = (
+                    j == len(block.ops) - 1
+                    and isinstance(block.terminator, ssa.Return)
+                    and block.terminator.value is op.result
+                )
+                self.lower_op(op, tail)
+            self.end_depth[block] = self.depth
+
+            next = self.order[i + 1] if i + 1 < len(self.order) else None
+            self.lower_terminator(block, next)
+
+        for block, set in self.patches:
+            set(self.labels[block])
+        for instr in self.exits:
+            instr.dest = len(self.code)
+        return self.code
+
+
+def lower(function: ssa.Function) -> list[Instr]:
+    """The VM instructions of a function in SSA form"""
+    return Lowering(function).lower()
+
+
+def lower_closure(function: ssa.Function) -> Closure:
+    """The closure running a program in SSA form"""
+    return Closure(ClosureSpec(lower(function), 0, []), [])
@@ -0,0 +1,268 @@
+"""Optimization passes over SSA form
+
+Each pass rewrites a `Function` in place and returns whether it changed anything. Redundant instructions found by value numbering become `Copy`s, which copy propagation then removes, and dead code elimination deletes whatever is left unused.
+"""
+
+from typing import Callable, Hashable, Optional
+
+from value import Bool, Float, Int, String, Tag, Unit
+
+from ssa.ssa import (
+    ArrayExtend,
+    ArrayPush,
+    BinOp,
+    Block,
+    Capture,
+    Cmp,
+    Concat,
+    Const,
+    Copy,
+    Function,
+    Index,
+    Jump,
+    Op,
+    Param,
+    Phi,
+    SetCapture,
+    Slice,
+    UnOp,
+    Var,
+)
+
+
+def dominators(function: Function) -> dict[Block, Block]:
+    """The immediate dominator of each reachable block; the entry is its own
+
+    Uses the iterative algorithm of Cooper, Harvey and Kennedy, "A Simple, Fast Dominance Algorithm" (2001).
+    """
+    order = function.reverse_postorder()
+    index = {block: i for i, block in enumerate(order)}
+    preds = function.predecessors()
+    idom = {function.entry: function.entry}
+
+    def intersect(a: Block, b: Block) -> Block:
+        while a is not b:
+            while index[a] > index[b]:
+                a = idom[a]
+            while index[b] > index[a]:
+                b = idom[b]
+        return a
+
+    changed = True
+    while changed:
+        changed = False
+        for block in order[1:]:
+            new = None
+            for pred in preds[block]:
+                if pred in idom:
+                    new = pred if new is None else intersect(pred, new)
+            if idom.get(block) is not new:
+                idom[block] = new
+                changed = True
+    return idom
+
+
+def remove_unreachable(function: Function) -> bool:
+    reachable = set(function.reverse_postorder())
+    if len(reachable) == len(function.blocks):
+        return False
+    function.blocks = [block for block in function.blocks if block in reachable]
+    for block in function.blocks:
+        for phi in block.phis:
+            phi.incoming = {pred: var for pred, var in phi.incoming.items() if pred in reachable}
+    return True
+
+
+def merge_blocks(function: Function) -> bool:
+    """Append each block to its predecessor when that predecessor unconditionally jumps to it and nothing else does"""
+    changed = False
+    preds = function.predecessors()
+    for block in list(function.blocks):
+        if block not in preds:
+            continue
+        while isinstance(block.terminator, Jump):
+            target = block.terminator.target
+            if target is function.entry or target is block or preds[target] != [block]:
+                break
+            block.ops += [Copy(phi.dest, phi.incoming[block]) for phi in target.phis]
+            block.ops += target.ops
+            block.terminator = target.terminator
+            for succ in target.successors():
+                preds[succ] = [block if pred is target else pred for pred in preds[succ]]
+                for phi in succ.phis:
+                    phi.incoming = {
+                        block if pred is target else pred: var for pred, var in phi.incoming.items()
+                    }
+            del preds[target]
+            function.blocks.remove(target)
+            changed = True
+    return changed
+
+
+def dce(function: Function) -> bool:
+    """Remove unreachable blocks and instructions whose results are never used
+
+    Instructions with side effects or that can fail are kept. Array pushes and capture updates only affect the value they modify, so they are kept as long as it is.
+    """
+    changed = remove_unreachable(function)
+    definitions = function.definitions()
+    effects = {}
+    live = set()
+    work = []
+
+    def mark(op: Op):
+        if op not in live:
+            live.add(op)
+            work.append(op)
+
+    for block in function.blocks:
+        for op in block.all_ops():
+            match op:
+                case ArrayPush() | ArrayExtend():
+                    effects.setdefault(op.array, []).append(op)
+                case SetCapture():
+                    effects.setdefault(op.closure, []).append(op)
+                case _ if op.terminator or not op.pure:
+                    mark(op)
+
+    while work:
+        op = work.pop()
+        for var in op.operands():
+            mark(definitions[var])
+        if op.result is not None:
+            for effect in effects.get(op.result, []):
+                mark(effect)
+
+    for block in function.blocks:
+        phis = [phi for phi in block.phis if phi in live]
+        ops = [op for op in block.ops if op in live]
+        changed |= len(phis) != len(block.phis) or len(ops) != len(block.ops)
+        block.phis, block.ops = phis, ops
+    return changed
+
+
+def copy_propagation(function: Function) -> bool:
+    """Replace the uses of copies, and of phis whose incoming values are all the same, with the original value"""
+    replace = {}
+
+    def resolve(var: Var) -> Var:
+        while var in replace:
+            var = replace[var]
+        return var
+
+    found = True
+    while found:
+        found = False
+        for block in function.blocks:
+            for op in [*block.phis, *block.ops]:
+                if op.result in replace:
+                    continue
+                match op:
+                    case Copy(dest, src):
+                        replace[dest] = src
+                        found = True
+                    case Phi(dest):
+                        sources = {resolve(var) for var in op.incoming.values()} - {dest}
+                        if len(sources) == 1:
+                            replace[dest] = sources.pop()
+                            found = True
+
+    if not replace:
+        return False
+    for block in function.blocks:
+        block.phis = [phi for phi in block.phis if phi.dest not in replace]
+        block.ops = [op for op in block.ops if op.result not in replace]
+        for op in block.all_ops():
+            op.map_operands(resolve)
+    return True
+
+
+def key(op: Op, block: Block, canon: Callable[[Var], Var]) -> Optional[Hashable]:
+    """What makes two instructions compute the same value, or `None` if they never do
+
+    Only immutable values are numbered. Closures and new arrays are distinct objects each time, and calls can have side effects.
+    """
+    match op:
+        case Const(value=Unit() | Bool() | Int() | Float() | String() | Tag()):
+            return (Const, repr(op.value))
+        case Param(index=index) | Capture(index=index):
+            return (type(op), index)
+        case BinOp() | UnOp() | Index() | Slice():
+            fields = (getattr(op, name) for name in op.__dataclass_fields__ if name != "dest")
+            return (type(op), *(canon(f) if isinstance(f, Var) else f for f in fields))
+        case Cmp():
+            return (Cmp, tuple(op.ops), tuple(map(canon, op.operands_)))
+        case Concat():
+            return (Concat, tuple(map(canon, op.pieces)))
+        case Phi():
+            incoming = sorted((pred.id, canon(var).id) for pred, var in op.incoming.items())
+            return (Phi, block, tuple(incoming))
+    return None
+
+
+def number(block: Block, table: dict, canon: dict[Var, Var]) -> bool:
+    """Value-number the instructions of a block against the values in `table`, turning redundant ones into copies
+
+    Redundant phis become copies at the start of the block.
+    """
+    changed = False
+    phis = []
+    ops = []
+    for op in [*block.phis, *block.ops]:
+        k = key(op, block, lambda var: canon.get(var, var))
+        if k is not None and (existing := table.get(k)) is not None:
+            canon[op.result] = existing
+            op = Copy(op.result, existing)
+            changed = True
+        elif k is not None:
+            table[k] = op.result
+        (phis if isinstance(op, Phi) else ops).append(op)
+    block.phis, block.ops = phis, ops
+    return changed
+
+
+def cse(function: Function) -> bool:
+    """Common subexpression elimination within each block"""
+    changed = False
+    canon = {}
+    for block in function.blocks:
+        changed |= number(block, {}, canon)
+    return changed
+
+
+def gvn(function: Function) -> bool:
+    """Global value numbering
+
+    Blocks are visited in reverse postorder, each starting from the values available at the end of its immediate dominator, since those are defined on every path to it.
+    """
+    changed = False
+    canon = {}
+    tables = {}
+    idom = dominators(function)
+    for block in function.reverse_postorder():
+        parent = idom[block]
+        table = {} if parent is block else dict(tables[parent])
+        changed |= number(block, table, canon)
+        tables[block] = table
+    return changed
+
+
+PASSES = {
+    "merge": merge_blocks,
+    "copy": copy_propagation,
+    "cse": cse,
+    "gvn": gvn,
+    "dce": dce,
+}
+
+
+def optimize(function: Function, passes: tuple[str, ...] = ("merge", "copy", "gvn", "dce")) -> Function:
+    """Run `passes` over a function and the functions nested in it until none of them changes anything"""
+    changed = True
+    while changed:
+        changed = False
+        for name in passes:
+            changed |= PASSES[name](function)
+    for nested in function.nested():
+        optimize(nested, passes)
+    return function
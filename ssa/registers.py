@@ -0,0 +1,210 @@
+"""Lowering of SSA form to register machine code
+
+Every value computed by an instruction or phi gets its own register. Constants, arguments and captures are used in place. Edges into blocks with phis become moves, sequentialized so that a value is read before its register is overwritten.
+"""
+
+from typing import Callable
+
+import register as reg
+from instr import Arg, Cap, Imm, Ref, Reg
+from value import Closure
+
+from ssa import ssa
+
+
+def sequentialize(moves: list[tuple[Reg, Ref]], scratch: Callable[[], Reg]) -> list[tuple[Reg, Ref]]:
+    """Order parallel moves so none overwrites a register a later one still reads, breaking cycles through a scratch register"""
+    pending = [(dest, src) for dest, src in moves if dest != src]
+    out = []
+    while pending:
+        for i, (dest, src) in enumerate(pending):
+            if not any(other == dest for _, other in pending):
+                out.append((dest, src))
+                del pending[i]
+                break
+        else:
+            # Every destination is still read by another move: save one of them first
+            dest, src = pending[0]
+            temp = scratch()
+            out.append((temp, dest))
+            pending = [(d, temp if s == dest else s) for d, s in pending]
+    return out
+
+
+class RegisterLowering:
+    def __init__(self, function: ssa.Function):
+        self.function = function
+        self.code: list[reg.RegInstr] = []
+        self.refs: dict[ssa.Var, Ref] = {}
+        self.labels: dict[ssa.Block, int] = {}
+        self.patches: list[tuple[ssa.Block, Callable[[int], None]]] = []
+        self.n_regs = 0
+        self.tail_calls: set[ssa.Var] = set()
+
+    def register(self) -> Reg:
+        self.n_regs += 1
+        return Reg(self.n_regs - 1)
+
+    def define(self, var: ssa.Var) -> Reg:
+        self.refs[var] = ref = self.register()
+        return ref
+
+    def emit(self, instr: reg.RegInstr):
+        self.code.append(instr)
+
+    def label(self, block: ssa.Block, set: Callable[[int], None]):
+        self.patches.append((block, set))
+
+    def moves(self, source: ssa.Block, target: ssa.Block) -> list[tuple[Reg, Ref]]:
+        moves = [(self.refs[phi.dest], self.refs[phi.incoming[source]]) for phi in target.phis]
+        return sequentialize(moves, self.register)
+
+    def edge(self, source: ssa.Block, target: ssa.Block) -> Callable[[Callable[[int], None]], None]:
+        """Emit the moves of an edge out of line if it has any, then jump to `target`
+
+        Returns a function that points a jump at the edge.
+        """
+        if not (moves := self.moves(source, target)):
+            return lambda set: self.label(target, set)
+        start = len(self.code)
+        for dest, src in moves:
+            self.emit(reg.Move(dest, src))
+        self.jump(target)
+        return lambda set: set(start)
+
+    def jump(self, target: ssa.Block):
+        instr = reg.Jump(-1)
+        self.emit(instr)
+        self.label(target, lambda dest: setattr(instr, "dest", dest))
+
+    def lower_op(self, op: ssa.Op, tail: bool):
+        refs = self.refs
+        match op:
+            case ssa.Const(dest, value):
+                refs[dest] = Imm(value)
+
+            case ssa.Param(dest, index):
+                refs[dest] = Arg(index)
+
+            case ssa.Capture(dest, index):
+                refs[dest] = Cap(index)
+
+            case ssa.Copy(dest, src):
+                refs[dest] = refs[src]
+
+            case ssa.BinOp(dest, name, left, right):
+                self.emit(reg.Binary(self.define(dest), name, refs[left], refs[right]))
+
+            case ssa.UnOp(dest, name, inner):
+                self.emit(reg.Unary(self.define(dest), name, refs[inner]))
+
+            case ssa.Cmp(dest, names, operands):
+                self.emit(reg.Compare(self.define(dest), names, [refs[var] for var in operands]))
+
+            case ssa.Concat(dest, pieces):
+                self.emit(reg.Concat(self.define(dest), [refs[var] for var in pieces]))
+
+            case ssa.Call(dest, fn, args):
+                args = [refs[var] for var in args]
+                if tail:
+                    self.emit(reg.TailCall(refs[fn], args))
+                    self.tail_calls.add(dest)
+                else:
+                    self.emit(reg.Call(self.define(dest), refs[fn], args))
+
+            case ssa.MakeClosure(dest, function, captures):
+                spec = lower_spec(function, [refs[var] for var in captures])
+                self.emit(reg.MakeClosure(self.define(dest), spec))
+
+            case ssa.SetCapture(closure, index, value):
+                self.emit(reg.SetCapture(refs[closure], index, refs[value]))
+
+            case ssa.NewArray(dest):
+                self.emit(reg.NewArray(self.define(dest)))
+
+            case ssa.ArrayPush(array, value):
+                self.emit(reg.Append(refs[array], refs[value]))
+
+            case ssa.ArrayExtend(array, value):
+                self.emit(reg.Extend(refs[array], refs[value]))
+
+            case ssa.Index(dest, array, index):
+                self.emit(reg.Index(self.define(dest), refs[array], index))
+
+            case ssa.Slice(dest, array, skip_front, skip_back):
+                self.emit(reg.Slice(self.define(dest), refs[array], skip_front, skip_back))
+
+            case _:
+                raise NotImplementedError(f"`RegisterLowering.lower_op({type(op).__name__})`")
+
+    def lower_terminator(self, block: ssa.Block, next: ssa.Block):
+        match block.terminator:
+            case ssa.Jump(target):
+                for dest, src in self.moves(block, target):
+                    self.emit(reg.Move(dest, src))
+                if target is not next:
+                    self.jump(target)
+
+            case ssa.Switch(value, cases, default):
+                instr = reg.Switch(self.refs[value], {}, -1)
+                self.emit(instr)
+                edges = {target: self.edge(block, target) for target in block.successors()}
+                for key, target in cases.items():
+                    edges[target](lambda dest, key=key: instr.cases.__setitem__(key, dest))
+                edges[default](lambda dest: setattr(instr, "default", dest))
+
+            case ssa.MatchArray(value, lower_bound, then, otherwise):
+                # Falls through when the value matches
+                instr = reg.MatchArray(self.refs[value], lower_bound, -1)
+                self.emit(instr)
+                moves = self.moves(block, then)
+                otherwise_moves = self.moves(block, otherwise)
+                if moves or then is not next or otherwise_moves:
+                    for dest, src in moves:
+                        self.emit(reg.Move(dest, src))
+                    self.jump(then)
+                self.edge(block, otherwise)(lambda dest: setattr(instr, "dest", dest))
+
+            case ssa.Fail(reason):
+                self.emit(reg.Fail(reason))
+
+            case ssa.Return(value):
+                # The return after a tail call is never reached
+                if value not in self.tail_calls:
+                    self.emit(reg.Return(self.refs[value]))
+
+    def lower(self) -> list[reg.RegInstr]:
+        order = self.function.reverse_postorder()
+        # Phis get their registers up front, since edges into a block can be lowered before the block itself
+        for block in order:
+            for phi in block.phis:
+                self.define(phi.dest)
+
+        for i, block in enumerate(order):
+            self.labels[block] = len(self.code)
+            for j, op in enumerate(block.ops):
+                # A call whose result is returned right away reuses the frame
+                tail = (
+                    j == len(block.ops) - 1
+                    and isinstance(block.terminator, ssa.Return)
+                    and block.terminator.value is op.result
+                )
+                self.lower_op(op, tail)
+            next = order[i + 1] if i + 1 < len(order) else None
+            self.lower_terminator(block, next)
+
+        for block, set in self.patches:
+            set(self.labels[block])
+        return self.code
+
+
+def lower_spec(function: ssa.Function, captures: list[Ref]) -> reg.RegisterSpec:
+    """The register machine code object of a function in SSA form"""
+    lowering = RegisterLowering(function)
+    code = lowering.lower()
+    return reg.RegisterSpec(code, function.n_params, captures, n_regs=lowering.n_regs)
+
+
+def lower_closure(function: ssa.Function) -> Closure:
+    """The closure running a program in SSA form on the register machine"""
+    return Closure(lower_spec(function, []), [])
@@ -1,8 +1,426 @@
-from dataclasses import dataclass, field
+"""Static single assignment form of Fast functions
 
-from format_node import FormatNode
+The IR sits between the syntax trees of `tree.py` and the stack instructions of `instr.py`. Every `Var` is defined exactly once, by an `Op` or a `Phi`, and control flow is an explicit graph of `Block`s that each end in a terminator. `ssa.build` produces it, `ssa.passes` optimizes it and `ssa.lower` turns it back into VM instructions.
+"""
 
+from dataclasses import dataclass, field, fields
+from typing import Callable, Hashable, Optional
 
-@dataclass
-class Ssa(FormatNode):
-    pass
+from mixins import Format, GetChildren
+from value import Value
+
+
+@dataclass(eq=False)
+class Var(Format):
+    """A value, defined once"""
+
+    id: int
+
+    def short(self):
+        return f"%{self.id}"
+
+    def __str__(self):
+        return self.short()
+
+
+def _text(value) -> str:
+    match value:
+        case Var():
+            return value.short()
+        case Block():
+            return value.short()
+        case list():
+            return "[" + ", ".join(_text(item) for item in value) + "]"
+        case dict():
+            return "{" + ", ".join(f"{_text(k)}: {_text(v)}" for k, v in value.items()) + "}"
+        case tuple():
+            return "(" + ", ".join(_text(item) for item in value) + ")"
+        case type():
+            return value.__name__
+        case Function():
+            return value.short()
+    return repr(value)
+
+
+@dataclass(eq=False)
+class Op(Format, GetChildren):
+    """Instruction; those that produce a value have a `dest` field
+
+    Subclasses set `pure` when they have no side effects and cannot fail, so they can be removed once unused, and `terminator` when they end a block.
+    """
+
+    pure = False
+    terminator = False
+
+    @property
+    def result(self) -> Optional[Var]:
+        return getattr(self, "dest", None)
+
+    def operands(self) -> list[Var]:
+        """The values read by the instruction"""
+        out = []
+        for f in fields(self):
+            if f.name == "dest":
+                continue
+            value = getattr(self, f.name)
+            if isinstance(value, Var):
+                out.append(value)
+            elif isinstance(value, list):
+                out.extend(item for item in value if isinstance(item, Var))
+        return out
+
+    def map_operands(self, f: Callable[[Var], Var]):
+        """Replace every operand `var` with `f(var)`, in place"""
+        for fl in fields(self):
+            if fl.name == "dest":
+                continue
+            value = getattr(self, fl.name)
+            if isinstance(value, Var):
+                setattr(self, fl.name, f(value))
+            elif isinstance(value, list):
+                setattr(
+                    self,
+                    fl.name,
+                    [f(item) if isinstance(item, Var) else item for item in value],
+                )
+
+    def successors(self) -> list["Block"]:
+        return []
+
+    def map_successors(self, f: Callable[["Block"], "Block"]):
+        pass
+
+    def short(self):
+        name = type(self).__name__.lower()
+        args = " ".join(_text(getattr(self, f.name)) for f in fields(self) if f.name != "dest")
+        text = f"{name} {args}".rstrip()
+        if self.result is not None:
+            return f"{self.result.short()} = {text}"
+        return text
+
+    def __str__(self):
+        return self.short()
+
+
+@dataclass(eq=False)
+class Const(Op):
+    dest: Var
+    value: Value
+
+    pure = True
+
+
+@dataclass(eq=False)
+class Param(Op):
+    """Function argument"""
+
+    dest: Var
+    index: int
+
+    pure = True
+
+
+@dataclass(eq=False)
+class Capture(Op):
+    """Closure capture"""
+
+    dest: Var
+    index: int
+
+    pure = True
+
+
+@dataclass(eq=False)
+class Copy(Op):
+    dest: Var
+    src: Var
+
+    pure = True
+
+
+@dataclass(eq=False)
+class Phi(Op):
+    """The value of `incoming[pred]` when control arrived from block `pred`"""
+
+    dest: Var
+    incoming: dict["Block", Var] = field(default_factory=dict)
+
+    pure = True
+
+    def operands(self) -> list[Var]:
+        return list(self.incoming.values())
+
+    def map_operands(self, f: Callable[[Var], Var]):
+        self.incoming = {block: f(var) for block, var in self.incoming.items()}
+
+    def short(self):
+        pairs = ", ".join(f"{block.short()}: {var.short()}" for block, var in self.incoming.items())
+        return f"{self.dest.short()} = phi {{{pairs}}}"
+
+
+@dataclass(eq=False)
+class BinOp(Op):
+    dest: Var
+    op: str
+    left: Var
+    right: Var
+
+
+@dataclass(eq=False)
+class UnOp(Op):
+    dest: Var
+    op: str
+    inner: Var
+
+
+@dataclass(eq=False)
+class Cmp(Op):
+    dest: Var
+    ops: list[str]
+    operands_: list[Var]
+
+    def short(self):
+        return f"{self.dest.short()} = cmp {self.ops} {_text(self.operands_)}"
+
+
+@dataclass(eq=False)
+class Concat(Op):
+    """String interpolation"""
+
+    dest: Var
+    pieces: list[Var]
+
+
+@dataclass(eq=False)
+class Call(Op):
+    dest: Var
+    fn: Var
+    args: list[Var]
+
+
+@dataclass(eq=False)
+class MakeClosure(Op):
+    dest: Var
+    function: "Function"
+    captures: list[Var]
+
+    pure = True
+
+
+@dataclass(eq=False)
+class SetCapture(Op):
+    """Overwrite a capture of a closure, for recursive functions"""
+
+    closure: Var
+    index: int
+    value: Var
+
+
+@dataclass(eq=False)
+class NewArray(Op):
+    """Allocate an array; `size` is the number of items the literal adds"""
+
+    dest: Var
+    size: int
+
+    pure = True
+
+
+@dataclass(eq=False)
+class ArrayPush(Op):
+    array: Var
+    value: Var
+
+
+@dataclass(eq=False)
+class ArrayExtend(Op):
+    array: Var
+    value: Var
+
+
+@dataclass(eq=False)
+class Index(Op):
+    """Item of an array already known to be long enough; negative indices count from the end"""
+
+    dest: Var
+    array: Var
+    index: int
+
+    pure = True
+
+
+@dataclass(eq=False)
+class Slice(Op):
+    """Items of an array without the first `skip_front` and last `skip_back`"""
+
+    dest: Var
+    array: Var
+    skip_front: int
+    skip_back: int
+
+    pure = True
+
+
+@dataclass(eq=False)
+class Jump(Op):
+    target: "Block"
+
+    terminator = True
+
+    def successors(self):
+        return [self.target]
+
+    def map_successors(self, f):
+        self.target = f(self.target)
+
+
+@dataclass(eq=False)
+class Switch(Op):
+    """Go to `cases[ops.switch_key(value)]`, or to `default`"""
+
+    value: Var
+    cases: dict[Hashable, "Block"]
+    default: "Block"
+
+    terminator = True
+
+    def successors(self):
+        return list(dict.fromkeys([*self.cases.values(), self.default]))
+
+    def map_successors(self, f):
+        self.cases = {key: f(block) for key, block in self.cases.items()}
+        self.default = f(self.default)
+
+
+@dataclass(eq=False)
+class MatchArray(Op):
+    """Go to `then` if `value` is an array of at least `lower_bound` items, otherwise to `otherwise`"""
+
+    value: Var
+    lower_bound: int
+    then: "Block"
+    otherwise: "Block"
+
+    terminator = True
+
+    def successors(self):
+        return list(dict.fromkeys([self.then, self.otherwise]))
+
+    def map_successors(self, f):
+        self.then = f(self.then)
+        self.otherwise = f(self.otherwise)
+
+
+@dataclass(eq=False)
+class Fail(Op):
+    reason: str
+
+    terminator = True
+
+
+@dataclass(eq=False)
+class Return(Op):
+    value: Var
+
+    terminator = True
+
+
+Op.get_children()
+
+
+@dataclass(eq=False)
+class Block(Format):
+    id: int
+    phis: list[Phi] = field(default_factory=list)
+    ops: list[Op] = field(default_factory=list)
+    terminator: Optional[Op] = None
+
+    def short(self):
+        return f"b{self.id}"
+
+    def successors(self) -> list["Block"]:
+        return [] if self.terminator is None else self.terminator.successors()
+
+    def all_ops(self):
+        """The phis, instructions and terminator of the block"""
+        yield from self.phis
+        yield from self.ops
+        if self.terminator is not None:
+            yield self.terminator
+
+    def lines(self):
+        yield f"{self.short()}:"
+        for op in self.all_ops():
+            yield f"    {op}"
+
+
+@dataclass(eq=False)
+class Function(Format):
+    """A code object in SSA form; `blocks[0]` is the entry"""
+
+    n_params: int = 0
+    n_captures: int = 0
+    blocks: list[Block] = field(default_factory=list)
+    n_vars: int = 0
+
+    @property
+    def entry(self) -> Block:
+        return self.blocks[0]
+
+    def short(self):
+        return f"fn/{self.n_params}"
+
+    def var(self) -> Var:
+        self.n_vars += 1
+        return Var(self.n_vars - 1)
+
+    def block(self) -> Block:
+        block = Block(max((b.id for b in self.blocks), default=-1) + 1)
+        self.blocks.append(block)
+        return block
+
+    def predecessors(self) -> dict[Block, list[Block]]:
+        preds = {block: [] for block in self.blocks}
+        for block in self.blocks:
+            for succ in block.successors():
+                preds[succ].append(block)
+        return preds
+
+    def reverse_postorder(self) -> list[Block]:
+        """Blocks reachable from the entry, each after all of its predecessors except along back edges"""
+        order = []
+        seen = set()
+        stack = [(self.entry, iter(self.entry.successors()))]
+        seen.add(self.entry)
+        while stack:
+            block, succs = stack[-1]
+            for succ in succs:
+                if succ not in seen:
+                    seen.add(succ)
+                    stack.append((succ, iter(succ.successors())))
+                    break
+            else:
+                stack.pop()
+                order.append(block)
+        return order[::-1]
+
+    def definitions(self) -> dict[Var, Op]:
+        return {op.result: op for block in self.blocks for op in block.all_ops() if op.result is not None}
+
+    def nested(self):
+        """The functions of the closures created in this one"""
+        for block in self.blocks:
+            for op in block.ops:
+                if isinstance(op, MakeClosure):
+                    yield op.function
+
+    def lines(self, indent: str = ""):
+        yield f"{indent}fn({self.n_params} params, {self.n_captures} captures)"
+        for block in self.blocks:
+            for line in block.lines():
+                yield indent + line
+        for function in self.nested():
+            yield from function.lines(indent + "    ")
+
+    def __str__(self):
+        return "\n".join(self.lines())
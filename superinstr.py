@@ -0,0 +1,88 @@
+"""Selection of superinstructions
+
+The most frequent instruction sequences in VM profiles (see `vm.Profile` and `devtools/superinstructions.py`) are pushes feeding the instruction right after them, such as array items pushed only to be appended and call arguments pushed only to be consumed by the call, and a result stored to its slot before the temporaries above it are popped. Those sequences are replaced by one instruction each, so they cost one dispatch.
+"""
+
+from typing import Optional
+
+from instr import (
+    ArrayPush,
+    Call,
+    Instr,
+    Pop,
+    Push,
+    PushArrayPush,
+    PushCall,
+    PushTailCall,
+    Ref,
+    Stack,
+    Store,
+    StorePop,
+    TailCall,
+)
+from peephole import compact, depths, nested_specs, predecessors
+from value import Closure, ClosureSpec
+
+
+def _plain(instr: Instr, base: int) -> bool:
+    """Is this a push of a value that can be read in place, not of a slot at or above `base`?"""
+    if not isinstance(instr, Push) or not isinstance(instr.value, Ref):
+        return False
+    return not (isinstance(instr.value, Stack) and instr.value.index >= base)
+
+
+def fuse_code(code: list[Instr]) -> list[Instr]:
+    """Replace pushes followed by the instruction consuming them with superinstructions
+
+    No sequence is fused across a jump target, since another path would skip its pushes.
+    """
+    depth = depths(code)
+    targets = {j for j, preds in enumerate(predecessors(code)) if any(i != j - 1 for i in preds)}
+    out: list[Optional[Instr]] = list(code)
+
+    for i, instr in enumerate(code):
+        match instr:
+            case ArrayPush(array, value) if i > 0 and i not in targets and depth[i] is not None:
+                top = Stack(depth[i] - 1)
+                if value == top and array != top and _plain(out[i - 1], depth[i] - 1):
+                    out[i] = PushArrayPush(array, out[i - 1].value)
+                    out[i - 1] = None
+
+            case Pop(n) if i > 0 and i not in targets and isinstance(out[i - 1], Store):
+                out[i] = StorePop(out[i - 1].dest, out[i - 1].value, n)
+                out[i - 1] = None
+
+            case Call(closure, n) | TailCall(closure, n) if n > 0 and depth[i] is not None:
+                base = depth[i] - n
+                start = i - n
+                if start < 0 or any(j in targets for j in range(start + 1, i + 1)):
+                    continue
+                if isinstance(closure, Stack) and closure.index >= base:
+                    continue
+                if not all(_plain(out[j], base) for j in range(start, i)):
+                    continue
+                args = [out[j].value for j in range(start, i)]
+                fused = PushCall if isinstance(instr, Call) else PushTailCall
+                out[i] = fused(closure, args)
+                for j in range(start, i):
+                    out[j] = None
+
+    return compact(out)
+
+
+def fuse_spec(spec: ClosureSpec, seen=None):
+    """Select superinstructions in a spec and the specs nested in it, in place"""
+    if seen is None:
+        seen = set()
+    if id(spec.code) in seen:
+        return
+    seen.add(id(spec.code))
+    for nested in nested_specs(spec):
+        fuse_spec(nested, seen)
+    spec.code[:] = fuse_code(spec.code)
+    spec.invalidate()
+
+
+def fuse(closure: Closure):
+    """Select superinstructions in the code of a compiled closure"""
+    fuse_spec(closure.spec)
@@ -0,0 +1,67 @@
+"""Helpers and programs shared by the tests"""
+
+from comb import Span
+from parse import statements
+from tree import BinaryExpr, ComparisonExpr, IdExpr, Transformer
+
+# The parser has no operators yet, so they are written as calls to these names
+OPERATORS = {"add": "+", "sub": "-", "mul": "*", "div": "/", "lt": "<", "eq": "=="}
+
+
+class Operators(Transformer):
+    def visit_CallExpr(self, expr):
+        expr = self.generic_visit(expr)
+        if isinstance(expr.fn, IdExpr) and (op := OPERATORS.get(expr.fn.span.str())):
+            if op in ("<", "=="):
+                return ComparisonExpr(expr.span, [Span(op)], expr.args)
+            return BinaryExpr(expr.span, Span(op), *expr.args)
+        return expr
+
+
+def program(source):
+    return [Operators().visit(statement) for statement in statements(source).val]
+
+
+# Programs that every backend and optimization level must run the same
+SOURCES = [
+    "fn even(n) { match n { [] -> :even, [_, ...r] -> odd(r) } }; fn odd(n) { match n { [] -> :odd, [_, ...r] -> even(r) } }; odd([1, 2, 3])",
+    'let f = fn(x) "<{x}>"; let g = fn(y) f(y); [g(1), g(:a), f("s")]',
+    "let n = 2; let f = fn(x) [n, x]; f(f(3))",
+]
+
+# Loops with assignments, labels, `break` and `continue`
+REVERSE = """
+fn rev(xs) {
+  let out = [];
+  loop {
+    match xs {
+      [] -> { break out },
+      [x, ...r] -> { out = [x, ...out]; xs = r }
+    }
+  }
+};
+rev([1, 2, 3])
+"""
+
+PAIRS = """
+fn pairs(xs) {
+  let out = [];
+  let rest = xs;
+  'rows: loop {
+    match rest {
+      [] -> { break 'rows out },
+      [x, ...r] -> {
+        rest = r;
+        let ys = xs;
+        loop {
+          match ys {
+            [] -> { continue 'rows },
+            [y, ...s] -> { ys = s; match y { 2 -> { continue }, _ -> { out = [...out, [x, y]] } } }
+          }
+        }
+      }
+    }
+  }
+};
+pairs([1, 2])
+"""
@@ -0,0 +1,46 @@
+import pytest
+
+from bytecode import MAGIC, dumps, load, loads, write
+from compile import compile
+from errors import BytecodeError
+from instr import Arg, ClosureNew, Imm, Push
+from value import Closure, ClosureSpec
+from vm import run
+
+SOURCES = [
+    "let f = fn(x, y) [y, x, 1.5, -2]; [f(1, 2), f(3, 4), ...f(5, 6)]",
+    "fn f(n) { match n { [] -> :done, [_, ...r] -> f(r) } }; f([1, 2, 3, 4, 5])",
+    "let g = fn(x) match x { :a -> 1, :b -> 2, [_, _] -> 3, _ -> 123456789012345678901234567890 }; [g(:a), g([1, 2]), g(:c)]",
+    "fn even(n) { match n { [] -> :even, [_, ...r] -> odd(r) } }; fn odd(n) { match n { [] -> :odd, [_, ...r] -> even(r) } }; odd([1, 2, 3])",
+]
+
+
+@pytest.mark.parametrize("source", SOURCES)
+@pytest.mark.parametrize("options", [{}, {"peephole": True, "superinstructions": True}, {"ssa": True}])
+def test_round_trip(source, options, tmp_path):
+    closure = compile(source, **options)
+    assert loads(dumps(closure)) == closure
+    path = tmp_path / "program.fastc"
+    write(closure, path)
+    assert load(path) == closure
+    assert run(load(path)) == run(compile(source, **options))
+
+
+def test_shared_specs():
+    spec = ClosureSpec([Push(Arg(0))], 1, [])
+    closure = Closure(ClosureSpec([ClosureNew(spec), ClosureNew(spec), Push(Imm(Closure(spec, [])))], 0, []), [])
+    loaded = loads(dumps(closure))
+    assert loaded == closure
+    first, second, hoisted = loaded.spec.code
+    assert first.spec is second.spec is hoisted.value.value.spec
+
+
+def test_malformed():
+    data = dumps(compile("[1, :a]"))
+    assert data.startswith(MAGIC)
+    with pytest.raises(BytecodeError, match="Not a .fastc file"):
+        loads(b"\0" + data[1:])
+    with pytest.raises(BytecodeError, match="version"):
+        loads(data[:6] + b"\xff\xff" + data[8:])
+    with pytest.raises(BytecodeError):
+        loads(data[:-1])
@@ -0,0 +1,59 @@
+from cache import CompileCache, code_size
+from compile import compile
+from peephole import optimize
+from value import Array, Int, Tag
+from vm import run
+
+
+def test_hits_and_misses():
+    cache = CompileCache()
+    a = cache.compile("let f = fn(x) x; f(1)")
+    b = cache.compile("let f = fn(x) x; f(1)")
+    c = cache.compile("let f = fn(x) x; f(1)", peephole=True)
+    assert a == b == compile("let f = fn(x) x; f(1)")
+    assert c == compile("let f = fn(x) x; f(1)", peephole=True)
+    assert (cache.stats.hits, cache.stats.misses, len(cache)) == (1, 2, 2)
+    assert run("[1]", cache=cache) == Array([Int(1)])
+
+
+def test_no_shared_state():
+    cache = CompileCache()
+    source = "fn f(n) { match n { [] -> :done, [_, ...r] -> f(r) } }; f([1, 2])"
+    first = cache.compile(source)
+    # Running a result keeps the VM state on its own specs
+    assert run(first) == Tag(":done")
+    assert first.spec.steps is not None and cache.compile(source).spec.steps is None
+    # Mutating a result, as the peephole optimizer does, leaves the cached program alone
+    optimize(first)
+    first.spec.code[-1].closure = None
+    second = cache.compile(source)
+    assert second == compile(source) and second is not first
+    assert run(second) == Tag(":done")
+    assert second.spec.code[1].spec is not cache.compile(source).spec.code[1].spec
+
+
+def test_bounds():
+    cache = CompileCache(max_entries=2)
+    for source in ["1", "2", "3"]:
+        cache.compile(source)
+    assert len(cache) == 2 and cache.stats.evictions == 1
+    cache.compile("2")
+    cache.compile("4")
+    assert cache.compile("2") and cache.stats.hits == 2, "recently used entries stay"
+
+    cache = CompileCache(max_instructions=10)
+    cache.compile("[1, 2, 3]")
+    assert cache.instructions == code_size(compile("[1, 2, 3]").spec)
+    cache.compile("[4, 5, 6]")
+    assert len(cache) == 1 and cache.instructions <= 10
+
+
+def test_invalidate():
+    cache = CompileCache()
+    cache.compile("1")
+    cache.compile("1", fold=True)
+    cache.compile("2")
+    assert cache.invalidate("1") == 1
+    assert cache.invalidate("1") == 0
+    assert cache.invalidate() == 2
+    assert len(cache) == 0 and cache.instructions == 0
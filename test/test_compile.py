@@ -8,10 +8,12 @@ from instr import (
     Call,
     ClosureNew,
     Imm,
+    Pop,
     Stack,
+    Store,
     Push,
-    StringBufferPush,
-    StringBufferToString,
+    StringFormat,
+    TailCall,
 )
 from value import (
     Array,
@@ -21,7 +23,6 @@ from value import (
     Float,
     Int,
     String,
-    StringBuffer,
     Tag,
     Unit,
 )
@@ -58,25 +59,16 @@ def test_compile_string():
     code_test(
         '"asdf{123}asdf"',
         [
-            Push(value=Imm(value=String(value="asdf"))),
-            Push(value=Imm(value=StringBuffer(pieces=[Stack(index=0)]))),
             Push(value=Imm(value=Int(value=123))),
-            StringBufferPush(buffer_loc=Stack(index=1), piece=Stack(index=2)),
-            Push(value=Imm(value=String(value="asdf"))),
-            StringBufferPush(buffer_loc=Stack(index=1), piece=Stack(index=3)),
-            StringBufferToString(buffer_loc=Stack(index=1)),
+            StringFormat(template=["asdf", "asdf"], operands=[Stack(index=0)]),
         ],
     )
     code_test(
-        '"asdf{"asdf"}asdf"',
+        '"a{"b"}c{:d}e"',
         [
-            Push(value=Imm(value=String(value="asdf"))),
-            Push(value=Imm(value=StringBuffer(pieces=[Stack(index=0)]))),
-            Push(value=Imm(value=String(value="asdf"))),
-            StringBufferPush(buffer_loc=Stack(index=1), piece=Stack(index=2)),
-            Push(value=Imm(value=String(value="asdf"))),
-            StringBufferPush(buffer_loc=Stack(index=1), piece=Stack(index=3)),
-            StringBufferToString(buffer_loc=Stack(index=1)),
+            Push(value=Imm(value=String(value="b"))),
+            Push(value=Imm(value=Tag(value=":d"))),
+            StringFormat(template=["a", "c", "e"], operands=[Stack(index=0), Stack(index=1)]),
         ],
     )
     code_test(
@@ -131,6 +123,7 @@ def test_compile_array():
             Push(value=Imm(value=Int(value=4))),
             ArrayPush(array=Stack(index=1), value=Stack(index=2)),
             ArrayExtend(array_loc=Stack(index=0), item_ref=Stack(index=1)),
+            Pop(n=1),
         ],
     )
 
@@ -147,7 +140,7 @@ def test_fn_expr():
                         Push(value=Arg(index=0)),
                         Push(value=Arg(index=1)),
                         Push(value=Arg(index=2)),
-                        Call(closure=Stack(index=0), n_args=2),
+                        TailCall(closure=Stack(index=0), n_args=2),
                     ],
                     n_args=3,
                     capture_indices=[],
@@ -155,3 +148,28 @@ def test_fn_expr():
             )
         ],
     )
+
+
+def test_share_specs():
+    code = compile("let f = fn(x) x; let g = fn(y) y; fn(x) x", share_specs=True).spec.code
+    assert code[0].spec is code[6].spec, "identical function bodies share a spec"
+    assert code[0].spec is not code[3].spec
+
+    code = compile("let f = fn(x) x; fn(x) x").spec.code
+    assert code[0].spec == code[3].spec and code[0].spec is not code[3].spec
+
+
+def test_reuse_slots():
+    from peephole import depths
+
+    names = [f"x{a}{b}" for a in "abcde" for b in "abcdefghij"]
+    source = f"let {names[0]} = 1; "
+    source += " ".join(f"let {b} = {a};" for a, b in zip(names, names[1:]))
+    source += f" {names[-1]}"
+    assert max(depths(compile(source).spec.code)) == 101
+    assert max(depths(compile(source, reuse_slots=True).spec.code)) == 3
+
+    code = compile("let x = 1; let y = 2; x", reuse_slots=True).spec.code
+    assert code[3] == Pop(1), "the assert result is dead but `x` is used later"
+    assert code[7] == Pop(2), "`y` is never used"
+    assert code[-2:] == [Store(Stack(0), Stack(1)), Pop(1)], "block result ends up at its base"
@@ -0,0 +1,58 @@
+from bytecode import dumps, loads
+from compile import compile
+from constants import intern_code
+from instr import Arg, Const, Imm, Push, Stack, StringFormat
+from value import TRUE, UNIT, Array, Bool, Float, Int, Tag, Unit
+from vm import run
+
+SOURCES = [
+    "let f = fn(x) [x, 1, 1, :a, :a, 2.5, 2.5]; [f(1), f(:a)]",
+    "let g = fn(x) match x { :a -> 1, [_, _] -> :a, _ -> :b }; [g(:a), g([1, 2]), g(3)]",
+    "fn f(n) { match n { [] -> :done, [_, ...r] -> f(r) } }; f([1, 2, 3])",
+]
+
+
+def test_interned_code():
+    code = [
+        Push(Imm(Int(1))),
+        Push(Imm(Tag(":a"))),
+        Push(Imm(Int(1))),
+        Push(Imm(Bool(True))),
+        Push(Imm(Unit())),
+        Push(Arg(0)),
+        StringFormat(["a", "b", "c"], [Stack(0), Imm(Int(1))]),
+    ]
+    out, constants = intern_code(code)
+    assert out == [
+        Push(Const(0)),
+        Push(Const(1)),
+        Push(Const(0)),
+        Push(Const(2)),
+        Push(Const(3)),
+        Push(Arg(0)),
+        StringFormat(["a", "b", "c"], [Stack(0), Const(0)]),
+    ]
+    assert constants == [Int(1), Tag(":a"), TRUE, UNIT]
+    assert constants[2] is TRUE and constants[3] is UNIT
+
+
+def test_floats_by_bits():
+    _, constants = intern_code([Push(Imm(Float(0.0))), Push(Imm(Float(-0.0))), Push(Imm(Float(0.0)))])
+    assert len(constants) == 2
+
+
+def test_same_results():
+    for source in SOURCES:
+        for options in [{}, {"peephole": True, "superinstructions": True}, {"ssa": True}]:
+            closure = compile(source, constant_pools=True, **options)
+            assert run(closure) == run(compile(source, **options))
+            assert run(loads(dumps(closure))) == run(closure)
+
+
+def test_no_imm_left():
+    closure = compile(SOURCES[0], constant_pools=True)
+    nested = closure.spec.code[0].spec
+    assert not any(isinstance(getattr(instr, "value", None), Imm) for instr in nested.code)
+    assert nested.constants == [Int(1), Tag(":a"), Float(2.5)]
+    items = [Int(1), Int(1), Tag(":a"), Tag(":a"), Float(2.5), Float(2.5)]
+    assert run(closure) == Array([Array([Int(1), *items]), Array([Tag(":a"), *items])])
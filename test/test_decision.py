@@ -0,0 +1,55 @@
+from decision import Branch, Failure, Leaf, LengthCheck, Occurrence, compile_patterns
+from instr import Index, MatchArray, Switch
+from compile import compile
+from parse import pattern
+from value import Array, Int, Tag
+
+
+def tree(*sources):
+    return compile_patterns([pattern(source).val for source in sources])
+
+
+def test_tags_share_one_switch():
+    subject = Occurrence()
+    assert tree(":a", ":b", "x") == Branch(
+        subject,
+        {(Tag, ":a"): Leaf(0, {}), (Tag, ":b"): Leaf(1, {})},
+        Leaf(2, {"x": subject}),
+    )
+
+
+def test_array_lengths():
+    subject = Occurrence()
+    first = Occurrence(subject, index=0)
+    assert tree("[]", "[a, ...r]") == Branch(
+        subject,
+        {(Array, 0): Leaf(0, {})},
+        LengthCheck(
+            subject,
+            1,
+            Leaf(1, {"a": first, "r": Occurrence(subject, gather=(1, 0))}),
+            Failure(),
+        ),
+    )
+
+
+def test_nested_columns():
+    subject = Occurrence()
+    t = tree("[1, :a]", "[1, _]", "[_, :b]")
+    assert isinstance(t, Branch) and list(t.cases) == [(Array, 2)]
+    first = t.cases[(Array, 2)]
+    assert first.occurrence == Occurrence(subject, index=0)
+    assert list(first.cases) == [(Int, 1)]
+    # Each element is tested once on every path
+    second = first.cases[(Int, 1)]
+    assert second.occurrence == Occurrence(subject, index=1)
+    assert second.cases == {(Tag, ":a"): Leaf(0, {}), (Tag, ":b"): Leaf(1, {})}
+    assert second.default == Leaf(1, {})
+
+
+def test_single_dispatch():
+    code = compile("match :c { :a -> 1, :b -> 2, :c -> 3, _ -> 4 }").spec.code
+    assert sum(1 for instr in code if isinstance(instr, Switch)) == 1
+    code = compile("match [1] { [] -> 0, [a] -> a, [a, b] -> b }").spec.code
+    assert sum(1 for instr in code if isinstance(instr, (Switch, MatchArray))) == 1
+    assert sum(1 for instr in code if isinstance(instr, Index)) == 3
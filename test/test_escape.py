@@ -0,0 +1,41 @@
+from compile import compile, lift_functions
+from instr import ClosureNew, Imm, Push
+from parse import statements
+from value import Array, Closure, Int, Tag
+from vm import run
+
+
+def closure_news(closure):
+    return sum(1 for instr in closure.spec.code if isinstance(instr, ClosureNew))
+
+
+def test_hoist_capture_less():
+    code = compile("fn(x) x", escape=True).spec.code
+    assert len(code) == 1 and isinstance(code[0], Push)
+    assert isinstance(code[0].value, Imm) and isinstance(code[0].value.value, Closure)
+    assert run(compile("fn id(x) { x }; id(:i)", escape=True)) == Tag(":i")
+
+
+def test_lift_captures():
+    source = "let k = :k; let f = fn(a) [a, k]; [f(1), f(2)]"
+    [_, let, _] = lift_functions(statements(source).val)
+    assert [param.name.str() for param in let.inner.params] == ["a", "k"]
+    closure = compile(source, escape=True)
+    assert closure_news(closure) == 0
+    assert run(closure) == Array([Array([Int(1), Tag(":k")]), Array([Int(2), Tag(":k")])])
+
+    # Calls from nested functions capture `k` in place of `f`
+    source = "let k = :k; let f = fn(a) [a, k]; let g = fn(b) f(b); g(:x)"
+    assert closure_news(compile(source, escape=True)) == 0
+    assert run(compile(source, escape=True)) == run(source)
+
+
+def test_escaping_not_lifted():
+    for source in [
+        "let k = :k; let f = fn(a) [a, k]; let g = f; g(:esc)",
+        # `k` means something else where `f` is called
+        "let k = :k; let f = fn(a) [a, k]; let h = fn(k) f(k); h(:shadow)",
+    ]:
+        closure = compile(source, escape=True)
+        assert closure_news(closure) == 1
+        assert run(closure) == run(source)
@@ -0,0 +1,84 @@
+import pytest
+
+from comb import Span
+from compile import compile, fold_constants
+from errors import VmError
+from instr import BinaryOp, Imm, Push
+from parse import expr, statements
+from tree import BinaryExpr, ComparisonExpr, ConstExpr, UnaryExpr
+from value import Bool, Float, Int, String
+from vm import run
+
+
+def binary(op, left, right):
+    if isinstance(left, str):
+        left = expr(left).val
+    if isinstance(right, str):
+        right = expr(right).val
+    return BinaryExpr(Span(op), Span(op), left, right)
+
+
+def folds_to(input, value):
+    assert compile(input, fold=True).spec.code == [Push(Imm(value))]
+
+
+def test_fold_binary():
+    folds_to(binary("*", binary("*", "60", "60"), "24"), Int(86400))
+    folds_to(binary("/", "1", "4"), Float(0.25))
+    folds_to(binary("+", '"a"', '"b"'), String("ab"))
+
+
+def test_fold_unary_and_comparison():
+    folds_to(UnaryExpr(Span("-"), Span("-"), expr("(5)").val), Int(-5))
+    e = ComparisonExpr(Span("<"), [Span("<"), Span("<=")], [expr(s).val for s in "123"])
+    folds_to(e, Bool(True))
+    e = ComparisonExpr(Span("<"), [Span("<"), Span("<=")], [expr(s).val for s in "132"])
+    folds_to(e, Bool(False))
+
+
+def test_fold_string_interpolation():
+    folds_to('"a{1}b"', String("a1b"))
+    folds_to('"a{"b{:c}d"}e{1.5}"', String("ab:cde1.5"))
+    assert compile('fn(x) "a{1}b{x}c"', fold=True) == compile('fn(x) "a1b{x}c"')
+
+
+def test_propagate_let():
+    folds_to("let x = 2; let y = x; y", Int(2))
+    s = statements("let x = 60; let f = fn(y) y; f(x)").val
+    s[2].inner.args[0] = binary("*", s[2].inner.args[0], "60")
+    code = compile(s, fold=True).spec.code
+    assert len(code) == 6 and code[-2] == Push(Imm(Int(3600)))
+
+
+def test_propagate_respects_scope():
+    assert compile("let x = 1; fn(x) x", fold=True) == compile("fn(x) x")
+    out = fold_constants(statements("let x = 1; let x = y; x").val)
+    assert len(out) == 2 and not isinstance(out[1].inner, ConstExpr)
+
+
+def test_fold_leaves_errors_for_runtime():
+    e = binary("//", "1", "0")
+    assert fold_constants(e) is e
+
+
+def test_run_binary():
+    s = statements("let x = 7; x").val
+    s[1].inner = binary("%", s[1].inner, "4")
+    code = compile(s).spec.code
+    assert any(isinstance(instr, BinaryOp) for instr in code)
+    assert run(compile(s)) == Int(3)
+    assert run(compile(s, fold=True)) == Int(3)
+
+
+def test_fold_power():
+    folds_to(binary("**", "2", "10"), Int(1024))
+    # Too large to compute at compile time
+    e = binary("**", "10", binary("**", "10", "9"))
+    assert isinstance(fold_constants(e), BinaryExpr)
+    assert isinstance(fold_constants(binary("<<", "1", binary("**", "10", "9"))), BinaryExpr)
+
+    # A negative number to a fractional power and a float overflow are errors at runtime
+    for e in [binary("**", UnaryExpr(Span("-"), Span("-"), expr("8").val), "0.5"), binary("**", "10.0", "400")]:
+        assert isinstance(fold_constants(e), BinaryExpr)
+        with pytest.raises(VmError, match="complex|overflow"):
+            run(compile(e))
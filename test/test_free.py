@@ -179,3 +179,17 @@ def test_assign_statement_free_bound():
     statement_binds("x = 1")
     statement_early_binds("x = 1")
     statement_free("x = 1")
+
+
+def test_loop_statement_free_bound():
+    statement_binds("loop { x; }")
+    statement_free("loop { let x = 1; x; y; }", {"y"})
+
+
+def test_break_statement_free_bound():
+    statement_free("break x", {"x"})
+    statement_free("break 'a")
+
+
+def test_match_statement_free_bound():
+    statement_free("match x { [y, ...z] -> f(y, z) }", {"x", "f"})
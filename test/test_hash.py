@@ -0,0 +1,43 @@
+from parse import expr
+from tree import *
+
+
+def same_structure(a, b):
+    a, b = expr(a).val, expr(b).val
+    table = HashCons()
+    return structural_hash(a) == structural_hash(b) and table.intern(a) is table.intern(b)
+
+
+def test_structural_hash_ignores_spans():
+    assert same_structure("f(x, [1, 2])", "f( x,[ 1,2 ] )")
+    assert same_structure('fn(x) "a{x}b"', 'fn( x )   "a{x}b"')
+
+
+def test_structural_hash_distinguishes_tokens():
+    assert not same_structure("f(x)", "f(y)")
+    assert not same_structure("[1, 2]", "[1, 3]")
+    assert not same_structure(":a", "a")
+    assert not same_structure('"a{x}b"', '"ab{x}"')
+
+
+def test_structural_hash_memo():
+    e = expr("f([1, 2], [1, 2])").val
+    memo = {}
+    structural_hash(e, memo)
+    assert len(memo) == 8
+    assert memo[id(e.args[0])] == memo[id(e.args[1])]
+
+
+def test_hashcons_shares_subtrees():
+    table = HashCons()
+    e = table.intern(expr("f([1, 2], [1, 2], g([1, 2]))").val)
+    assert e.args[0] is e.args[1] is e.args[2].args[0]
+    assert len(table) == 7
+
+
+def test_hashcons_keeps_canonical_nodes():
+    table = HashCons()
+    a = expr("[x, y]").val
+    assert table.intern(a) is a, "first occurrence becomes canonical"
+    b = expr("[x,y]").val
+    assert table.intern(b) is a
@@ -0,0 +1,68 @@
+import pytest
+
+from compile import compile
+from errors import CompileError
+from incremental import IncrementalBuild
+from vm import run
+
+MODULE = """
+let k = 1;
+let pair = fn(a, b) [a, b, k];
+fn even(n) { match n { [] -> :even, [_, ...r] -> odd(r) } };
+fn odd(n) { match n { [] -> :odd, [_, ...r] -> even(r) } };
+let id = fn(x) x;
+fn swap(p) { match p { [a, b, _] -> pair(b, a) } };
+[even([1, 2, 3]), swap(pair(1, 2)), id(:x)]
+"""
+
+
+def test_only_changed_functions():
+    build = IncrementalBuild()
+    closure = build.build(MODULE)
+    assert (build.stats.compiled, build.stats.reused) == (5, 0)
+    assert closure == compile(MODULE)
+
+    build.build(MODULE)
+    assert (build.stats.compiled, build.stats.reused) == (0, 5)
+    assert run(closure) == run(MODULE)
+
+    changed = MODULE.replace("let id = fn(x) x;", "let id = fn(x) [x];")
+    assert build.build(changed) is closure, "the first closure is patched in place"
+    assert closure.spec.steps is None, "the code threaded by the first run is dropped"
+    assert (build.stats.compiled, build.stats.reused) == (1, 4)
+    assert closure == compile(changed)
+    assert run(closure) == run(changed)
+
+
+def test_dependents():
+    changed = MODULE.replace("let k = 1;", "let k = 2;")
+    for options, compiled in [({}, 0), ({"fold": True}, 1), ({"inline": True, "fold": True}, 1)]:
+        build = IncrementalBuild(**options)
+        build.build(MODULE)
+        closure = build.build(changed)
+        assert build.stats.compiled == compiled, options
+        assert closure == compile(changed, **options)
+
+
+def test_code_passes():
+    options = {"peephole": True, "escape": True, "superinstructions": True}
+    changed = MODULE.replace("[a, b, k]", "[b, a, k]")
+    build = IncrementalBuild(**options)
+    build.build(MODULE)
+    assert build.build(changed) == compile(changed, **options)
+    assert build.stats.compiled == 1
+    # Kept code is copied before the code passes rewrite it
+    assert build.build(MODULE) == compile(MODULE, **options)
+
+
+def test_errors():
+    with pytest.raises(ValueError):
+        IncrementalBuild(ssa=True)
+    build = IncrementalBuild()
+    with pytest.raises(CompileError):
+        build.build("let = ;")
+    # A failed build leaves the previous one in place
+    closure = build.build(MODULE)
+    with pytest.raises(CompileError):
+        build.build("fn (")
+    assert build.build(MODULE) is closure and build.stats.compiled == 0
@@ -0,0 +1,60 @@
+from compile import compile
+from infer import infer, specialize
+from instr import BinaryOp, Compare, FloatBinaryOp, IntBinaryOp, NumberCompare, StringConcat
+from tree import BinaryExpr, IdExpr, walk
+from value import Array, Bool, Closure, Float, Int, String
+from vm import run
+
+from test.helpers import program
+
+
+def types_of(source):
+    """The types of the identifiers in the last statement"""
+    module = program(source)
+    types = infer(module)
+    return [types[id(node)] for node in walk(module[-1]) if isinstance(node, IdExpr)]
+
+
+def instrs(closure):
+    return {type(instr) for instr in closure.spec.code}
+
+
+def test_synth():
+    source = 'let a = 1; let b = add(a, 2.5); let c = lt(a, b); let d = add("x", "y"); let f = fn(x) x; [a, b, c, d, f]'
+    assert types_of(source) == [Int, Float, Bool, String, Closure]
+    # Parameters and calls are unknown
+    assert types_of("let f = fn(x) add(x, 1); let y = f(1); [y]") == [None]
+    # A name keeps its type only if every assignment agrees with it
+    assert types_of("let a = 1; let b = 1; a = add(a, 1); b = 0.5; [a, b]") == [Int, None]
+    # Which can depend on another name becoming unstable first
+    assert types_of("let a = 1; let b = 1; a = b; b = 0.5; [a, b]") == [None, None]
+    # The value of a loop is that of its `break`s
+    assert types_of("let n = 0; let a = loop { match n { 3 -> { break n }, _ -> { n = add(n, 1) } } }; [a]") == [Int]
+
+
+def test_specialize():
+    source = 'let a = 2; let b = 0.5; [add(a, 3), mul(b, a), add("x", "y"), lt(a, b), eq(a, 2), eq(a, b), div(a, 4)]'
+    module = program(source)
+    specialized = compile(module, specialize=True)
+    assert {IntBinaryOp, FloatBinaryOp, StringConcat, NumberCompare, BinaryOp, Compare} <= instrs(specialized)
+    assert run(specialized) == run(compile(module)) == Array(
+        [Int(5), Float(1.0), String("xy"), Bool(False), Bool(True), Bool(False), Float(0.5)]
+    )
+
+    # Unknown and unstable operands keep the generic instructions
+    assert instrs(compile(program("let f = fn(x) add(x, 1); f(1)"), specialize=True)).isdisjoint({IntBinaryOp})
+    code = compile(program("let a = 1; a = 0.5; add(a, 1)"), specialize=True).spec.code
+    assert BinaryOp in {type(instr) for instr in code} and IntBinaryOp not in {type(instr) for instr in code}
+
+
+def test_loop_kernel():
+    source = """
+    let i = 0; let acc = 0; let x = 1.0;
+    loop { match i { 50 -> { break [acc, x] }, _ -> { acc = add(acc, mul(i, 3)); x = mul(x, 0.5); i = add(i, 1) } } }
+    """
+    module = program(source)
+    expected = run(compile(module))
+    for level in (1, 2):
+        closure = compile(module, level=level, debug=True)
+        assert run(closure) == expected
+    assert not any(isinstance(node, BinaryExpr) and node.operand_types is None for node in walk(specialize(module)[-1]))
@@ -0,0 +1,73 @@
+import pytest
+
+from compile import compile, inline_functions
+from instr import Call, ClosureNew
+from parse import statements
+from tree import BlockExpr, ExprStatement, LetStatement
+from value import Array, Int, Tag
+from vm import run
+
+
+def inlined(source):
+    return inline_functions(statements(source).val)
+
+
+def same(source, **kwargs):
+    assert run(compile(source, inline=True, **kwargs)) == run(source), source
+
+
+def test_immediately_invoked():
+    [statement] = inlined("(fn(x) x)(123)")
+    assert isinstance(statement.inner, BlockExpr)
+    code = compile("(fn(x) x)(123)", inline=True).spec.code
+    assert not any(isinstance(instr, (ClosureNew, Call)) for instr in code)
+    assert run(compile("(fn(x) x)(123)", inline=True)) == Int(123)
+
+
+def test_let_bound():
+    # The `let` goes away once every call is inlined
+    assert [type(s) for s in inlined("let f = fn(x) x; f(:y)")] == [ExprStatement]
+    same("let f = fn(x) x; f(:y)")
+    same("let f = fn(a) { let b = a; [b, a] }; [f(1), f(2)]")
+
+
+def test_escaping():
+    out = inlined("let f = fn(a) a; let g = f; g(:esc)")
+    assert isinstance(out[0], LetStatement) and out[0].pattern.name.str() == "f"
+    same("let f = fn(a) a; let g = f; g(:esc)")
+
+
+def test_renaming():
+    # Arguments are evaluated outside the body, where `x` is the outer binding
+    assert run(compile("let x = :outer; let f = fn(x, y) y; f(1, x)", inline=True)) == Tag(":outer")
+    # `f` cannot be inlined where its free variable `k` is shadowed
+    source = "let k = :k; let f = fn(a) [a, k]; let g = fn(k) f(k); g(:arg)"
+    assert run(compile(source, inline=True)) == Array([Tag(":arg"), Tag(":k")])
+    same(source, fold=True, peephole=True, reuse_slots=True)
+
+
+def test_budget():
+    body = "[" + ", ".join(["a"] * 50) + "]"
+    source = f"let f = fn(a) {body}; [f(1), f(2)]"
+    assert isinstance(inlined(source)[0], LetStatement)
+    source = f"let f = fn(a) {body}; f(1)"
+    assert [type(s) for s in inlined(source)] == [ExprStatement]
+    same(source)
+
+
+def test_captured_by_value():
+    # Closures capture by value, so functions whose free variables are assigned stay closures
+    for source in [
+        "let a = [1]; let f = fn() a; a = [2]; f()",
+        "let a = 1; let f = fn() { a = 5; a }; [f(), a]",
+        "let c = 1; let f = fn() c; let g = fn() f(); c = 2; g()",
+        "let a = 1; [(fn() { a = 5; a })(), a]",
+    ]:
+        assert run(compile(source, level=2)) == run(compile(source)), source
+
+
+def test_undefined():
+    # Inlining must not hide a function capturing a name before it is defined
+    for level in (0, 2):
+        with pytest.raises(KeyError, match="Undefined reference to y"):
+            compile("let f = fn(x) [x, y]; let y = 1; 0", level=level)
@@ -0,0 +1,76 @@
+import pytest
+
+from compile import LEVELS, compile
+from errors import VmError
+from instr import ClosureNew
+from jit import translate
+from vm import Profile, Vm, run
+
+from test.helpers import PAIRS, REVERSE, SOURCES, program
+
+KERNEL = program(
+    """
+fn work(n) { let i = 0; let acc = 0; loop { match i { n -> { break acc }, _ -> { acc = add(acc, mul(i, 3)); i = add(i, 1) } } } };
+[work(5), work(10), work(20)]
+"""
+)
+
+
+def nested(closure):
+    return [instr.spec for instr in closure.spec.code if isinstance(instr, ClosureNew)]
+
+
+def test_same_results():
+    for source in [*SOURCES, REVERSE, PAIRS, KERNEL]:
+        for level in LEVELS:
+            closure = compile(source, level=level)
+            expected = run(closure, jit_threshold=None)
+            for threshold in (1, 2):
+                assert run(closure, jit_threshold=threshold) == expected
+
+
+def test_tier_up():
+    closure = compile("fn f(n) { match n { [] -> 0, [_, ...r] -> [f(r)] } }; f([1, 2, 3])")
+    [spec] = nested(closure)
+    Vm(jit_threshold=None).run(closure)
+    assert spec.calls == 0 and spec.jit is None
+    Vm(jit_threshold=6).run(closure)
+    assert spec.calls == 4 and spec.jit is None
+    # Calls are counted across runs, and the compiled function is kept on the spec
+    Vm(jit_threshold=6).run(closure)
+    assert spec.jit is not None
+    compiled = spec.jit
+    assert run(closure) == run(closure, jit_threshold=None) and spec.jit is compiled
+
+    # Profiles count every instruction, so profiled runs only interpret
+    profiles = Profile(), Profile()
+    Vm(profile=profiles[0]).run(closure)
+    Vm(profile=profiles[1], jit_threshold=None).run(closure)
+    assert profiles[0].singles == profiles[1].singles and profiles[0].total() > 0
+
+
+def test_translate():
+    closure = compile(REVERSE)
+    source, cells = translate(nested(closure)[0])
+    # The loop is a Python loop, and pushes and pops are assignments to locals
+    assert "while True:" in source and "continue" in source
+    assert "locals" not in source and "resolve" not in source
+    assert all(name in cells for name in ("Array", "consts"))
+
+
+def test_errors():
+    source = "fn f(n) { match n { [] -> :empty } }; [f([]), f([]), f([1])]"
+    with pytest.raises(VmError) as interpreted:
+        run(compile(source), jit_threshold=None)
+    with pytest.raises(VmError) as compiled:
+        run(compile(source), jit_threshold=1)
+    assert str(compiled.value) == str(interpreted.value)
+
+
+def test_tail_calls():
+    # Tail calls hand the frame back to the VM, so they do not nest Python calls
+    source = f"fn count(xs, n) {{ match xs {{ [] -> n, [_, ...r] -> count(r, [n]) }} }}; count([{', '.join(['1'] * 3000)}], 0)"
+    value = run(compile(source), jit_threshold=1)
+    for _ in range(3000):
+        value = value.values[0]
+    assert value.value == 0
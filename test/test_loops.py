@@ -0,0 +1,84 @@
+import pytest
+
+from compile import LEVELS, compile, hoist_invariants
+from errors import CompileError, VmError
+from instr import Jump
+from parse import statements
+from tree import BlockExpr, LetStatement, LoopExpr, walk
+from value import Array, Int, String, Tag, Unit
+from vm import run
+
+from test.helpers import PAIRS, REVERSE
+
+LABELS = """
+fn labels(xs, t) {
+  let out = [];
+  loop {
+    let prefix = "<{t}>";
+    match xs {
+      [] -> { break out },
+      [x, ...r] -> { out = [...out, "{prefix}{x}"]; xs = r }
+    }
+  }
+};
+labels([1, 2], :a)
+"""
+
+
+def test_loops():
+    assert run(compile(REVERSE)) == Array([Int(3), Int(2), Int(1)])
+    pairs = Array([Array([Int(1), Int(1)]), Array([Int(2), Int(1)])])
+    for options in [{}, {"reuse_slots": True}, {"escape": True}]:
+        for level in LEVELS:
+            assert run(compile(PAIRS, level=level, debug=True, **options)) == pairs
+    # Without `break`, the loop has no value
+    assert run(compile("let xs = [1]; loop { match xs { [] -> { break }, _ -> { xs = [] } } }")) == Unit()
+
+
+def test_direct_jumps():
+    code = compile(REVERSE).spec.code[1].spec.code
+    backward = [i for i, instr in enumerate(code) if isinstance(instr, Jump) and instr.dest <= i]
+    assert len(backward) == 1
+
+
+def test_loop_errors():
+    with pytest.raises(CompileError, match="outside of a loop"):
+        compile("break")
+    with pytest.raises(CompileError, match="outside of a loop"):
+        compile("loop { let f = fn(x) { continue }; f(1) }")
+    with pytest.raises(CompileError, match="undefined loop label 'b"):
+        compile("'a: loop { break 'b }")
+    # Inlining must not move a `break` into a loop
+    with pytest.raises(CompileError, match="outside of a loop"):
+        compile("let f = fn(x) { break }; loop { f(1) }", inline=True)
+
+
+def test_licm():
+    module = statements(LABELS).val
+    hoisted = hoist_invariants(module)
+    lets = [node for node in walk(hoisted[0]) if isinstance(node, LetStatement)]
+    assert [let.pattern.name.str() for let in lets] == ["out", "loop%0", "prefix"]
+    assert lets[1].inner.span.str() == '"<{t}>"'
+    block = next(node for node in walk(hoisted[0]) if isinstance(node, BlockExpr) and node.statements[0] is lets[1])
+    assert isinstance(block.statements[1].inner, LoopExpr)
+
+    expected = Array([String("<:a>1"), String("<:a>2")])
+    assert run(compile(LABELS)) == run(compile(LABELS, level=2, debug=True)) == expected
+
+    # Assigned names and expressions after the loop may be left are not invariant
+    for source in [
+        "let xs = [1]; loop { let s = \"{xs}\"; match xs { [] -> { break s }, _ -> { xs = [] } } }",
+        "let t = :a; loop { match t { _ -> { break } }; let s = \"{t}\" }",
+    ]:
+        module = statements(source).val
+        assert hoist_invariants(module) == module
+    assert run(compile("let t = :a; loop { let s = \"{t}\"; break s }", level=2)) == String(":a")
+
+    # Interpolation can fail, so it stays after a call that might fail first
+    source = "let t = [1]; let f = fn(x) match x { 0 -> 0 }; loop { f(1); let s = \"{t}\" }"
+    module = statements(source).val
+    assert hoist_invariants(module) == module
+    for level in LEVELS:
+        with pytest.raises(VmError, match="No match arm matched"):
+            run(compile(source, level=level))
+    assert run(compile("let t = :a; loop { break }; t", level=2)) == Tag(":a")
@@ -0,0 +1,28 @@
+from compile import compile, precompile
+from parse import statements
+from vm import run
+
+MODULE = """
+fn even(n) { match n { [] -> :even, [_, ...r] -> odd(r) } };
+fn odd(n) { match n { [] -> :odd, [_, ...r] -> even(r) } };
+let pair = fn(a, b) [a, b];
+let k = 1;
+fn swap(p) { match p { [a, b] -> pair(b, a) } };
+let greet = fn(x) "hello {x}";
+let adder = fn(x) fn(y) [x, y, k];
+fn wrap(x) { let add = adder(x); add(x) };
+[even([1, 2, 3]), swap(pair(1, 2)), greet(:you), wrap(2)]
+"""
+
+
+def test_same_code():
+    for options in [{}, {"reuse_slots": True}, {"escape": True}, {"share_specs": True}, {"peephole": True}]:
+        assert compile(MODULE, jobs=3, **options) == compile(MODULE, **options), options
+    assert run(compile(MODULE, jobs=2)) == run(MODULE)
+
+
+def test_precompiled_functions():
+    module = statements(MODULE).val
+    precompiled = precompile(module, 4)
+    assert len(module) == 9 and len(precompiled) == 7
+    assert precompile(module, 1) == {}
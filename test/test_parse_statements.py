@@ -58,6 +58,9 @@ def test_loop_statement():
     fails_parse("loop }")
     parses_to("loop {}", LoopStatement)
     parses_to("loop {x; y}", LoopStatement)
+    parses_to("'outer: loop { loop { break 'outer } }", LoopStatement)
+    assert statement("'outer: loop {}").val.loop_expr.label.str() == "'outer"
+    assert statement("loop {}").val.loop_expr.label is None
 
 
 def test_match_statement():
@@ -0,0 +1,91 @@
+from compile import compile
+from instr import Arg, Assert, Call, ClosureNew, Imm, LocalJump, Pop, Push, Stack, Store, StringFormat
+from peephole import optimize, optimize_code
+from value import ClosureSpec, Int, String, Unit
+from vm import run
+
+
+def test_irrefutable_let():
+    assert compile('let f = fn(x) x; f"hello"', peephole=True).spec.code == [
+        ClosureNew(ClosureSpec([Push(Arg(0))], 1, [])),
+        Push(Stack(0)),
+        Push(Imm(String("hello"))),
+        Call(Stack(1), 1),
+    ]
+
+
+def test_dead_pushes():
+    code = compile("let x = 1; { let y = x; }; fn(a) { let b = a; b }", peephole=True).spec.code
+    assert code == [ClosureNew(ClosureSpec([Push(Arg(0))], 1, []))]
+
+
+def test_format_operands():
+    assert compile('"a{1}b"', peephole=True).spec.code == [StringFormat(["a", "b"], [Imm(Int(1))])]
+    assert compile('fn(x) "a{x}b"', peephole=True).spec.code[0].spec.code == [StringFormat(["a", "b"], [Arg(0)])]
+
+
+def test_report():
+    closure = compile("let f = fn(x) { let y = x; y }; f(1)")
+    report = optimize(closure)
+    assert (report.before, report.after, report.specs) == (10, 5, 2)
+    assert str(report) == "peephole: 10 -> 5 instructions in 2 code objects"
+
+
+def test_jump_targets():
+    code = [
+        Push(Imm(Int(0))),
+        Push(Arg(0)),
+        LocalJump(Stack(1), 4),
+        Assert(Stack(1), ""),
+        Push(Stack(1)),
+    ]
+    assert optimize_code(code) == [
+        Push(Arg(0)),
+        LocalJump(Stack(0), 3),
+        Assert(Stack(0), ""),
+        Push(Stack(0)),
+    ]
+
+
+def test_pop_counts():
+    code = [
+        Push(Arg(0)),
+        Push(Imm(Unit())),
+        Push(Arg(1)),
+        Call(Stack(0), 1),
+        Pop(2),
+        Push(Stack(0)),
+    ]
+    assert optimize_code(code) == [
+        Push(Arg(0)),
+        Push(Arg(1)),
+        Call(Stack(0), 1),
+        Pop(1),
+        Push(Stack(0)),
+    ]
+    assert optimize_code([Push(Imm(Int(1))), Push(Imm(Int(2))), Pop(1)]) == [
+        Push(Imm(Int(1)))
+    ]
+
+
+def test_same_result():
+    for source in [
+        "(fn(x) x)(123)",
+        "(fn() 123)()",
+        "let f = fn(x) x; f(123)",
+        'let f = fn(x) { let y = x; y }; { let z = f; z }("hello")',
+    ]:
+        assert run(compile(source, peephole=True)) == run(compile(source)), source
+
+
+def test_redundant_stores():
+    assert optimize_code([Push(Arg(0)), Store(Stack(0), Arg(0))]) == [Push(Arg(0))]
+    code = [
+        Push(Arg(0)),
+        Push(Arg(1)),
+        Call(Stack(0), 1),
+        Push(Stack(1)),
+        Store(Stack(1), Stack(2)),
+        Pop(1),
+    ]
+    assert optimize_code(code) == [Push(Arg(1)), Call(Arg(0), 1)]
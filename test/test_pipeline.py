@@ -0,0 +1,74 @@
+import pytest
+
+from compile import LEVELS, compile, pass_names
+from errors import CompileError
+from instr import Jump, Pop, Push, PushArrayPush, Stack
+from pipeline import CODE, REGISTRY, Pipeline, PipelineReport, code_size, order, register, verify
+from value import Closure, Int
+from vm import run
+
+from test.helpers import SOURCES
+
+
+def test_order():
+    names = [p.name for p in order(["constant_pools", "peephole", "fold", "inline", "superinstructions"])]
+    assert names == ["inline", "fold", "peephole", "superinstructions", "constant_pools"]
+    assert [p.name for p in order(["fold"])] == ["fold"]
+
+
+def test_order_errors():
+    with pytest.raises(CompileError, match="Unknown pass"):
+        order(["nope"])
+    register("test_a", CODE, lambda closure: None, after=("test_b",))
+    register("test_b", CODE, lambda closure: None, after=("test_a",))
+    try:
+        with pytest.raises(CompileError, match="cycle"):
+            order(["test_a", "test_b"])
+        assert [p.name for p in order(["test_a"])] == ["test_a"]
+    finally:
+        del REGISTRY["test_a"], REGISTRY["test_b"]
+
+
+def test_levels():
+    with pytest.raises(ValueError):
+        pass_names(3)
+    assert pass_names(0, escape=True) == ["lift"]
+    for source in SOURCES:
+        expected = run(compile(source))
+        for level in LEVELS:
+            assert run(compile(source, level=level, debug=True)) == expected
+
+
+def test_verify():
+    verify(Closure.from_code([Push(Int(1)), Push(Stack(0))]))
+    with pytest.raises(CompileError, match="jump target"):
+        verify(Closure.from_code([Jump(5)]))
+    with pytest.raises(CompileError, match="stack slot"):
+        verify(Closure.from_code([Push(Int(1)), Push(Stack(1))]))
+    with pytest.raises(CompileError, match="pops"):
+        verify(Closure.from_code([Pop(1)]))
+
+    register("test_break", CODE, lambda closure: closure.spec.code.append(Pop(1)))
+    try:
+        Pipeline(["test_break"]).run_code(Closure.from_code([]))
+        with pytest.raises(CompileError, match="After pass 'test_break'"):
+            Pipeline(["test_break"], debug=True).run_code(Closure.from_code([]))
+    finally:
+        del REGISTRY["test_break"]
+
+
+def test_report():
+    report = PipelineReport()
+    compile(SOURCES[2], level=2, report=report)
+    assert [stats.name for stats in report.passes] == list(LEVELS[2])
+    peephole = next(stats for stats in report.passes if stats.name == "peephole")
+    assert peephole.after <= peephole.before and peephole.seconds >= 0
+
+
+def test_hoisted_bodies():
+    # Closures without captures are hoisted to literals, whose bodies the code passes and `code_size` reach too
+    closure = compile("fn g(x) { [x, 1, 2] }; g(1); g(2); 0", level=2)
+    [body] = [value.spec for value in closure.spec.constants if isinstance(value, Closure)]
+    assert len(body.code) == 4 and any(isinstance(instr, PushArrayPush) for instr in body.code)
+    assert body.constants == [Int(1), Int(2)]
+    assert code_size(closure.spec) == len(closure.spec.code) + len(body.code)
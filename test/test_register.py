@@ -0,0 +1,47 @@
+from compile import compile
+from instr import Imm, Reg
+from register import Call, TailCall
+from regvm import run
+from ssa.registers import sequentialize
+from value import Int, Tag
+import vm
+
+
+def same(source):
+    assert run(source) == vm.run(source), source
+
+
+def test_same_result():
+    same("123")
+    same("let f = fn(x) x; f(:y)")
+    same("let [a, b] = [1, 2]; [b, a, ...[a]]")
+    same("match [1, [2, 3]] { [a, [b, ...c]] -> [c, b, a], _ -> :no }")
+    same("let v = match :a { :a -> 1, _ -> 2 }; [v, v]")
+    same("fn even(n) { match n { [] -> :even, [_, ...r] -> odd(r) } }; fn odd(n) { match n { [] -> :odd, [_, ...r] -> even(r) } }; even([1, 2, 3])")
+    same("let n = 0; n = 1; n")
+    same("let xs = [1, 2, 3]; let n = []; loop { match xs { [] -> { break n }, [x, ...r] -> { xs = r; n = [x, ...n] } } }")
+
+
+def test_three_address():
+    source = "let f = fn(x, y) [y, x]; [f(1, 2), f(3, 4)]"
+    code = compile(source, registers=True).spec.code
+    assert Call(Reg(2), Reg(0), [Imm(Int(1)), Imm(Int(2))]) in code
+    assert len(code) * 2 <= len(compile(source).spec.code)
+    assert len(compile(source, registers=True).spec.code) < len(compile(source, peephole=True).spec.code)
+
+
+def test_tail_calls():
+    code = compile("fn f(n) { match n { [] -> :done, [_, ...r] -> f(r) } }; f([1, 2])", registers=True).spec.code
+    assert isinstance(code[-1], TailCall)
+    deep = "[" + ", ".join(["1"] * 2000) + "]"
+    assert run(f"fn f(n) {{ match n {{ [] -> :done, [_, ...r] -> f(r) }} }}; f({deep})") == Tag(":done")
+
+
+def test_sequentialize():
+    scratch = iter(Reg(i) for i in range(10, 20))
+    moves = sequentialize([(Reg(0), Reg(1)), (Reg(1), Reg(0)), (Reg(2), Reg(0))], lambda: next(scratch))
+    regs = {Reg(0): "a", Reg(1): "b", Reg(2): None}
+    for dest, src in moves:
+        regs[dest] = regs[src]
+    assert (regs[Reg(0)], regs[Reg(1)], regs[Reg(2)]) == ("b", "a", "a")
+    assert sequentialize([(Reg(0), Reg(0))], lambda: next(scratch)) == []
@@ -1,4 +1,6 @@
-from value import Float, Int, String, Tag
+from errors import VmError
+from value import Array, Float, Int, String, Tag
+from compile import compile
 from vm import run
 
 
@@ -25,6 +27,14 @@ def test_run_string():
     assert run('let f = fn(x) x; f"hello"') == run('let f = fn(x) x; f("hello")')
 
 
+def test_run_interpolation():
+    value(
+        'let f = fn(x) "<{x}>"; [f(1), f(2.5), f(:a), f("s")]',
+        Array([String("<1>"), String("<2.5>"), String("<:a>"), String("<s>")]),
+    )
+    value('let f = fn(x) x; f"a{"b{1}c"}d"', String(value="ab1cd"))
+
+
 def test_run_let_statement():
     value("let f = fn(x) x; f(123)", Int(value=123))
 
@@ -32,3 +42,54 @@ def test_run_let_statement():
 def test_run_fn():
     value("(fn() 123)()", Int(value=123))
     value("(fn(x) x)(123)", Int(value=123))
+
+
+def test_run_reuse_slots():
+    for source in [
+        "let x = 1; let y = 2; x",
+        "let f = fn(x) { let a = x; let b = a; b }; let g = f; g(5)",
+        '{ let a = "a"; let b = { let c = a; c }; b }',
+    ]:
+        assert run(compile(source, reuse_slots=True)) == run(source), source
+
+
+def test_run_match():
+    value("match :b { :a -> 1, :b -> 2, _ -> 3 }", Int(2))
+    value('match "hi" { "ho" -> 1, "hi" -> 2 }', Int(2))
+    value("match 7 { 1 -> :one, y @ 7 -> y, _ -> :other }", Int(7))
+    value("match [1, [2, 3]] { [a, [b, c]] -> c, _ -> 0 }", Int(3))
+    value("match [1, 2, 3, 4] { [a, b] -> a, [a, ..., b] -> b }", Int(4))
+    value("match [5] { [a, ...r, b] -> :long, [y] -> y }", Int(5))
+    for peephole in [False, True]:
+        source = "match [1, 2, 3] { [] -> 0, [a] -> a, [a, ...rest] -> rest }"
+        assert run(compile(source, peephole=peephole)) == Array([Int(2), Int(3)])
+
+
+def test_run_refutable_let():
+    value("let [a, ...r] = [1, 2, 3]; a", Int(1))
+    for source in ["match :c { :a -> 1 }", "let [a, b] = [1]; a"]:
+        try:
+            run(source)
+        except VmError:
+            pass
+        else:
+            assert False, source
+
+
+def test_run_fn_statement():
+    value("let k = :k; fn f() { k }; f()", Tag(":k"))
+    value("fn last(xs) { match xs { [x] -> x, [x, ...r] -> last(r) } }; last([1, 2, 3])", Int(3))
+    value(
+        "fn even(xs) { match xs { [] -> :even, [x, ...r] -> odd(r) } };"
+        "fn odd(xs) { match xs { [] -> :odd, [x, ...r] -> even(r) } };"
+        "odd([1, 2, 3])",
+        Tag(":even"),
+    )
+
+
+def test_run_tail_calls():
+    # Deeper than the Python recursion limit allows without frame reuse
+    items = ", ".join(["1"] * 5000)
+    source = f"fn walk(xs) {{ match xs {{ [] -> :done, [x, ...r] -> walk(r) }} }}; walk([{items}])"
+    for peephole in [False, True]:
+        assert run(compile(source, peephole=peephole)) == Tag(":done")
@@ -0,0 +1,124 @@
+import pytest
+
+from comb import Span
+from compile import compile
+from errors import CompileError
+from instr import BinaryOp, TailCall
+from parse import statements
+from ssa import ssa
+from ssa.build import build
+from ssa.passes import copy_propagation, cse, dce, dominators, gvn, optimize
+from tree import BinaryExpr, IdExpr, Transformer
+from value import Tag
+from vm import run
+
+
+class Square(Transformer):
+    """Replace `sq` with `x * x`, since the parser has no binary operators"""
+
+    def visit_IdExpr(self, expr):
+        if expr.span.str() == "sq":
+            x = IdExpr(Span("x"))
+            return BinaryExpr(Span("*"), Span("*"), x, x)
+        return expr
+
+
+def squared(source):
+    return [Square().visit(statement) for statement in statements(source).val]
+
+
+def count(function, kind):
+    return sum(isinstance(op, kind) for block in function.blocks for op in block.all_ops())
+
+
+def same(source):
+    assert run(compile(source, ssa=True)) == run(compile(source)), source
+    assert run(compile(source, ssa=True, peephole=True)) == run(compile(source)), source
+
+
+def test_same_result():
+    same("123")
+    same("let f = fn(x) x; f(:y)")
+    same("let [a, b] = [1, 2]; [b, a, ...[a]]")
+    same("match [1, [2, 3]] { [a, [b, ...c]] -> [c, b, a], _ -> :no }")
+    same("let g = fn(x) match x { :a -> 1, :b -> 2, _ -> 3 }; [g(:a), g(:b), g(:c)]")
+    same("fn even(n) { match n { [] -> :even, [_, ...r] -> odd(r) } }; fn odd(n) { match n { [] -> :odd, [_, ...r] -> even(r) } }; even([1, 2, 3])")
+
+
+def test_phis():
+    function = build(statements("let v = match :a { :a -> 1, _ -> 2 }; [v]").val)
+    [join] = [block for block in function.blocks if block.phis]
+    assert len(join.phis) == 1 and len(join.phis[0].incoming) == 2
+    assert "phi" in str(function)
+
+
+def test_copy_propagation():
+    function = build(statements("let x = [1]; let y = x; let z = y; z").val)
+    copy_propagation(function)
+    assert str(function).count("newarray") == 1
+    [ret] = [block.terminator for block in function.blocks]
+    assert ret.value is function.entry.ops[0].dest
+
+
+def test_cse_and_gvn():
+    source = "let f = fn(x) [sq, sq]; f(3)"
+    function = build(squared(source))
+    [inner] = function.nested()
+    assert count(inner, ssa.BinOp) == 2
+    assert cse(inner) and copy_propagation(inner)
+    assert count(inner, ssa.BinOp) == 1
+
+    # A value computed before a match is available in every arm
+    function = build(squared("let f = fn(x) { let y = sq; match x { 2 -> [sq, y], _ -> sq } }; f(2)"))
+    [inner] = function.nested()
+    assert not cse(inner)
+    assert gvn(inner) and copy_propagation(inner)
+    assert count(inner, ssa.BinOp) == 1
+
+
+def test_dce():
+    function = build(statements("let unused = fn(x) x; let a = [1, 2]; :kept").val)
+    assert dce(function)
+    assert count(function, ssa.MakeClosure) == 0 and count(function, ssa.NewArray) == 0
+
+    # Unreachable arms go away with their blocks
+    function = optimize(build(statements("match :a { x -> x, :a -> :never }").val))
+    assert len(function.blocks) == 1
+
+
+def test_dominators():
+    function = build(statements("match :a { :a -> 1, _ -> 2 }").val)
+    idom = dominators(function)
+    assert all(idom[block] is function.entry for block in function.entry.successors())
+
+
+def test_lowering():
+    code = compile(squared("let f = fn(x) [sq, sq]; f(3)"), ssa=True).spec.code
+    assert isinstance(code[-1], TailCall)
+    assert sum(isinstance(instr, BinaryOp) for instr in code[0].spec.code) == 1
+    assert run(compile("fn f(n) { match n { [] -> :done, [_, ...r] -> f(r) } }; f([1, 2, 3])", ssa=True)) == Tag(":done")
+
+
+LOOPS = [
+    "let n = 0; n = 1; n",
+    "let n = 0; let r = match :a { :a -> { n = 5; 1 }, _ -> 2 }; [n, r]",
+    "let xs = [1, 2, 3]; let n = []; loop { match xs { [] -> { break }, [x, ...r] -> { xs = r; n = [x, ...n] } } }; n",
+    "let n = [1, 2]; let v = 'outer: loop { loop { match n { [] -> { break 'outer :done }, [_, ...r] -> { n = r; continue 'outer } } } }; [v, n]",
+    "let n = 1; let f = fn(x) { n = x; n }; [f(2), n]",
+]
+
+
+def test_assignment_and_loops():
+    for source in LOOPS:
+        same(source)
+
+    # Both assigned names get a phi in the header of the loop, which the end of the body jumps back to
+    function = build(statements(LOOPS[2]).val)
+    header = function.entry.terminator.target
+    assert len(header.phis) == 2
+    assert all(len(phi.incoming) == 2 for phi in header.phis)
+
+    with pytest.raises(CompileError, match="outside of a loop"):
+        build(statements("break").val)
+    with pytest.raises(CompileError, match="undefined loop label"):
+        build(statements("loop { continue 'nope }").val)
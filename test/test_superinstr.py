@@ -0,0 +1,53 @@
+from compile import compile
+from instr import Arg, ArrayPush, Call, Imm, Jump, Pop, Push, PushArrayPush, PushCall, Stack, Store, StorePop
+from superinstr import fuse_code
+from value import Int
+from vm import Profile, run
+
+SOURCES = [
+    "let f = fn(x, y) [y, x, 1, 2]; [f(1, 2), f(3, 4), ...f(5, 6)]",
+    "fn f(n) { match n { [] -> :done, [_, ...r] -> f(r) } }; f([1, 2, 3, 4, 5])",
+    "let g = fn(x) match x { :a -> 1, :b -> 2, _ -> 3 }; [g(:a), g(:b), g(:c)]",
+]
+
+
+def test_fused_code():
+    code = [
+        Push(Arg(0)),
+        Push(Imm(Int(1))),
+        Push(Arg(1)),
+        Call(Stack(0), 2),
+        Push(Imm(Int(2))),
+        ArrayPush(Stack(1), Stack(2)),
+        Store(Stack(0), Stack(1)),
+        Pop(1),
+    ]
+    assert fuse_code(code) == [
+        Push(Arg(0)),
+        PushCall(Stack(0), [Imm(Int(1)), Arg(1)]),
+        PushArrayPush(Stack(1), Imm(Int(2))),
+        StorePop(Stack(0), Stack(1), 1),
+    ]
+
+
+def test_jump_targets():
+    # The push is skipped by the jump, so the append cannot read its value in place
+    code = [Push(Imm(Int(0))), Jump(3), Push(Imm(Int(1))), ArrayPush(Stack(0), Stack(1))]
+    assert fuse_code(code) == code
+
+
+def test_fewer_dispatches():
+    for source in SOURCES:
+        for options in [{}, {"peephole": True}, {"ssa": True}]:
+            before, after = Profile(), Profile()
+            expected = run(compile(source, **options), before)
+            assert run(compile(source, superinstructions=True, **options), after) == expected
+            assert after.total() < before.total(), (source, options)
+
+
+def test_profile():
+    profile = Profile()
+    run(compile("[1, 2]"), profile)
+    assert profile.singles["Push(Imm)"] == 2
+    assert profile.pairs[("Push(Imm)", "ArrayPush")] == 2
+    assert profile.triples[("Push(Array)", "Push(Imm)", "ArrayPush")] == 1
@@ -0,0 +1,67 @@
+from comb import Span
+from parse import expr
+from tree import *
+
+
+class CountIds(Visitor):
+    def __init__(self):
+        self.count = 0
+
+    def visit_IdExpr(self, node):
+        self.count += 1
+
+
+class RenameX(Transformer):
+    def visit_IdExpr(self, node):
+        if node.span.str() == "x":
+            return IdExpr(Span("y"))
+        return node
+
+
+def test_handler_cached_per_type():
+    visitor = CountIds()
+    visitor.visit(expr("f(x, [x, g(x)])").val)
+    assert visitor.count == 5
+    assert CountIds._handlers[IdExpr] is CountIds.visit_IdExpr
+    assert CountIds._handlers[CallExpr] is Visitor.generic_visit
+    assert IdExpr not in Visitor._handlers, "handler caches are per class"
+
+
+def test_walk_pre_order():
+    e = expr("f(x, g(y))").val
+    names = [type(node).__name__ for node in walk(e)]
+    assert names == ["CallExpr", "IdExpr", "IdExpr", "CallExpr", "IdExpr", "IdExpr"]
+
+    visitor = CountIds()
+    visitor.walk(e)
+    assert visitor.count == 4
+
+
+def test_walk_deep_tree():
+    e = expr("x").val
+    for _ in range(5000):
+        e = ParenExpr(e.span, e.span, e, e.span)
+    assert sum(1 for _ in walk(e)) == 5001
+
+
+def test_transformer_copy_on_write():
+    e = expr("f(x, [z])").val
+    out = RenameX().visit(e)
+    assert out is not e
+    assert e.args[0].span.str() == "x", "input is not modified"
+    assert out.args[0].span.str() == "y"
+    assert out.fn is e.fn and out.args[1] is e.args[1], "unchanged subtrees are shared"
+
+
+def test_transformer_inplace():
+    e = expr("f(x, [x])").val
+    out = RenameX(inplace=True).visit(e)
+    assert out is e
+    assert set(e.free()) == {"f", "y"}
+
+
+def test_child_fields():
+    assert child_fields(CallExpr) == ("fn", "args")
+    assert child_fields(StringExpr) == ("fn", "interpolants")
+    assert child_fields(IdPattern) == ("inner",)
+    assert child_fields(IntExpr) == ()
@@ -1,7 +1,14 @@
-from instr import ArrayPush, Imm, Stack, Push, Return
-from value import Array, Closure, Unit
+import pytest
+
+from compile import compile
+from errors import VmError
+from instr import ArrayPush, ClosureNew, Fail, Imm, IsType, Reg, Stack, Push, Return
+from peephole import optimize
+from value import Array, Closure, Int, Unit
 from vm import Vm
 
+from test.helpers import program
+
 
 # def test_vm():
 #     code = [
@@ -13,3 +20,41 @@ from vm import Vm
 #     vm = Vm()
 #     # assert vm.run(closure) == Array([Unit()]), "bad return value"
 #     # assert vm == Vm(), "bad final vm state"
+
+
+def test_decode():
+    closure = compile("fn f(n) { match n { [] -> 0, [_, ...r] -> [f(r)] } }; f([1, 2])")
+    assert Vm().run(closure) == Array([Array([Int(0)])])
+    # Each spec is decoded once, however often and by however many VMs it runs
+    [inner] = [instr.spec for instr in closure.spec.code if isinstance(instr, ClosureNew)]
+    steps = inner.steps
+    assert len(steps) == len(inner.code) and len(closure.spec.steps) == len(closure.spec.code)
+    assert Vm().run(closure) == Array([Array([Int(0)])])
+    assert inner.steps is steps
+    # Rewriting the code in place drops the steps
+    optimize(closure)
+    assert inner.steps is None
+
+
+def test_return():
+    closure = Closure.from_code([Push(Imm(Int(1))), Return(), Push(Imm(Int(2)))])
+    assert Vm().run(closure) == Int(1)
+
+
+def test_missing_instruction():
+    with pytest.raises(NotImplementedError, match="missing case"):
+        Vm().run(Closure.from_code([IsType(Int)]))
+    # Operands are looked at when the code is threaded, before it runs
+    with pytest.raises(NotImplementedError, match="resolve"):
+        Vm().run(Closure.from_code([Fail("unreachable"), Push(Reg(0))]))
+
+
+def test_deep_recursion():
+    # Far deeper than the Python recursion limit, as calls do not nest Python calls
+    closure = compile(program("fn down(n) { match n { 0 -> 0, _ -> add(down(sub(n, 1)), 1) } }; down(20000)"))
+    assert Vm(jit_threshold=None).run(closure) == Int(20000)
+    # Compiled code does nest them, until calls go back to the interpreter
+    assert Vm(jit_threshold=1).run(closure) == Int(20000)
+
+    with pytest.raises(VmError, match="stack overflow"):
+        Vm(max_depth=1000).run(closure)
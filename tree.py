@@ -1,8 +1,10 @@
-from dataclasses import dataclass, field
-from typing import Optional
+from dataclasses import dataclass, field, fields, replace
+from functools import cache
+from typing import Callable, Optional, get_args, get_type_hints
 
 from comb import Span
 from mixins import Format, GetChildren
+from value import Value
 
 
 def free(statements: list["Statement"]):
@@ -31,56 +33,9 @@ class SyntaxNode(Format):
 @dataclass
 class Expr(SyntaxNode, GetChildren):
     def free(self):
-        match self:
-            case IdExpr():
-                yield self.span.str()
-
-            case FnExpr():
-                bound = set()
-                for pat in self.params:
-                    bound.update(pat.bound())
-                for var in self.inner.free():
-                    if var not in bound:
-                        yield var
-
-            case LoopExpr():
-                yield from free(self.statements)
-
-            case StringExpr():
-                for child in self.positional():
-                    yield from child.free()
-
-            case (
-                ArrayExpr(_)
-                | Spread(_)
-                | ParenExpr(_)
-                | CallExpr(_)
-                | IndexExpr(_)
-                | BinaryExpr(_)
-                | UnaryExpr(_)
-                | ComparisonExpr(_)
-            ):
-                for child in self.positional():
-                    yield from child.free()
-
-            case IntExpr(_) | TagExpr(_) | FloatExpr(_) | StringExpr(_):
-                pass
-
-            case BlockExpr():
-                yield from free(self.statements)
-
-            case MatchExpr():
-                yield from self.subject.free()
-                for pat, expr in self.arms:
-                    bound = pat.bound()
-                    for var in expr.free():
-                        if var not in bound:
-                            yield var
-
-            case _:
-                raise NotImplementedError(f"`{type(self)}.free`")
-
-        return free
+        """Iterate over free variables in expression"""
+
+        return FreeVars().visit(self)
 
 
 @dataclass
@@ -231,6 +186,8 @@ class BinaryExpr(Expr):
     op: Span
     left: Expr
     right: Expr
+    # The types of the operands, where `infer.specialize` proved them
+    operand_types: Optional[tuple[type, ...]] = None
 
     def positional(self):
         yield self.left
@@ -262,6 +219,8 @@ class ComparisonExpr(Expr):
 
     ops: list[Span]  # len(self.ops) == len(self.inner) - 1
     inner: list[Expr]
+    # The types of the operands, where `infer.specialize` proved them
+    operand_types: Optional[tuple[type, ...]] = None
 
     def positional(self):
         yield from self.inner
@@ -276,6 +235,16 @@ class IdExpr(Expr):
     """
 
 
+@dataclass
+class ConstExpr(Expr):
+    """Compile-time constant
+
+    Has no surface syntax; optimization passes put it in place of expressions whose value is known while compiling.
+    """
+
+    value: Value
+
+
 @dataclass
 class FnExpr(Expr):
     """Function expression
@@ -346,9 +315,10 @@ class LoopExpr(Expr):
     """Loop expression
 
     Example:
-        loop { ... }
+        ['label:] loop { ... }
     """
 
+    label: Optional[Span]
     loop_token: Span
     lbrace_token: Span
     statements: list["Statement"]
@@ -365,54 +335,17 @@ class Statement(SyntaxNode, GetChildren):
     def free(self):
         """Iterate over free variables in statement"""
 
-        match self:
-            case ExprStatement():
-                yield from self.inner.free()
-
-            case LetStatement():
-                yield from self.inner.free()
-
-            case AssignStatement():
-                yield from self.pattern.free()
-                yield from self.inner.free()
-
-            case LoopStatement():
-                yield from free(self.statements)
-
-            case MatchStatement():
-                yield from self.match_expr.free()
-
-            case BreakStatement():
-                if self.expr is not None:
-                    yield from self.expr.free()
-
-            case ContinueStatement():
-                pass
-
-            case ReturnStatement():
-                yield from self.inner.free()
-
-            case FnStatement():
-                bound = set()
-                bound.add(self.name.str())
-                for pat in self.params:
-                    bound.update(pat.bound())
-                    for var in free(self.body):
-                        if var not in bound:
-                            yield var
-
-            case _:
-                raise NotImplementedError(f"`{type(self)}.free`")
+        return FreeVars().visit(self)
 
     def early_bound(self):
-        match self:
-            case FnStatement():
-                yield self.name.str()
+        """Iterate over variables bound before the statements in the enclosing block run"""
+
+        return EarlyBoundVars().visit(self)
 
     def bound(self):
-        match self:
-            case LetStatement():
-                yield from self.pattern.bound()
+        """Iterate over variables bound after the statement runs"""
+
+        return BoundVars().visit(self)
 
 
 @dataclass
@@ -579,30 +512,7 @@ class Pattern(SyntaxNode, GetChildren):
     def bound(self):
         """Iterate over bound variables"""
 
-        match self:
-            case IdPattern():
-                yield self.name.str()
-                if self.inner is not None:
-                    yield from self.inner.bound()
-
-            case ArrayPattern():
-                for item in self.items:
-                    yield from item.bound()
-
-            case GatherPattern():
-                yield from self.inner.bound()
-
-            case (
-                IgnorePattern(_)
-                | TagPattern(_)
-                | IntPattern(_)
-                | FloatPattern(_)
-                | StringPattern(_)
-            ):
-                pass
-
-            case _:
-                raise NotImplementedError(f"`{type(self)}.bind`")
+        return BoundVars().visit(self)
 
 
 @dataclass
@@ -716,3 +626,351 @@ class GatherPattern(Pattern):
 Expr.get_children()
 Pattern.get_children()
 Statement.get_children()
+
+
+def _child_type(hint) -> bool:
+    """Does a field annotation hold syntax nodes?"""
+    if isinstance(hint, type):
+        return issubclass(hint, SyntaxNode)
+    return any(_child_type(arg) for arg in get_args(hint))
+
+
+@cache
+def child_fields(ty: type) -> tuple[str, ...]:
+    """Names of the fields of a node type that hold child nodes, in source order"""
+    hints = get_type_hints(ty)
+    return tuple(f.name for f in fields(ty) if _child_type(hints[f.name]))
+
+
+def children(node: SyntaxNode):
+    """Iterate over the direct children of a node"""
+    for name in child_fields(type(node)):
+        value = getattr(node, name)
+        if isinstance(value, list):
+            yield from value
+        elif value is not None:
+            yield value
+
+
+def walk(node: SyntaxNode):
+    """Iterate over a node and all of its descendants in pre-order without recursing"""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(list(children(node))))
+
+
+class Visitor:
+    """Base class for passes over syntax trees
+
+    Handlers are methods named `visit_<class name>`. The handler for a node type is looked up along its MRO the first time the type is seen and cached on the visitor class, so dispatch costs one dict lookup per node.
+    """
+
+    _handlers: dict[type, Callable] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._handlers = {}
+
+    @classmethod
+    def handler(cls, ty: type) -> Callable:
+        try:
+            return cls._handlers[ty]
+        except KeyError:
+            pass
+        for base in ty.__mro__:
+            if (handler := getattr(cls, f"visit_{base.__name__}", None)) is not None:
+                break
+        else:
+            handler = cls.generic_visit
+        cls._handlers[ty] = handler
+        return handler
+
+    def visit(self, node: SyntaxNode):
+        """Dispatch to the handler for `node`"""
+        return self.handler(type(node))(self, node)
+
+    def generic_visit(self, node: SyntaxNode):
+        """Visit the children of a node without a more specific handler"""
+        for child in children(node):
+            self.visit(child)
+
+    def walk(self, node: SyntaxNode):
+        """Call the handler of every node under `node` in pre-order without recursing
+
+        Handlers called this way should not visit their own children; nodes without a specific handler are skipped.
+        """
+        generic = type(self).generic_visit
+        for child in walk(node):
+            if (handler := self.handler(type(child))) is not generic:
+                handler(self, child)
+
+
+class Transformer(Visitor):
+    """Visitor whose handlers return a replacement for the node they are given
+
+    By default rewriting is copy-on-write: a node is copied only if one of its children was replaced, so untouched subtrees are shared with the input. With `inplace=True`, nodes are updated in place instead.
+    """
+
+    def __init__(self, inplace: bool = False):
+        self.inplace = inplace
+
+    def generic_visit(self, node: SyntaxNode) -> SyntaxNode:
+        changes = {}
+        for name in child_fields(type(node)):
+            old = getattr(node, name)
+            if isinstance(old, list):
+                new = [self.visit(child) for child in old]
+                if any(a is not b for a, b in zip(old, new)):
+                    changes[name] = new
+            elif old is not None:
+                new = self.visit(old)
+                if new is not old:
+                    changes[name] = new
+        if not changes:
+            return node
+        if self.inplace:
+            for name, new in changes.items():
+                setattr(node, name, new)
+            return node
+        return replace(node, **changes)
+
+
+class ScopedTransformer(Transformer):
+    """Transformer carrying `env`, facts about names bound outside the node being visited
+
+    Entries for names rebound by a nested scope are dropped inside that scope, and restored when leaving it.
+    """
+
+    def __init__(self, inplace: bool = False):
+        super().__init__(inplace)
+        self.env: dict = {}
+
+    def shadow(self, names):
+        for name in names:
+            self.env.pop(name, None)
+
+    def scoped(self, node: SyntaxNode, names) -> SyntaxNode:
+        saved = dict(self.env)
+        self.shadow(names)
+        node = self.generic_visit(node)
+        self.env = saved
+        return node
+
+    def visit_FnExpr(self, expr):
+        return self.scoped(expr, [var for pat in expr.params for var in pat.bound()])
+
+    def visit_Arm(self, arm):
+        return self.scoped(arm, arm.pattern.bound())
+
+    def visit_BlockExpr(self, expr):
+        return replace(expr, statements=self.visit_statements(expr.statements))
+
+    def visit_LoopExpr(self, expr):
+        return replace(expr, statements=self.visit_statements(expr.statements))
+
+    def visit_BlockStatement(self, statement):
+        return replace(statement, statements=self.visit_statements(statement.statements))
+
+    def visit_FnStatement(self, statement):
+        saved = dict(self.env)
+        self.shadow([statement.name.str()])
+        for pat in statement.params:
+            self.shadow(pat.bound())
+        statement = replace(statement, body=self.visit_statements(statement.body))
+        self.env = saved
+        return statement
+
+    def visit_statements(self, statements: list["Statement"]) -> list["Statement"]:
+        """Visit a block, where each statement is in the scope of the ones before it"""
+        saved = dict(self.env)
+        for statement in statements:
+            self.shadow(statement.early_bound())
+        out = []
+        for statement in statements:
+            out.append(self.visit(statement))
+            self.shadow(statement.bound())
+        self.env = saved
+        return out
+
+
+class FreeVars(Visitor):
+    """Iterate over the free variables of a node"""
+
+    def generic_visit(self, node):
+        for child in children(node):
+            yield from self.visit(child)
+
+    def visit_IdExpr(self, node):
+        yield node.span.str()
+
+    def visit_FnExpr(self, node):
+        bound = set()
+        for pat in node.params:
+            bound.update(pat.bound())
+        for var in self.visit(node.inner):
+            if var not in bound:
+                yield var
+
+    def visit_BlockExpr(self, node):
+        yield from free(node.statements)
+
+    def visit_LoopExpr(self, node):
+        yield from free(node.statements)
+
+    def visit_BlockStatement(self, node):
+        yield from free(node.statements)
+
+    def visit_Arm(self, node):
+        bound = set(node.pattern.bound())
+        for var in self.visit(node.expr):
+            if var not in bound:
+                yield var
+
+    def visit_LetStatement(self, node):
+        yield from self.visit(node.inner)
+
+    def visit_FnStatement(self, node):
+        bound = {node.name.str()}
+        for pat in node.params:
+            bound.update(pat.bound())
+        for var in free(node.body):
+            if var not in bound:
+                yield var
+
+    def visit_Pattern(self, node):
+        yield from ()
+
+
+class BoundVars(Visitor):
+    """Iterate over the variables bound by a pattern or statement"""
+
+    def generic_visit(self, node):
+        yield from ()
+
+    def visit_IdPattern(self, node):
+        yield node.name.str()
+        if node.inner is not None:
+            yield from self.visit(node.inner)
+
+    def visit_ArrayPattern(self, node):
+        for item in node.items:
+            yield from self.visit(item)
+
+    def visit_GatherPattern(self, node):
+        if node.inner is not None:
+            yield from self.visit(node.inner)
+
+    def visit_LetStatement(self, node):
+        yield from self.visit(node.pattern)
+
+
+class EarlyBoundVars(Visitor):
+    """Iterate over the variables a statement binds for the whole of its enclosing block"""
+
+    def generic_visit(self, node):
+        yield from ()
+
+    def visit_FnStatement(self, node):
+        yield node.name.str()
+
+
+def _token_text(value):
+    if isinstance(value, Span):
+        return value.str()
+    if isinstance(value, list):
+        return tuple(_token_text(item) for item in value)
+    if isinstance(value, Value):
+        return repr(value)
+    return value
+
+
+@cache
+def label_fields(ty: type) -> tuple[str, ...]:
+    """Names of the non-child fields of a node type that take part in structural equality
+
+    The overall `span` of a node only matters for leaves, where its text is the whole content of the node (e.g. the digits of an `IntExpr`).
+    """
+    children = child_fields(ty)
+    return tuple(
+        f.name
+        for f in fields(ty)
+        if f.name not in children and (f.name != "span" or not children)
+    )
+
+
+def node_label(node: SyntaxNode) -> tuple:
+    """The type of a node and the text of its tokens, ignoring where they appear in the source"""
+    return (type(node),) + tuple(
+        _token_text(getattr(node, name)) for name in label_fields(type(node))
+    )
+
+
+def _child_keys(node: SyntaxNode, key: Callable) -> tuple:
+    out = []
+    for name in child_fields(type(node)):
+        value = getattr(node, name)
+        if isinstance(value, list):
+            out.append(tuple(key(child) for child in value))
+        elif value is not None:
+            out.append(key(value))
+        else:
+            out.append(None)
+    return tuple(out)
+
+
+def structural_hash(node: SyntaxNode, memo: Optional[dict[int, int]] = None) -> int:
+    """Hash a subtree, ignoring spans
+
+    Hashes are computed once per node, bottom-up. Pass the same `memo` to several calls to share work between overlapping subtrees; it must not outlive the tree.
+    """
+    if memo is None:
+        memo = {}
+    for child in reversed(list(walk(node))):
+        if id(child) not in memo:
+            keys = _child_keys(child, lambda c: memo[id(c)])
+            memo[id(child)] = hash((node_label(child), keys))
+    return memo[id(node)]
+
+
+class HashCons:
+    """Table of canonical subtrees
+
+    `intern` maps every subtree to a single canonical representative of its structural equivalence class, so structurally equal trees intern to the same object and identity can stand in for deep comparison. Canonical trees share subtrees and must not be rewritten in place.
+    """
+
+    def __init__(self):
+        self.table: dict[tuple, SyntaxNode] = {}
+        self._memo: dict[int, tuple[SyntaxNode, SyntaxNode]] = {}
+
+    def __len__(self):
+        return len(self.table)
+
+    def intern(self, node: SyntaxNode) -> SyntaxNode:
+        """Get the canonical subtree structurally equal to `node`"""
+        memo = self._memo
+        for child in reversed(list(walk(node))):
+            if id(child) in memo:
+                continue
+            canonical = lambda c: memo[id(c)][1]
+            key = (node_label(child), _child_keys(child, lambda c: id(canonical(c))))
+            if (out := self.table.get(key)) is None:
+                changes = {}
+                for name in child_fields(type(child)):
+                    value = getattr(child, name)
+                    if isinstance(value, list):
+                        new = [canonical(c) for c in value]
+                        if any(a is not b for a, b in zip(value, new)):
+                            changes[name] = new
+                    elif value is not None and canonical(value) is not value:
+                        changes[name] = canonical(value)
+                out = replace(child, **changes) if changes else child
+                self.table[key] = out
+            # Keep `child` alive so its id cannot be reused by another node
+            memo[id(child)] = (child, out)
+        return memo[id(node)][1]
+
+    def clear(self):
+        self.table.clear()
+        self._memo.clear()
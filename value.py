@@ -1,4 +1,5 @@
 from dataclasses import dataclass, field
+from typing import Callable, Optional
 
 from instr import Instr
 from mixins import Format
@@ -9,10 +10,22 @@ class ClosureSpec(Format):
     code: list[Instr]
     n_args: int
     capture_indices: list[int]
+    # Values `Const` refs in the code index, see `constants.py`
+    constants: list["Value"] = field(default_factory=list)
+    # Calls run by the VM, and the code compiled to a Python function once there were enough, see `jit.py`
+    calls: int = field(default=0, init=False, compare=False, repr=False)
+    jit: Optional[Callable] = field(default=None, init=False, compare=False, repr=False)
+    # The code threaded for the interpreter on its first run, see `vm.thread`
+    steps: Optional[list[Callable]] = field(default=None, init=False, compare=False, repr=False)
 
     def short(self):
         return f"{type(self).__qualname__}"
 
+    def invalidate(self):
+        """Drop what was derived from the code, once it is rewritten in place"""
+        self.jit = None
+        self.steps = None
+
     def positional(self):
         yield from self.code
 
@@ -57,11 +70,6 @@ class String(Value):
         yield self.value
 
 
-@dataclass
-class StringBuffer(Value):
-    pieces: list[String]
-
-
 @dataclass
 class Float(Value):
     value: float
@@ -91,3 +99,13 @@ class Closure(Value):
     @classmethod
     def from_code(cls, code):
         return cls(ClosureSpec(code, 0, []), [])
+
+
+# Unit and booleans carry no state, so every use shares one instance of each
+UNIT = Unit()
+TRUE = Bool(True)
+FALSE = Bool(False)
+
+
+def boolean(b: bool) -> Bool:
+    return TRUE if b else FALSE
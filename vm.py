@@ -1,27 +1,55 @@
+import sys
+from collections import Counter
 from dataclasses import dataclass, field
-from typing import Any, Optional
+from typing import Any, Callable, Optional
 
+import jit
+import ops
 from errors import VmError
 from instr import (
     Arg,
     ArrayExtend,
     ArrayPush,
+    ArraySlice,
     Assert,
+    BinaryOp,
     Call,
     Cap,
+    CaptureSet,
     ClosureNew,
+    Compare,
+    Const,
+    Fail,
+    FloatBinaryOp,
     Imm,
+    Index,
     Instr,
+    IntBinaryOp,
+    Jump,
     LocalJump,
+    MatchArray,
+    NumberCompare,
     Ref,
     Stack,
     Pop,
     Push,
+    PushArrayPush,
+    PushCall,
+    PushTailCall,
     Return,
+    Store,
+    StorePop,
+    StringConcat,
+    StringFormat,
+    Switch,
+    TailCall,
+    UnaryOp,
 )
 from mixins import Format
-from value import Bool, Closure, Value
+from value import TRUE, Array, Closure, ClosureSpec, Float, Int, String, Value, boolean
+from cache import CompileCache
 from compile import compile
+from jit import Compiled
 
 
 @dataclass
@@ -29,6 +57,8 @@ class StackFrame(Format):
     closure: Closure
     args: list[Any]
     locals: list[Any] = field(default_factory=list)
+    # Where the code resumes when the call it made returns
+    ip: int = 0
 
     def positional(self):
         yield self.closure
@@ -36,10 +66,494 @@ class StackFrame(Format):
         yield from self.locals
 
 
+def shape(instr: Instr) -> str:
+    """Name of an instruction for profiles; pushes also name the kind of value they push"""
+    if isinstance(instr, Push):
+        return f"Push({type(instr.value).__name__})"
+    return type(instr).__name__
+
+
+@dataclass
+class Profile(Format):
+    """Counts of executed instructions, and of pairs and triples executed one after another, by `shape`"""
+
+    singles: Counter = field(default_factory=Counter)
+    pairs: Counter = field(default_factory=Counter)
+    triples: Counter = field(default_factory=Counter)
+    recent: tuple[str, ...] = ()
+
+    def record(self, instr: Instr):
+        name = shape(instr)
+        self.singles[name] += 1
+        self.recent = (*self.recent[-2:], name)
+        if len(self.recent) >= 2:
+            self.pairs[self.recent[-2:]] += 1
+        if len(self.recent) == 3:
+            self.triples[self.recent] += 1
+
+    def total(self) -> int:
+        return sum(self.singles.values())
+
+
+# Calls of a spec after which it runs compiled, by default
+JIT_THRESHOLD = 1000
+
+# Frames on the stack of a VM, by default
+MAX_DEPTH = 100_000
+
+# Compiled code runs in Python frames, and calls through `Vm.run`. Beyond this many compiled calls in progress, calls are
+# interpreted, as the interpreter runs calls without Python frames.
+MAX_COMPILED_DEPTH = 100
+
+# A step executes one instruction in a frame and returns the index of the next one. The code of a closure is threaded
+# into a list of steps when it is first run, with the kind of each operand and the index of the next instruction
+# already decided, so running it is one call per instruction.
+Step = Callable[["Vm", StackFrame], int]
+
+# Reads an operand from a frame
+Getter = Callable[[StackFrame], Value]
+
+# Instruction type -> the function making the step of an instruction at an index
+THREADERS: dict[type, Callable[[Any, int], Step]] = {}
+
+# Returned by steps that leave the code of the running closure
+RETURN = sys.maxsize
+TAIL_CALL = sys.maxsize - 1
+CALL = sys.maxsize - 2
+
+
+def threads(*types: type):
+    def register(fn):
+        for ty in types:
+            THREADERS[ty] = fn
+        return fn
+
+    return register
+
+
+def getter(ref: Ref) -> Getter:
+    """Read an operand, like `Vm.resolve` with the match done once"""
+    match ref:
+        case Arg(index):
+            return lambda frame: frame.args[index]
+
+        case Cap(index):
+            return lambda frame: frame.closure.captures[index]
+
+        case Imm(value):
+            return lambda frame: value
+
+        case Const(index):
+            return lambda frame: frame.closure.spec.constants[index]
+
+        case Stack(index):
+            return lambda frame: frame.locals[index]
+
+        case Ref():
+            raise NotImplementedError(f"`Vm.resolve({type(ref).__name__})`")
+    raise TypeError
+
+
+def thread(instr: Instr, ip: int) -> Step:
+    """The step that executes an instruction at an index"""
+    if (threader := THREADERS.get(type(instr))) is None:
+        raise NotImplementedError(f"`Vm.run` missing case for instruction: {instr}")
+    return threader(instr, ip)
+
+
+@threads(Push)
+def thread_push(instr: Push, ip: int) -> Step:
+    next = ip + 1
+    match instr.value:
+        case Array():
+            # Array literals push a fresh array; the template only records how many items follow
+            def step(vm, frame):
+                frame.locals.append(Array([]))
+                return next
+
+        case Imm(value):
+
+            def step(vm, frame):
+                frame.locals.append(value)
+                return next
+
+        case Stack(index):
+
+            def step(vm, frame):
+                locals = frame.locals
+                locals.append(locals[index])
+                return next
+
+        case ref:
+            get = getter(ref)
+
+            def step(vm, frame):
+                frame.locals.append(get(frame))
+                return next
+
+    return step
+
+
+# Operands of known types, the operators looked up once
+@threads(IntBinaryOp, FloatBinaryOp)
+def thread_number_op(instr: IntBinaryOp | FloatBinaryOp, ip: int) -> Step:
+    next = ip + 1
+    ty, table = (Int, ops.INT_BINARY) if isinstance(instr, IntBinaryOp) else (Float, ops.FLOAT_BINARY)
+    f = table[instr.op]
+    left, right = getter(instr.left), getter(instr.right)
+
+    def step(vm, frame):
+        frame.locals.append(ty(f(left(frame).value, right(frame).value)))
+        return next
+
+    return step
+
+
+@threads(NumberCompare)
+def thread_number_compare(instr: NumberCompare, ip: int) -> Step:
+    next = ip + 1
+    f = ops.NUMBER_COMPARE[instr.op]
+    left, right = getter(instr.left), getter(instr.right)
+
+    def step(vm, frame):
+        frame.locals.append(boolean(f(left(frame).value, right(frame).value)))
+        return next
+
+    return step
+
+
+@threads(StringConcat)
+def thread_string_concat(instr: StringConcat, ip: int) -> Step:
+    next = ip + 1
+    left, right = getter(instr.left), getter(instr.right)
+
+    def step(vm, frame):
+        frame.locals.append(String(left(frame).value + right(frame).value))
+        return next
+
+    return step
+
+
+@threads(Call)
+def thread_call(instr: Call, ip: int) -> Step:
+    next = ip + 1
+    closure = getter(instr.closure)
+
+    def step(vm, frame):
+        callee = closure(frame)
+        frame.ip = next
+        vm.push_frame(callee)
+        return CALL
+
+    return step
+
+
+@threads(PushCall)
+def thread_push_call(instr: PushCall, ip: int) -> Step:
+    next = ip + 1
+    closure = getter(instr.closure)
+    args = [getter(ref) for ref in instr.args]
+
+    def step(vm, frame):
+        frame.ip = next
+        vm.push_frame(closure(frame), [arg(frame) for arg in args])
+        return CALL
+
+    return step
+
+
+@threads(PushTailCall)
+def thread_push_tail_call(instr: PushTailCall, ip: int) -> Step:
+    closure = getter(instr.closure)
+    args = [getter(ref) for ref in instr.args]
+
+    def step(vm, frame):
+        callee = closure(frame)
+        frame.args = [arg(frame) for arg in args]
+        frame.closure = callee
+        frame.locals.clear()
+        return TAIL_CALL
+
+    return step
+
+
+@threads(TailCall)
+def thread_tail_call(instr: TailCall, ip: int) -> Step:
+    closure = getter(instr.closure)
+    n_args = instr.n_args
+
+    def step(vm, frame):
+        # Replace the running closure in the current frame instead of nesting a new one
+        callee = closure(frame)
+        locals = frame.locals
+        frame.args = locals[len(locals) - n_args :]
+        frame.closure = callee
+        locals.clear()
+        return TAIL_CALL
+
+    return step
+
+
+@threads(ClosureNew)
+def thread_closure_new(instr: ClosureNew, ip: int) -> Step:
+    next = ip + 1
+    spec = instr.spec
+    captures = [getter(ref) for ref in spec.capture_indices]
+
+    def step(vm, frame):
+        frame.locals.append(Closure(spec, [capture(frame) for capture in captures]))
+        return next
+
+    return step
+
+
+@threads(CaptureSet)
+def thread_capture_set(instr: CaptureSet, ip: int) -> Step:
+    next = ip + 1
+    closure, index, value = getter(instr.closure), instr.index, getter(instr.value)
+
+    def step(vm, frame):
+        closure(frame).captures[index] = value(frame)
+        return next
+
+    return step
+
+
+@threads(ArrayPush)
+def thread_array_push(instr: ArrayPush, ip: int) -> Step:
+    next = ip + 1
+    array, value = getter(instr.array), getter(instr.value)
+
+    def step(vm, frame):
+        array(frame).values.append(value(frame))
+        # The item is the temporary on top of the stack
+        frame.locals.pop()
+        return next
+
+    return step
+
+
+@threads(PushArrayPush)
+def thread_push_array_push(instr: PushArrayPush, ip: int) -> Step:
+    next = ip + 1
+    array, value = getter(instr.array), getter(instr.value)
+
+    def step(vm, frame):
+        array(frame).values.append(value(frame))
+        return next
+
+    return step
+
+
+@threads(ArrayExtend)
+def thread_array_extend(instr: ArrayExtend, ip: int) -> Step:
+    next = ip + 1
+    array, source = getter(instr.array_loc), getter(instr.item_ref)
+
+    def step(vm, frame):
+        array(frame).values.extend(source(frame).values)
+        return next
+
+    return step
+
+
+@threads(LocalJump)
+def thread_local_jump(instr: LocalJump, ip: int) -> Step:
+    next, dest = ip + 1, instr.dest
+    condition = getter(instr.condition)
+
+    def step(vm, frame):
+        return dest if condition(frame) == TRUE else next
+
+    return step
+
+
+@threads(Jump)
+def thread_jump(instr: Jump, ip: int) -> Step:
+    dest = instr.dest
+    return lambda vm, frame: dest
+
+
+@threads(Switch)
+def thread_switch(instr: Switch, ip: int) -> Step:
+    value, cases, default = getter(instr.value), instr.cases, instr.default
+
+    def step(vm, frame):
+        return cases.get(ops.switch_key(value(frame)), default)
+
+    return step
+
+
+@threads(MatchArray)
+def thread_match_array(instr: MatchArray, ip: int) -> Step:
+    next = ip + 1
+    array, lower_bound, dest = getter(instr.array), instr.lower_bound, instr.dest
+
+    def step(vm, frame):
+        value = array(frame)
+        if isinstance(value, Array) and len(value.values) >= lower_bound:
+            return next
+        return dest
+
+    return step
+
+
+@threads(Fail)
+def thread_fail(instr: Fail, ip: int) -> Step:
+    reason = instr.reason
+
+    def step(vm, frame):
+        raise VmError(reason)
+
+    return step
+
+
+@threads(Index)
+def thread_index(instr: Index, ip: int) -> Step:
+    next = ip + 1
+    array, ix = getter(instr.array), getter(instr.ix)
+
+    def step(vm, frame):
+        frame.locals.append(array(frame).values[ix(frame).value])
+        return next
+
+    return step
+
+
+@threads(ArraySlice)
+def thread_array_slice(instr: ArraySlice, ip: int) -> Step:
+    next = ip + 1
+    array, skip_front, skip_back = getter(instr.array), instr.skip_front, instr.skip_back
+
+    def step(vm, frame):
+        values = array(frame).values
+        frame.locals.append(Array(values[skip_front : len(values) - skip_back]))
+        return next
+
+    return step
+
+
+@threads(Return)
+def thread_return(instr: Return, ip: int) -> Step:
+    # Like the end of the code, returns the value on top of the stack
+    return lambda vm, frame: RETURN
+
+
+@threads(Store)
+def thread_store(instr: Store, ip: int) -> Step:
+    next, dest = ip + 1, instr.dest.index
+    value = getter(instr.value)
+
+    def step(vm, frame):
+        frame.locals[dest] = value(frame)
+        return next
+
+    return step
+
+
+@threads(Pop)
+def thread_pop(instr: Pop, ip: int) -> Step:
+    next, n = ip + 1, instr.n
+
+    def step(vm, frame):
+        locals = frame.locals
+        del locals[len(locals) - n :]
+        return next
+
+    return step
+
+
+@threads(StorePop)
+def thread_store_pop(instr: StorePop, ip: int) -> Step:
+    next, dest, n = ip + 1, instr.dest.index, instr.n
+    value = getter(instr.value)
+
+    def step(vm, frame):
+        locals = frame.locals
+        locals[dest] = value(frame)
+        del locals[len(locals) - n :]
+        return next
+
+    return step
+
+
+@threads(Assert)
+def thread_assert(instr: Assert, ip: int) -> Step:
+    next, reason = ip + 1, instr.reason
+    value = getter(instr.value)
+
+    def step(vm, frame):
+        if value(frame) != TRUE:
+            raise VmError(f"assertion error: {reason}")
+        return next
+
+    return step
+
+
+@threads(StringFormat)
+def thread_string_format(instr: StringFormat, ip: int) -> Step:
+    next, template = ip + 1, instr.template
+    operands = [getter(ref) for ref in instr.operands]
+
+    def step(vm, frame):
+        frame.locals.append(String(ops.render(template, [operand(frame) for operand in operands])))
+        return next
+
+    return step
+
+
+@threads(BinaryOp)
+def thread_binary_op(instr: BinaryOp, ip: int) -> Step:
+    next, op = ip + 1, instr.op
+    left, right = getter(instr.left), getter(instr.right)
+
+    def step(vm, frame):
+        frame.locals.append(ops.binary(op, left(frame), right(frame)))
+        return next
+
+    return step
+
+
+@threads(UnaryOp)
+def thread_unary_op(instr: UnaryOp, ip: int) -> Step:
+    next, op = ip + 1, instr.op
+    inner = getter(instr.inner)
+
+    def step(vm, frame):
+        frame.locals.append(ops.unary(op, inner(frame)))
+        return next
+
+    return step
+
+
+@threads(Compare)
+def thread_compare(instr: Compare, ip: int) -> Step:
+    next, names = ip + 1, instr.ops
+    operands = [getter(ref) for ref in instr.operands]
+
+    def step(vm, frame):
+        frame.locals.append(ops.compare(names, [operand(frame) for operand in operands]))
+        return next
+
+    return step
+
+
 @dataclass
 class Vm(Format):
     stack: list[StackFrame] = field(default_factory=lambda: [])
 
+    # When set, every executed instruction is recorded, and nothing runs compiled
+    profile: Optional[Profile] = None
+
+    # Calls of a spec after which it runs compiled to a Python function, or `None` to only interpret
+    jit_threshold: Optional[int] = JIT_THRESHOLD
+
+    # Frames the stack may hold, for the depth of recursion
+    max_depth: int = MAX_DEPTH
+
+    # Calls running compiled
+    compiled_depth: int = field(default=0, repr=False)
+
     def positional(self):
         yield from self.stack
 
@@ -47,16 +561,17 @@ class Vm(Format):
     def frame(self):
         return self.stack[-1]
 
-    def push_frame(self, closure):
-        if len(self.stack) == 0:
+    def push_frame(self, closure, args=None):
+        if len(self.stack) >= self.max_depth:
+            raise VmError(f"stack overflow: more than {self.max_depth} nested calls")
+        if args is None and len(self.stack) == 0:
             assert closure.spec.n_args == 0, "First closure run must not have arguments"
             args = []
-        else:
+        elif args is None:
             n_args = closure.spec.n_args
-            self.frame.locals, args = (
-                self.frame.locals[:-n_args],
-                self.frame.locals[-n_args:],
-            )
+            locals = self.frame.locals
+            args = locals[len(locals) - n_args :]
+            del locals[len(locals) - n_args :]
         self.stack.append(StackFrame(closure, args))
 
     def pop_frame(self) -> StackFrame:
@@ -75,6 +590,9 @@ class Vm(Format):
             case Imm(value):
                 return value
 
+            case Const(index):
+                return self.frame.closure.spec.constants[index]
+
             case Stack(index):
                 return self.frame.locals[index]
 
@@ -84,74 +602,87 @@ class Vm(Format):
     def push(self, value):
         self.frame.locals.append(value)
 
-    def ret(self, value_ref):
-        return_value = self.resolve(value_ref)
-        self.pop_frame()
-        return return_value
+    def decode(self, spec: ClosureSpec) -> list[Step]:
+        """The steps of the code of a spec, threaded on its first run and kept on the spec for later ones"""
+        if spec.steps is None:
+            spec.steps = [thread(instr, ip) for ip, instr in enumerate(spec.code)]
+        return spec.steps
 
-    def run(self, closure: list[Instr] | Closure) -> Value:
-        self.closure = closure
+    def tier_up(self, spec: ClosureSpec) -> Optional[Compiled]:
+        """Count a call of a spec, compiling it to a Python function once it is called often enough"""
+        if spec.jit is None and self.jit_threshold is not None:
+            spec.calls += 1
+            if spec.calls >= self.jit_threshold:
+                spec.jit = jit.compile_spec(spec)
+        return spec.jit
 
-        # Push the new frame
-        self.push_frame(closure)
-        code = closure.spec.code
+    def run(self, closure: list[Instr] | Closure, args: Optional[list[Value]] = None) -> Value:
+        """Run a closure, with arguments taken from the top of the stack unless they are given
 
+        The calls it makes push frames on `self.stack` and run in the same loop, each frame keeping where its code resumes, so the depth of recursion is only limited by `max_depth`.
+
+        Raises:
+            VmError: The code fails, or the stack overflows
+        """
+        self.closure = closure
+        base = len(self.stack)
+        self.push_frame(closure, args)
+        frame = self.frame
         ip = 0
-        while ip in range(len(code)):
-            instr = code[ip]
-            match instr:
-                case Push(value_ref):
-                    value = self.resolve(value_ref)
-                    self.push(value)
-
-                case Call():
-                    closure = self.resolve(instr.closure)
-                    value = self.run(closure)
-                    self.push(value)
-
-                case ClosureNew(spec):
-                    captures = [self.frame[i] for i in spec.capture_indices]
-                    closure = Closure(spec, captures)
-                    self.push(closure)
-
-                case ArrayPush(dest_ref, item_ref):
-                    dest = self.resolve(dest_ref)
-                    item = self.resolve(item_ref)
-                    dest.values.append(item)
-
-                case ArrayExtend(dest_ref, source_ref):
-                    dest = self.resolve(dest_ref)
-                    source = self.resolve(source_ref)
-                    dest.values.extend(source.values)
-
-                case LocalJump(condition_ref, dest):
-                    condition = self.resolve(condition_ref)
-                    if condition == Bool(True):
-                        ip = dest
-                        continue
-
-                case Return(return_value_ref):
-                    return self.ret(return_value_ref)
-
-                case Pop():
-                    self.frame.locals.pop()
-
-                case Assert():
-                    value = self.resolve(instr.value)
-                    if value != Bool(True):
-                        raise VmError(f"assertion error: {instr.reason}")
-
-                case _:
-                    raise NotImplementedError(
-                        f"`Vm.run` missing case for instruction: {instr}"
-                    )
-
-            ip += 1
-        return self.ret(Stack(-1))
-
-
-def run(code):
+
+        while True:
+            spec = frame.closure.spec
+            if (
+                ip == 0
+                and self.profile is None
+                and self.compiled_depth < MAX_COMPILED_DEPTH
+                and (compiled := self.tier_up(spec)) is not None
+            ):
+                self.compiled_depth += 1
+                try:
+                    value = compiled(self, frame)
+                finally:
+                    self.compiled_depth -= 1
+                if value is None:
+                    # Tail call
+                    continue
+            else:
+                code = spec.code
+                steps = self.decode(spec)
+                n = len(steps)
+                if self.profile is None:
+                    while ip < n:
+                        ip = steps[ip](self, frame)
+                else:
+                    while ip < n:
+                        self.profile.record(code[ip])
+                        ip = steps[ip](self, frame)
+                if ip == CALL:
+                    frame = self.frame
+                    ip = 0
+                    continue
+                if ip == TAIL_CALL:
+                    # The new closure runs in the same frame
+                    ip = 0
+                    continue
+                value = frame.locals[-1]
+
+            # Return to the caller
+            self.pop_frame()
+            if len(self.stack) == base:
+                return value
+            frame = self.frame
+            frame.locals.append(value)
+            ip = frame.ip
+
+
+def run(
+    code,
+    profile: Optional[Profile] = None,
+    cache: Optional[CompileCache] = None,
+    jit_threshold: Optional[int] = JIT_THRESHOLD,
+):
     if isinstance(code, str):
-        code = compile(code)
-    vm = Vm()
+        code = compile(code) if cache is None else cache.compile(code)
+    vm = Vm(profile=profile, jit_threshold=jit_threshold)
     return vm.run(code)